@@ -0,0 +1,98 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmark of event fan-out.
+
+Usage: python -m bench.events [--subscribers N] [--events N] [--all N]
+
+Subscribes handlers to a single event type each (and a number of
+handlers to all events), then pushes a stream of events of every
+type.  The indexed, serialise-once EventManager is measured against
+the scan-and-serialise-per-subscriber implementation it replaced.
+
+"""
+
+import argparse
+import json
+import random
+import time
+
+from igor.server import event
+from igor.server import queue
+
+
+class ScanEventManager(queue.EventManager):
+    """The previous EventManager, which scanned every subscriber."""
+    def push_event(self, event):
+        for subscriber, events in self:
+            if len(events) == 0 or isinstance(event, events):
+                subscriber.push_event(event)
+
+
+class Subscriber:
+    def __init__(self):
+        self.sent = 0
+
+    def push(self, data):
+        self.sent += len(data)
+
+    def push_event(self, event):
+        self.push(event.to_bytes())
+
+
+class SerialisingSubscriber(Subscriber):
+    """Subscriber that serialises each event it is pushed."""
+    def push_event(self, event):
+        self.push(json.dumps(event.to_obj()).encode('UTF-8') + b'\n')
+
+
+def bench(label, em_cls, sub_cls, args):
+    random.seed(0)
+    em = em_cls()
+    types = sorted(event.Event.events.values(), key=lambda cls: cls.name())
+    subscribers = [sub_cls() for i in range(args.subscribers)]
+    for i, subscriber in enumerate(subscribers):
+        em.add(subscriber, () if i < args.all else (random.choice(types),))
+    events = [
+        random.choice(types)(order_id=str(i), spec_uri='/bench')
+        for i in range(args.events)
+    ]
+
+    t_start = time.time()
+    for ev in events:
+        em.push_event(ev)
+    elapsed = time.time() - t_start
+    sent = sum(subscriber.sent for subscriber in subscribers)
+    print('{:40} {:9.3f}s {:12} bytes'.format(label, elapsed, sent))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--subscribers', type=int, default=10000)
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument(
+        '--all', type=int, default=10,
+        help='number of subscribers subscribed to all events')
+    args = parser.parse_args()
+    bench('indexed, serialise once', queue.EventManager, Subscriber, args)
+    bench('indexed, serialise per subscriber',
+          queue.EventManager, SerialisingSubscriber, args)
+    bench('scan, serialise per subscriber (previous)',
+          ScanEventManager, SerialisingSubscriber, args)
+
+
+if __name__ == '__main__':
+    main()
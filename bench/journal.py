@@ -0,0 +1,79 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Order intake rate with the order journal off and on.
+
+Usage: python -m bench.journal [--orders N] [--batch N] [--dir DIR]
+
+Orders are added to an OrderManager with no subscribers.  The
+journal is flushed every ``--batch`` orders, standing in for the
+orders created during one event loop iteration; a batch of 1 is an
+fsync per order.  Use ``--dir`` to place the journal on the file
+system of interest.
+
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from igor import order as _order
+from igor.server import journal
+from igor.server import queue
+
+
+def bench(label, args, batch=None):
+    with tempfile.TemporaryDirectory(dir=args.dir) as name:
+        j = None
+        if batch:
+            j = journal.Journal(
+                os.path.join(name, 'journal'),
+                snapshot_interval=args.snapshot_interval)
+        om = queue.OrderManager(journal=j)
+        orders = [
+            _order.Order(
+                desc='bench', spec_uri='/bench', spec_ref='bench',
+                source_uri='/bench')
+            for i in range(args.orders)
+        ]
+        t_start = time.time()
+        for i, o in enumerate(orders, 1):
+            om.add_order(o)
+            if j is not None and i % batch == 0:
+                j.flush()
+        if j is not None:
+            j.close()
+        elapsed = time.time() - t_start
+    print('{:28} {:8.3f}s {:10.0f} orders/s'.format(
+        label, elapsed, args.orders / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--snapshot-interval', type=int, default=10000)
+    parser.add_argument('--dir')
+    args = parser.parse_args()
+
+    bench('journal off', args)
+    bench('journal, batch {}'.format(args.batch), args, args.batch)
+    bench('journal, fsync per order', args, 1)
+
+
+if __name__ == '__main__':
+    main()
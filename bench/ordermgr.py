@@ -0,0 +1,147 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmark of OrderManager queue maintenance.
+
+Usage: python -m bench.ordermgr [--orders N] [--slots N] [--per-worker N]
+
+Registers subscriber slots and unsubscribes every worker, then
+queues orders with no subscribers, cancels a sample of them and
+assigns the rest.  Each scheduling policy is measured, along with
+the deque-based queues that the indexed queues replaced.
+
+"""
+
+import argparse
+import collections
+import random
+import time
+import uuid
+
+from igor import order as _order
+from igor.server import queue
+from igor.server import schedule
+
+
+class DequePolicy(collections.deque):
+    """The previous deque-based order queue."""
+    def push(self, order):
+        self.append(order.id)
+
+    def pushleft(self, order):
+        self.appendleft(order.id)
+
+    def discard(self, order_id):
+        while order_id in self:
+            self.remove(order_id)
+
+
+class DequeOrderManager(queue.OrderManager):
+    """OrderManager with the previous deque-based queues."""
+    def __init__(self):
+        super().__init__(policy=DequePolicy())
+        self.subq = collections.deque()
+
+    def subscribe(self, subscriber, count=1):
+        self.subscribers[subscriber.id] = subscriber
+        self.subq.extend([subscriber.id] * count)
+        self._assign()
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.pop(subscriber.id, None)
+        while subscriber.id in self.subq:
+            self.subq.remove(subscriber.id)
+
+
+class Subscriber:
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+
+    def push_order(self, order):
+        pass
+
+
+def timed(label, f, *args):
+    t_start = time.time()
+    f(*args)
+    elapsed = time.time() - t_start
+    print('  {:32} {:9.3f}s'.format(label, elapsed))
+
+
+def bench(label, cls, args, **kwargs):
+    om = cls(**kwargs)
+    orders = [
+        _order.Order(
+            desc='bench', spec_uri='/bench',
+            spec_ref='bench{}'.format(random.randrange(args.specs)),
+            source_uri='/bench', priority=random.randrange(args.priorities))
+        for i in range(args.orders)
+    ]
+    victims = random.sample(orders, args.cancel)
+    workers = [Subscriber() for i in range(args.slots // args.per_worker)]
+
+    def add_orders():
+        for o in orders:
+            om.add_order(o)
+
+    def cancel_orders():
+        for o in victims:
+            om.cancel_order(o)
+
+    def assign():
+        w = Subscriber()
+        om.subscribe(w, args.orders - args.cancel)
+
+    def subscribe():
+        for i in range(args.per_worker):
+            for w in workers:
+                om.subscribe(w)
+
+    def unsubscribe():
+        for w in workers:
+            om.unsubscribe(w)
+
+    print('{}:'.format(label))
+    timed('subscribe {} slots'.format(args.slots), subscribe)
+    timed('unsubscribe {} workers'.format(len(workers)), unsubscribe)
+    timed('add {} orders'.format(args.orders), add_orders)
+    timed('cancel {} queued orders'.format(args.cancel), cancel_orders)
+    timed('assign remaining orders', assign)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--cancel', type=int, default=1000)
+    parser.add_argument('--slots', type=int, default=10000)
+    parser.add_argument('--per-worker', type=int, default=8)
+    parser.add_argument(
+        '--specs', type=int, default=100,
+        help='number of distinct specs the orders are spread over')
+    parser.add_argument(
+        '--priorities', type=int, default=10,
+        help='number of distinct priorities the orders are spread over')
+    args = parser.parse_args()
+    for name in sorted(schedule.Policy.policies):
+        bench('{} policy'.format(name), queue.OrderManager, args,
+              policy=schedule.Policy.lookup(name)())
+    bench('priority policy with fair share', queue.OrderManager, args,
+          policy=schedule.PriorityPolicy(inner=schedule.FairSharePolicy))
+    bench('deque (previous implementation)', DequeOrderManager, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the asyncore and asyncio server engines.
+
+Usage: python -m bench.server [--workers N] [--subscribers N] [--orders N]
+
+Each engine is started in a subprocess.  Worker clients register an
+assignment slot, complete every order they receive and register
+again; subscribers subscribe to all events.  Orders are pipelined
+down a single trigger connection and the time until every order has
+been completed and every subscriber has seen every completion is
+reported.
+
+The asyncore engine is limited by ``select()`` to descriptors below
+``FD_SETSIZE`` (usually 1024) and fails outright above that.
+
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+
+def line(obj):
+    return json.dumps(obj).encode('UTF-8') + b'\n'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def connect(port):
+    for i in range(100):
+        try:
+            return await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+async def register(port, obj, limit):
+    """Connect and send ``obj``; return once the server has processed it.
+
+    A bogus command follows the registration; the error reply
+    indicates that the server has accepted the connection and
+    processed everything before it.
+
+    The asyncore server listens with a backlog of 5.  Connection
+    bursts larger than that are dropped and retried by TCP a second
+    or more later, so the number of registrations in flight is
+    limited.
+
+    """
+    async with limit:
+        reader, writer = await connect(port)
+        writer.write(line(obj) + line({'command': 'ping'}))
+        while b'error' not in await reader.readline():
+            pass
+    return reader, writer
+
+
+async def worker(port, ready, limit):
+    reader, writer = await register(port, {'command': 'orderassign'}, limit)
+    ready.release()
+    while True:
+        data = await reader.readline()
+        if not data:
+            return
+        obj = json.loads(data.decode('UTF-8'))
+        if 'order' in obj:
+            writer.write(line({
+                'command': 'ordercomplete',
+                'params': {'order_id': obj['order']['id'], 'result': 'C'},
+            }) + line({'command': 'orderassign'}))
+
+
+async def subscriber(port, ready, limit, n_orders, done):
+    reader, writer = await register(
+        port, {'command': 'subscribe', 'params': {'events': []}}, limit)
+    ready.release()
+    completed = 0
+    while completed < n_orders:
+        data = await reader.readline()
+        if not data:
+            break
+        if b'OrderCompleted' in data:
+            completed += 1
+    done.release()
+    writer.close()
+
+
+async def watch(proc):
+    while proc.poll() is None:
+        await asyncio.sleep(0.1)
+    raise RuntimeError('server exited with status {}'.format(proc.returncode))
+
+
+async def bench(port, proc, args):
+    # clients of a crashed server fail noisily; the crash is reported
+    asyncio.get_event_loop().set_exception_handler(lambda loop, ctx: None)
+    done, pending = await asyncio.wait(
+        [asyncio.ensure_future(run(port, args)),
+            asyncio.ensure_future(watch(proc))],
+        return_when=asyncio.FIRST_COMPLETED
+    )
+    for task in pending:
+        task.cancel()
+    return done.pop().result()
+
+
+async def run(port, args):
+    ready = asyncio.Semaphore(0)
+    done = asyncio.Semaphore(0)
+    limit = asyncio.Semaphore(4)
+    tasks = [
+        asyncio.ensure_future(worker(port, ready, limit))
+        for i in range(args.workers)
+    ] + [
+        asyncio.ensure_future(
+            subscriber(port, ready, limit, args.orders, done))
+        for i in range(args.subscribers)
+    ]
+    for i in range(len(tasks)):
+        await ready.acquire()
+
+    reader, writer = await connect(port)
+    t_start = time.time()
+    writer.write(b''.join(
+        line({'command': 'ordercreate', 'params': {'order': {
+            'id': str(uuid.uuid4()), 'desc': 'bench',
+            'spec_uri': '/bench', 'spec_ref': 'bench',
+            'source_uri': '/bench',
+        }}})
+        for i in range(args.orders)
+    ))
+    await writer.drain()
+    for i in range(args.subscribers):
+        await done.acquire()
+    elapsed = time.time() - t_start
+
+    for task in tasks:
+        task.cancel()
+    writer.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=1000)
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=1000)
+    parser.add_argument(
+        '--engine', action='append', choices=('asyncore', 'asyncio'))
+    args = parser.parse_args()
+
+    for engine in args.engine or ('asyncore', 'asyncio'):
+        port = free_port()
+        stderr = tempfile.TemporaryFile()
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'igor.server',
+                '--engine', engine, '--host', '127.0.0.1',
+                '--port', str(port)],
+            stdout=subprocess.DEVNULL, stderr=stderr,
+            env=dict(os.environ, PYTHONWARNINGS='ignore'),
+        )
+        try:
+            elapsed = asyncio.run(bench(port, proc, args))
+        except RuntimeError as e:
+            stderr.seek(0)
+            lines = stderr.read().decode('UTF-8', 'replace').splitlines()
+            print('{:9} failed: {}: {}'.format(
+                engine, e, lines[-1] if lines else ''))
+            continue
+        finally:
+            proc.terminate()
+            proc.wait()
+            stderr.close()
+        print('{:9} {:6} workers {:6} subscribers {:6} orders: '
+              '{:7.3f}s ({:.0f} orders/s, {:.0f} events/s)'.format(
+                  engine, args.workers, args.subscribers, args.orders,
+                  elapsed, args.orders / elapsed,
+                  args.orders * 4 * args.subscribers / elapsed))
+
+
+if __name__ == '__main__':
+    main()
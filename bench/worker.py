@@ -0,0 +1,179 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the pool and asyncio worker engines.
+
+Usage: python -m bench.worker [--orders N] [--concurrency N] [--steps N]
+
+A server and a worker are started in subprocesses for each engine.
+A spec repository whose steps each run ``true`` is created, and
+orders to build it (from itself) are pipelined to the server.  The
+time until every order has completed gives the per-order overhead of
+the engine; the resident memory of the worker and all of its child
+processes is sampled throughout and the peak reported.
+
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from .server import free_port, line
+
+
+def git(cwd, *args):
+    subprocess.check_call(
+        ('git',) + args, cwd=cwd,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def spec_repo(path, steps):
+    """Create a repo at ``path`` with a spec at ``refs/ci/spec/bench``."""
+    git(None, 'init', '--quiet', path)
+    os.mkdir(os.path.join(path, 'steps'))
+    for i in range(steps):
+        with open(os.path.join(path, 'steps', '{:02}'.format(i)), 'w') as f:
+            f.write('true\n')
+    git(path, 'add', 'steps')
+    git(
+        path, '-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+        'commit', '--quiet', '-m', 'bench')
+    git(path, 'update-ref', 'refs/ci/spec/bench', 'HEAD')
+
+
+def rss(pid):
+    """Return resident bytes of the process and its descendants."""
+    total = 0
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for entry in f:
+                if entry.startswith('VmRSS:'):
+                    total += int(entry.split()[1]) * 1024
+        with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+            children = f.read().split()
+    except OSError:
+        return total
+    return total + sum(rss(child) for child in children)
+
+
+def sample_rss(pid, stop, peak):
+    while not stop.is_set():
+        peak[0] = max(peak[0], rss(pid))
+        stop.wait(0.05)
+
+
+def wait_for_port(port):
+    for i in range(100):
+        try:
+            return socket.create_connection(('127.0.0.1', port))
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+def run(engine, repo, args):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'igor.server', '--engine', 'asyncio',
+            '--host', '127.0.0.1', '--port', str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    client = None
+    worker = None
+    with tempfile.TemporaryDirectory() as cache:
+        try:
+            client = wait_for_port(port).makefile('rwb')
+            client.write(line({
+                'command': 'subscribe',
+                'params': {'events': ['OrderCompleted']},
+            }))
+            client.flush()
+            worker = subprocess.Popen(
+                [sys.executable, '-m', 'igor.worker', '--engine', engine,
+                    '--host', '127.0.0.1', '--port', str(port),
+                    '--concurrency', str(args.concurrency),
+                    '--repo-cache', cache],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                env=dict(os.environ, PYTHONWARNINGS='ignore'),
+            )
+            stop, peak = threading.Event(), [0]
+            sampler = threading.Thread(
+                target=sample_rss, args=(worker.pid, stop, peak))
+            sampler.start()
+
+            t_start = time.time()
+            client.write(b''.join(
+                line({'command': 'ordercreate', 'params': {'order': {
+                    'id': str(uuid.uuid4()), 'desc': 'bench',
+                    'spec_uri': repo, 'spec_ref': 'refs/ci/spec/bench',
+                    'source_uri': repo, 'source_type': 'git',
+                }}})
+                for i in range(args.orders)
+            ))
+            client.flush()
+            results = {}
+            while sum(results.values()) < args.orders:
+                data = client.readline()
+                if not data:
+                    raise RuntimeError('server closed the connection')
+                obj = json.loads(data.decode('UTF-8'))
+                if obj.get('event') == 'OrderCompleted':
+                    result = obj['params']['result']
+                    results[result] = results.get(result, 0) + 1
+            elapsed = time.time() - t_start
+            stop.set()
+            sampler.join()
+            return elapsed, peak[0], results
+        finally:
+            for proc in (worker, server):
+                if proc is not None:
+                    proc.terminate()
+                    proc.wait()
+            if client is not None:
+                client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--orders', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=2)
+    parser.add_argument(
+        '--engine', action='append', choices=('pool', 'asyncio'))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = os.path.join(tmp, 'spec')
+        spec_repo(repo, args.steps)
+        for engine in args.engine or ('pool', 'asyncio'):
+            elapsed, peak, results = run(engine, repo, args)
+            print('{:8} {:5} orders at concurrency {:4}: {:7.3f}s '
+                  '({:.1f} ms/order), peak RSS {:.0f} MiB, results {}'.format(
+                      engine, args.orders, args.concurrency, elapsed,
+                      1000 * elapsed / args.orders, peak / 2 ** 20,
+                      ' '.join('{}={}'.format(k, v)
+                               for k, v in sorted(results.items()))))
+
+
+if __name__ == '__main__':
+    main()
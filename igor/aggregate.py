@@ -0,0 +1,147 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Fold incoming build reports into the report chains.
+
+Workers publishing with ``order.PUBLISH_INCOMING`` push each report
+to its own ref, ``refs/ci/incoming/<worker>/<spec>/<order-id>``, so
+that they do not contend for ``refs/ci/report/<spec>``.  The
+aggregator runs beside the repository to which the workers push, and
+periodically appends the incoming reports of each spec to its report
+chain, in the order they were written, then deletes their refs.
+
+Each incoming report is rewritten with the tip of the report chain
+as its first parent; its other parents, tree and message are kept,
+so that the chain is as if the reports had been pushed to it.
+
+Usage: python -m igor.aggregate --repo PATH [--interval SECONDS]
+
+"""
+
+import argparse
+import collections
+import logging
+import time
+
+from . import git
+
+logger = logging.getLogger(__name__)
+
+INCOMING_REFS = 'refs/ci/incoming/'
+REPORT_REFS = 'refs/ci/report/'
+INTERVAL = 5.0  # seconds between aggregations
+BATCH_SIZE = 100  # incoming reports appended to a chain at once
+
+
+def incoming(repo):
+    """Return a ``dict`` of spec name to its incoming reports.
+
+    Each spec's reports are a list of ``(ref, commit)``, oldest
+    first.
+
+    """
+    reports = collections.defaultdict(list)
+    for name in repo.listall_references():
+        if not name.startswith(INCOMING_REFS):
+            continue
+        parts = name[len(INCOMING_REFS):].split('/')
+        if len(parts) != 3:
+            logger.warning('ignoring malformed ref {}'.format(name))
+            continue
+        worker, spec, order_id = parts
+        commit = git.peel(repo, 'commit', repo.lookup_reference(name))
+        reports[spec].append((name, commit))
+    for spec_reports in reports.values():
+        spec_reports.sort(key=lambda x: (x[1].commit_time, x[0]))
+    return dict(reports)
+
+
+def append(repo, spec, reports):
+    """Append incoming reports to the spec's report chain.
+
+    The report ref is moved and the incoming refs deleted in one
+    transaction.  Return True if it succeeded, or False if a ref
+    moved meanwhile (e.g. a worker appended to the chain itself);
+    the reports are then left to be appended later.
+
+    """
+    report_ref = REPORT_REFS + spec
+    try:
+        tip = repo.lookup_reference(report_ref).target
+    except KeyError:
+        tip = None
+    new = tip or repo.null_report()
+    for ref, commit in reports:
+        new = repo.rebase_commit(commit, new)
+    updates = [(report_ref, new, tip)]
+    updates.extend((ref, None, commit.oid) for ref, commit in reports)
+    return repo.update_refs(updates)
+
+
+def aggregate(repo, *, batch_size=BATCH_SIZE):
+    """Append the incoming reports of every spec to its chain.
+
+    At most ``batch_size`` reports of each spec are appended.
+    Return the number of reports appended.
+
+    """
+    appended = 0
+    for spec, reports in sorted(incoming(repo).items()):
+        batch = reports[:batch_size]
+        if append(repo, spec, batch):
+            logger.info('appended {} reports to {}'.format(
+                len(batch), REPORT_REFS + spec))
+            appended += len(batch)
+        else:
+            logger.info('{} moved; retrying later'.format(
+                REPORT_REFS + spec))
+    return appended
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='fold incoming igor-ci reports into report chains')
+    parser.add_argument(
+        '--repo', required=True, metavar='PATH',
+        help='repository to which workers push reports')
+    parser.add_argument(
+        '--interval', type=float, default=INTERVAL, metavar='SECONDS',
+        help='aggregate every SECONDS; 0 to aggregate once and exit '
+             '(default: {})'.format(INTERVAL))
+    parser.add_argument(
+        '--batch-size', type=int, default=BATCH_SIZE, metavar='N',
+        help='append at most N reports to a chain at once '
+             '(default: {})'.format(BATCH_SIZE))
+    parser.add_argument('--logging', metavar='LEVEL')
+    args = parser.parse_args()
+
+    if args.logging:
+        try:
+            level = getattr(logging, args.logging.upper())
+        except AttributeError:
+            level = logging.INFO
+        logging.basicConfig(level=level)
+
+    repo = git.Repository(args.repo)
+    while True:
+        aggregate(repo, batch_size=args.batch_size)
+        if args.interval <= 0:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import functools
 import os
 import subprocess
 import time
@@ -23,6 +25,7 @@ import pygit2
 from . import build_source
 from . import build_report
 from . import git
+from . import spool
 
 
 class SpecError(Exception):
@@ -30,28 +33,78 @@ class SpecError(Exception):
 
 
 class BuildStep:
-    """A single step in a build process."""
+    """A single step in a build process.
+
+    A step is stored in the spec's ``steps`` tree either as a blob
+    containing its script, or as a tree containing a ``script`` blob
+    and optionally an ``after`` blob listing, one per line, the names
+    of the steps that must succeed before it runs.  A step stored as
+    a blob runs after the step that precedes it in lexicographic
+    order.
+
+    Output of the step is spooled (see ``spool.Spool``), keeping up
+    to ``spool_memory`` bytes of each of standard output and standard
+    error in memory.  If ``max_output`` is not ``None``, at most that
+    many bytes of each are kept.
+
+    """
+    spool_memory = spool.DEFAULT_MAX_MEMORY
+    max_output = None
+
+    @classmethod
+    def set_output_limits(cls, *, spool_memory, max_output):
+        cls.spool_memory = spool_memory
+        cls.max_output = max_output
+
     @classmethod
     def from_blob(cls, repo, oid):
         """Instantiate from a blob in the given repository."""
         return cls(script=repo[oid].data)
 
+    @classmethod
+    def from_tree(cls, repo, oid):
+        """Instantiate from a step tree in the given repository."""
+        tree = repo[oid]
+        if 'script' not in tree:
+            raise SpecError('step tree has no script')
+        after = ()
+        if 'after' in tree:
+            data = repo[tree['after'].oid].data.decode('UTF-8')
+            after = tuple(line for line in data.split() if line)
+        return cls(script=repo[tree['script'].oid].data, after=after)
+
     def __eq__(self, other):
-        return isinstance(other, type(self)) and self._script == other._script
+        return isinstance(other, type(self)) \
+            and self._script == other._script and self.after == other.after
 
     def __ne__(self, other):
         return not self == other
 
-    def __init__(self, *, script):
+    def __init__(self, *, script, after=None):
+        """Initialise the build step.
+
+        ``script``
+          Shell script to execute (``bytes``).
+        ``after``
+          Names of the steps that must succeed before this step
+          runs.  If ``None``, the step runs after the step that
+          precedes it in lexicographic order.
+
+        """
         self._script = script  # shell script to execute (bytes)
+        self.after = None if after is None else tuple(after)
 
-    def execute(self, *, env, cwd):
+    def execute(self, *, env, cwd, log=None):
         """Execute this build step, returning a ``BuildStepReport``.
 
         ``env``
           Environment in which to execute the build step.
         ``cwd``
           Directory in which to execute the build step.
+        ``log``
+          If not ``None``, a callable that is given the name of the
+          stream (``'stdout'`` or ``'stderr'``) and each chunk of
+          output as the step produces it.
 
         """
         t_start = time.time()
@@ -63,23 +116,43 @@ class BuildStep:
             env=env,
             cwd=cwd
         )
-        stdout, stderr = proc.communicate(self._script)
+        stdout, stderr = (
+            spool.Spool(
+                max_memory=self.spool_memory,
+                max_size=self.max_output,
+                tee=log and functools.partial(log, stream)
+            )
+            for stream in ('stdout', 'stderr')
+        )
+        returncode = spool.communicate(
+            proc, self._script, {proc.stdout: stdout, proc.stderr: stderr})
         t_finish = time.time()
 
         return build_report.BuildStepReport(
             t_start=t_start,
             t_finish=t_finish,
-            exit=proc.returncode,
+            exit=returncode,
             stdout=stdout,
             stderr=stderr
         )
 
 
 class BuildSpec:
-    """A build specification."""
+    """A build specification.
+
+    Steps whose dependencies have succeeded are executed
+    concurrently, up to ``parallelism`` at once.
+
+    """
     __slots__ = 'env', 'oid',  'name', 'steps'
     __attrs__ = __slots__
 
+    parallelism = 1  # steps of an order executed at once
+
+    @classmethod
+    def set_parallelism(cls, parallelism):
+        cls.parallelism = parallelism
+
     @classmethod
     def from_ref(cls, repo, name):
         obj = repo.revparse_single(name)
@@ -96,16 +169,22 @@ class BuildSpec:
             raise NotImplementedError
 
         steps = {
-            te.name: BuildStep.from_blob(repo, te.oid)
+            te.name: (
+                BuildStep.from_tree(repo, te.oid)
+                if te.filemode == pygit2.GIT_FILEMODE_TREE
+                else BuildStep.from_blob(repo, te.oid)
+            )
             for te in repo[tree['steps'].oid]
         }
 
-        return cls(
+        spec = cls(
             name=name,
             oid=commit_oid,
             env=env,
             steps=steps,
         )
+        spec.dependencies()  # reject a bad step graph before execution
+        return spec
 
     def __eq__(self, other):
         if isinstance(other, type(self)):
@@ -140,7 +219,8 @@ class BuildSpec:
           environment
         ``steps``
           Mapping of name to ``BuildStep``.  Build steps will be
-          executed in lexicographic order.
+          executed in lexicographic order, subject to their
+          dependencies.
 
         """
         self.name = name
@@ -148,25 +228,87 @@ class BuildSpec:
         self.steps = steps
         self.env = env or {}
 
-    def execute(self, *, order, source_oid=None, cwd):
+    def dependencies(self):
+        """Return a ``dict`` of step name to names of its prerequisites.
+
+        Raise ``SpecError`` if a step depends on an unknown step or
+        the dependencies are cyclic.
+
+        """
+        dependencies = {}
+        prev = None
+        for name in sorted(self.steps):
+            after = self.steps[name].after
+            if after is None:
+                after = () if prev is None else (prev,)
+            unknown = set(after) - set(self.steps)
+            if unknown:
+                raise SpecError(
+                    'step {!r} depends on unknown steps: {}'.format(
+                        name, ', '.join(sorted(unknown))))
+            dependencies[name] = frozenset(after)
+            prev = name
+
+        # check for cycles by repeatedly removing steps that are ready
+        remaining = dict(dependencies)
+        while remaining:
+            ready = [
+                name for name, after in remaining.items()
+                if not after & remaining.keys()
+            ]
+            if not ready:
+                raise SpecError('cyclic step dependencies: {}'.format(
+                    ', '.join(sorted(remaining))))
+            for name in ready:
+                del remaining[name]
+        return dependencies
+
+    def environment(self):
+        """Return the environment in which the steps are executed."""
+        return dict(os.environ, **self.env)
+
+    def execute(self, *, order, source_oid=None, cwd, log=None):
         """Execute the build specification and return a ``BuildReport``.
 
         If ``order`` is not an assigned and incomplete
         ``BuildOrder``, raise ``SpecError``.
 
+        If ``log`` is not ``None``, it is called with the step name,
+        stream name and each chunk of output of the running steps.
+
         """
         if not order.assigned or order.completed:
             raise SpecError('order must be assigned and incomplete')
 
-        env = dict(os.environ, **self.env)
+        env = self.environment()
 
-        # run the build steps
+        # run the build steps; once one fails, start no more
+        dependencies = self.dependencies()
+        waiting = sorted(self.steps)
         step_reports = {}
-        for name in sorted(self.steps):
-            step_reports[name] = \
-                self.steps[name].execute(env=env, cwd=cwd)
-            if not step_reports[name].ok():
-                break
+        running = {}
+        failed = False
+        with concurrent.futures.ThreadPoolExecutor(self.parallelism) as ex:
+            while True:
+                for name in list(waiting):
+                    if failed or len(running) >= self.parallelism:
+                        break
+                    if dependencies[name] <= step_reports.keys():
+                        waiting.remove(name)
+                        future = ex.submit(
+                            self.steps[name].execute,
+                            env=env, cwd=cwd,
+                            log=log and functools.partial(log, name)
+                        )
+                        running[future] = name
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    step_reports[name] = future.result()
+                    failed = failed or not step_reports[name].ok()
 
         # return report
         return build_report.BuildReport(
@@ -177,3 +319,25 @@ class BuildSpec:
             env=env,
             step_reports=step_reports
         )
+
+    def reuse(self, *, order, source_oid, report, cached):
+        """Return a ``BuildReport`` reusing the results of ``report``.
+
+        No steps are executed; the step reports are those of the
+        earlier ``report`` of the same inputs, whose commit oid is
+        ``cached``.  The same conditions apply to ``order`` as for
+        ``execute``.
+
+        """
+        if not order.assigned or order.completed:
+            raise SpecError('order must be assigned and incomplete')
+
+        return build_report.BuildReport(
+            spec_oid=self.oid,
+            source_oid=source_oid,
+            name=self.name,
+            order=order.complete(),
+            env=self.environment(),
+            step_reports=report.step_reports,
+            cached=cached
+        )
@@ -21,6 +21,7 @@ import pygit2
 
 from . import order
 from . import git
+from . import spool
 
 
 class ReportError(Exception):
@@ -51,9 +52,9 @@ class BuildStepReport:
         ``t_finish``
           Time that the step finished as UTC UNIX timestamp.
         ``stdout``
-          ``bytes`` of standard output.
+          ``bytes`` or ``spool.Spool`` of standard output.
         ``stderr``
-          ``bytes`` of standard error.
+          ``bytes`` or ``spool.Spool`` of standard error.
 
         """
         self.exit = exit
@@ -68,10 +69,17 @@ class BuildStepReport:
             raise AttributeError('immutable object')
         object.__setattr__(self, name, value)
 
+    def _getvalue(self, attr):
+        """Return the attribute, with spooled output as ``bytes``."""
+        value = getattr(self, attr)
+        if isinstance(value, spool.Spool):
+            return value.getvalue()
+        return value
+
     def __eq__(self, other):
         if isinstance(other, type(self)):
             return all(
-                getattr(self, attr) == getattr(other, attr)
+                self._getvalue(attr) == other._getvalue(attr)
                 for attr in self.__attrs__
             )
         else:
@@ -81,7 +89,7 @@ class BuildStepReport:
         return '{}({})'.format(
             type(self).__name__,
             ', '.join(
-                '{}={}'.format(attr, getattr(self, attr))
+                '{}={}'.format(attr, self._getvalue(attr))
                 for attr in self.__attrs__
             )
         )
@@ -100,10 +108,13 @@ class BuildStepReport:
         tb.insert('t_start', oid, pygit2.GIT_FILEMODE_BLOB)
         oid = repo.create_blob(bytes(str(self.t_finish) + '\n', 'UTF-8'))
         tb.insert('t_finish', oid, pygit2.GIT_FILEMODE_BLOB)
-        oid = repo.create_blob(self.stdout)
-        tb.insert('stdout', oid, pygit2.GIT_FILEMODE_BLOB)
-        oid = repo.create_blob(self.stderr)
-        tb.insert('stderr', oid, pygit2.GIT_FILEMODE_BLOB)
+        for name in ('stdout', 'stderr'):
+            output = getattr(self, name)
+            if isinstance(output, spool.Spool):
+                oid = output.create_blob(repo)
+            else:
+                oid = repo.create_blob(output)
+            tb.insert(name, oid, pygit2.GIT_FILEMODE_BLOB)
 
         return tb.write()
 
@@ -113,24 +124,33 @@ class BuildReport:
     def from_commit(cls, repo, oid):
         commit = repo[oid]
         parents = [c.oid for c in commit.parents]
+        source_oid = parents[2] if len(parents) >= 3 else None
+        if 'source' in commit.tree:
+            source_oid = pygit2.Oid(
+                hex=repo[commit.tree['source'].oid].data.decode('ascii'))
+        cached = None
+        if 'cached' in commit.tree:
+            cached = pygit2.Oid(
+                hex=repo[commit.tree['cached'].oid].data.decode('ascii'))
         step_reports = {
             te.name: BuildStepReport.from_tree(repo, te.oid)
             for te in repo[commit.tree['steps'].oid]
         }
         return cls(
             spec_oid=parents[1],
-            source_oid=parents[2] if len(parents) >= 3 else None,
+            source_oid=source_oid,
             name=re.search(r'(?<= ).*', commit.message).group(),
             order=order.Order.from_blob(repo[commit.tree['order'].oid]),
             env=git.bytes_to_obj(repo[commit.tree['env'].oid].data),
-            step_reports=step_reports
+            step_reports=step_reports,
+            cached=cached
         )
 
     def __init__(
         self,
         *,
         spec_oid, source_oid=None, name,
-        order, env, step_reports
+        order, env, step_reports, cached=None
     ):
         """Initialise the build report.
 
@@ -150,6 +170,10 @@ class BuildReport:
         ``step_reports``
           Mapping of ``BuildStepReport`` values.  The order is
           implicit in the keys (i.e., lexicographic order).
+        ``cached``
+          Oid of the earlier report whose step reports this report
+          reuses (see ``result_cache``), or ``None`` if the steps
+          were executed.
 
         """
         self.spec_oid = spec_oid
@@ -161,6 +185,7 @@ class BuildReport:
         self.order = order
         self.env = env
         self.step_reports = step_reports
+        self.cached = cached
 
     def __eq__(self, other):
         if isinstance(other, type(self)):
@@ -168,7 +193,7 @@ class BuildReport:
                 getattr(self, name) == getattr(other, name)
                 for name in (
                     'spec_oid', 'source_oid',
-                    'name', 'order', 'env', 'step_reports',
+                    'name', 'order', 'env', 'step_reports', 'cached',
                 )
             )
         else:
@@ -192,8 +217,13 @@ class BuildReport:
         """Return a textual representation of the result."""
         return 'PASS' if self.ok() else 'FAIL'
 
-    def _write_tree(self, repo):
-        """Write tree into the repo and return the object ID."""
+    def write_tree(self, repo):
+        """Write tree into the repo and return the object ID.
+
+        A source commit outside the repository cannot be a parent of
+        the report commit, so its oid is recorded in the tree.
+
+        """
         tb = repo.TreeBuilder()
 
         tb.insert(
@@ -205,6 +235,12 @@ class BuildReport:
         tb.insert('env', blob, pygit2.GIT_FILEMODE_BLOB)
         blob = repo.create_blob(self.result().encode('UTF-8'))
         tb.insert('result', blob, pygit2.GIT_FILEMODE_BLOB)
+        if self.source_oid and self.source_oid not in repo:
+            blob = repo.create_blob(self.source_oid.hex.encode('ascii'))
+            tb.insert('source', blob, pygit2.GIT_FILEMODE_BLOB)
+        if self.cached:
+            blob = repo.create_blob(self.cached.hex.encode('ascii'))
+            tb.insert('cached', blob, pygit2.GIT_FILEMODE_BLOB)
 
         steps_tb = repo.TreeBuilder()
         for name, report in self.step_reports.items():
@@ -212,9 +248,13 @@ class BuildReport:
         tb.insert('steps', steps_tb.write(), pygit2.GIT_FILEMODE_TREE)
         return tb.write()
 
-    def write(self, repo, prev_oid):
+    def write(self, repo, prev_oid, *, tree=None):
         """Write to the repository and return the commit oid.
 
+        ``tree`` is the oid of the tree if already written (see
+        ``write_tree``), so that a report can be rewritten onto
+        another ``prev_oid`` cheaply.
+
         This method does not write or update any refs; this is the
         caller's responsibility.
 
@@ -224,5 +264,5 @@ class BuildReport:
             parents.append(self.source_oid)
 
         return repo.create_commit(
-            None, self.message(), self._write_tree(repo), parents
+            None, self.message(), tree or self.write_tree(repo), parents
         )
@@ -17,18 +17,45 @@
 import abc
 import collections
 import logging
+import os
+import shutil
 import subprocess
 
 import pygit2
 
+from . import cache
+
 logger = logging.getLogger(__name__)
 
+# what ``BuildSource.update`` removes from an earlier checkout
+CLEAN_NONE = 'none'  # nothing; files not in the source are kept
+CLEAN_UNTRACKED = 'untracked'  # files not in the source, unless ignored
+CLEAN_ALL = 'all'  # all files not in the source
+CLEAN_POLICIES = (CLEAN_NONE, CLEAN_UNTRACKED, CLEAN_ALL)
+
+
+def empty(path):
+    """Remove everything in the directory, but not the directory."""
+    for name in os.listdir(path):
+        child = os.path.join(path, name)
+        if os.path.isdir(child) and not os.path.islink(child):
+            shutil.rmtree(child)
+        else:
+            os.unlink(child)
+
 
 class BuildSource(metaclass=abc.ABCMeta):
     """Base class for mechanism to fetch things to build."""
 
     impls = collections.OrderedDict()
 
+    probe_cache = None  # cache.ProbeCache used by get_for_uri
+
+    @classmethod
+    def set_probe_cache(cls, probe_cache):
+        """Use the given ``cache.ProbeCache``; ``None`` to always probe."""
+        cls.probe_cache = probe_cache
+
     @classmethod
     def register(cls, name, impl):
         """Register a build source implementation.
@@ -57,17 +84,29 @@ class BuildSource(metaclass=abc.ABCMeta):
         return cls.impls[name](uri, *args, **kwargs)
 
     @classmethod
-    def get_for_uri(cls, uri, *args, **kwargs):
+    def get_for_uri(cls, uri, *args, source_type=None, **kwargs):
         """Find a registered source that will handle the given URI.
 
-        Implementations are tried in the order that they were
-        registered.  The first to return a true value is
+        If ``source_type`` is given, instantiate the implementation
+        of that name.  Otherwise, if the probe cache has a current
+        record of the implementation that handles the URI, use it.
+
+        Otherwise, implementations are tried in the order that they
+        were registered.  The first to return a true value is
         instantiated and returned.  If none of the registered
         implementations return true, raise ``RuntimeError``.
 
         """
-        for impl in cls.impls.values():
+        if source_type is not None:
+            return cls.get(source_type, uri, *args, **kwargs)
+        if cls.probe_cache is not None:
+            name = cls.probe_cache.get(uri)
+            if name in cls.impls:
+                return cls.get(name, uri, *args, **kwargs)
+        for name, impl in cls.impls.items():
             if impl.handles_uri(uri):
+                if cls.probe_cache is not None:
+                    cls.probe_cache.put(uri, name)
                 return impl(uri, *args, **kwargs)
         raise RuntimeError('No source available for {!r}.'.format(uri))
 
@@ -86,9 +125,55 @@ class BuildSource(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError
 
+    def prefetch(self):
+        """Bring any local copy of the source up to date.
+
+        Called ahead of ``checkout`` so that it has less to do.
+        This base implementation does nothing.
+
+        """
+
+    def update(self, dest, *, clean=CLEAN_UNTRACKED):
+        """Bring an earlier checkout in ``dest`` to the source.
+
+        Files not in the source are removed according to ``clean``,
+        one of ``CLEAN_POLICIES``.  If ``dest`` is empty, this is
+        ``checkout``.  Return as for ``checkout``.
+
+        This base implementation empties ``dest`` and calls
+        ``checkout``.
+
+        """
+        empty(dest)
+        return self.checkout(dest)
+
+
+def _git(*args):
+    subprocess.check_call(('git',) + args, stdout=subprocess.DEVNULL)
+
+
+def _git_output(*args):
+    return subprocess.check_output(
+        ('git',) + args, stderr=subprocess.DEVNULL).decode('UTF-8').strip()
+
 
 class GitBuildSource(BuildSource):
-    """A Git build source."""
+    """A Git build source.
+
+    By default each checkout is a full clone.  If ``mirror_root`` is
+    set (see ``set_mirror_root``), a bare mirror of each repository
+    is kept under it and brought up to date before each checkout,
+    fetching only new objects.  Checkouts then share the mirror's
+    objects, so their cost is that of the working tree alone.
+
+    """
+
+    mirror_root = None
+
+    @classmethod
+    def set_mirror_root(cls, path):
+        """Keep mirrors under ``path``; ``None`` to clone afresh."""
+        cls.mirror_root = path
 
     def __init__(self, url, *args):
         """Initialise the build source.
@@ -125,16 +210,96 @@ class GitBuildSource(BuildSource):
             return False
         return True
 
+    def mirror(self):
+        """Create or update the mirror of the repository.
+
+        Return the path to the mirror.  Processes sharing the mirror
+        root take turns to update a mirror.
+
+        """
+        os.makedirs(self.mirror_root, exist_ok=True)
+        path = os.path.join(
+            self.mirror_root, cache.RepoCache.key(self._url) + '.git')
+        with cache.flock(path + '.lock'):
+            if os.path.isdir(path):
+                logger.debug('updating mirror {}'.format(path))
+                _git('--git-dir', path, 'fetch', '--prune', '--quiet')
+            else:
+                logger.debug('mirroring {} into {}'.format(self._url, path))
+                _git('clone', '--mirror', '--quiet', self._url, path)
+        return path
+
+    def prefetch(self):
+        """Update the mirror, if mirrors are kept."""
+        if self.mirror_root is not None:
+            self.mirror()
+
     def checkout(self, dest):
         """Clone the repository to the given destination.
 
         Return the oid of the checked-out commit.
 
         """
+        if self.mirror_root is not None:
+            mirror = self.mirror()
+            logger.debug('cloning {} into {}'.format(mirror, dest))
+            _git('clone', '--shared', '--no-checkout', '--quiet', mirror, dest)
+            logger.debug('checking out {!r}'.format(self._rev))
+            _git('-C', dest, 'checkout', '--quiet', '--detach',
+                 self._rev or 'HEAD')
+            return pygit2.Repository(dest).head.target
+
         logger.debug('cloning {} into {}'.format(self._url, dest))
         repo = pygit2.clone_repository(self._url, dest)
         logger.debug('checking out {!r}'.format(self._rev))
         repo.checkout_tree(repo[self._rev], pygit2.GIT_CHECKOUT_SAFE_CREATE)
         return repo.head.target
 
+    def _resolve(self, dest):
+        """Return the commit the revision names after a fetch in ``dest``.
+
+        Remote branches are preferred to the checkout's stale local
+        branches of the same name.
+
+        """
+        for rev in ('origin/' + (self._rev or 'HEAD'), self._rev):
+            if rev is None:
+                continue
+            try:
+                return _git_output(
+                    '-C', dest, 'rev-parse', '--verify', '--quiet',
+                    rev + '^{commit}')
+            except subprocess.CalledProcessError:
+                continue
+        raise KeyError('Revision {!r} not found'.format(self._rev))
+
+    def update(self, dest, *, clean=CLEAN_UNTRACKED):
+        """Fetch into an earlier checkout in ``dest`` and reset it.
+
+        Ignored files, such as build outputs, survive unless
+        ``clean`` is ``CLEAN_ALL``.  If ``dest`` holds no checkout,
+        or it cannot be updated, it is checked out afresh.
+
+        """
+        if not os.path.isdir(os.path.join(dest, '.git')):
+            empty(dest)
+            return self.checkout(dest)
+        try:
+            if self.mirror_root is not None:
+                self.mirror()
+            logger.debug('updating checkout {}'.format(dest))
+            _git('-C', dest, 'fetch', '--quiet', '--force', 'origin')
+            commit = self._resolve(dest)
+            _git('-C', dest, 'checkout', '--quiet', '--force', '--detach',
+                 commit)
+            if clean == CLEAN_UNTRACKED:
+                _git('-C', dest, 'clean', '--quiet', '-fd')
+            elif clean == CLEAN_ALL:
+                _git('-C', dest, 'clean', '--quiet', '-fdx')
+            return pygit2.Repository(dest).head.target
+        except (subprocess.CalledProcessError, KeyError) as e:
+            logger.warning('checking out {} afresh: {}'.format(dest, e))
+            empty(dest)
+            return self.checkout(dest)
+
 BuildSource.register('git', GitBuildSource)
@@ -0,0 +1,454 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent caches on workers.
+
+Spec repositories are kept under a configurable root directory, at
+a path derived from a digest of the (normalised) repository URI, so
+every worker process and run uses the same clone.  An index of when
+each repository was last used, and its size, is shared by all
+processes using the root; least recently used repositories are
+evicted when the total size exceeds a limit.
+
+Which build source handles a URI is also remembered for a time, to
+save probing the URI for every order.
+
+Workspaces in which orders are built can be kept between orders of
+the same source and spec, so that build outputs and caches survive.
+Retired workspaces are deleted in the background.
+
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from . import git
+
+logger = logging.getLogger(__name__)
+
+CACHE_HOME = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'igor-ci'
+)
+DEFAULT_ROOT = os.path.join(CACHE_HOME, 'repos')
+DEFAULT_MAX_SIZE = 2 ** 30  # bytes
+DEFAULT_PROBES = os.path.join(CACHE_HOME, 'probes.json')
+DEFAULT_PROBE_TTL = 300  # seconds
+DEFAULT_WORKSPACES = os.path.join(CACHE_HOME, 'workspaces')
+DEFAULT_MAX_WORKSPACES = 8
+
+
+def normalise_uri(uri):
+    """Normalise a repository URI; local paths are made absolute."""
+    if uri.startswith(('/', '.')):
+        uri = os.path.abspath(uri)
+    return uri
+
+
+def disk_usage(path):
+    """Return the total size in bytes of files under the path."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+@contextlib.contextmanager
+def flock(path, operation=fcntl.LOCK_EX):
+    """Hold an advisory lock on the given lock file."""
+    with open(path, 'a') as f:
+        fcntl.flock(f, operation)
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def delete_in_background(path):
+    """Delete the directory tree in a daemon thread; return the thread."""
+    thread = threading.Thread(
+        target=shutil.rmtree, args=(path,), kwargs={'ignore_errors': True},
+        daemon=True
+    )
+    thread.start()
+    return thread
+
+
+class RepoCache:
+    """Size-bounded cache of bare spec repositories.
+
+    ``root``
+      Directory holding the repositories and their index.
+    ``max_size``
+      Total size in bytes above which least recently used
+      repositories are evicted.
+
+    Each repository is locked while in use; eviction skips
+    repositories in use by any process.
+
+    """
+    INDEX = 'index.json'
+
+    def __init__(self, root=DEFAULT_ROOT, *, max_size=DEFAULT_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+
+    @staticmethod
+    def key(uri):
+        return hashlib.sha256(normalise_uri(uri).encode('UTF-8')).hexdigest()
+
+    def path(self, uri):
+        """Return the path of the cached repository for the URI."""
+        return os.path.join(self.root, self.key(uri) + '.git')
+
+    def _lock_path(self, key):
+        return os.path.join(self.root, key + '.lock')
+
+    def _clone_lock_path(self, key):
+        return os.path.join(self.root, key + '.clone.lock')
+
+    @contextlib.contextmanager
+    def _index(self):
+        """Lock, read and yield the index, writing it back on exit."""
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, self.INDEX)
+        with flock(path + '.lock'):
+            try:
+                with open(path) as f:
+                    index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                index = {}
+            index.setdefault('repos', {})
+            index.setdefault('hits', 0)
+            index.setdefault('misses', 0)
+            yield index
+            with open(path + '.tmp', 'w') as f:
+                json.dump(index, f)
+            os.rename(path + '.tmp', path)
+
+    @contextlib.contextmanager
+    def open(self, uri):
+        """Clone or open the cached repository for the URI.
+
+        The repository is protected from eviction until the context
+        exits, whereupon its size is recorded and the cache trimmed.
+
+        """
+        key = self.key(uri)
+        path = self.path(uri)
+        os.makedirs(self.root, exist_ok=True)
+        with flock(self._lock_path(key), fcntl.LOCK_SH):
+            # users of a repository share it; only cloning is exclusive,
+            # so that no user opens a partial clone
+            hit = os.path.isdir(path)
+            with flock(
+                self._clone_lock_path(key),
+                fcntl.LOCK_SH if hit else fcntl.LOCK_EX
+            ):
+                hit = hit or os.path.isdir(path)  # cloned meanwhile
+                repo = git.Repository.clone_or_open(uri, path)
+            with self._index() as index:
+                index['hits' if hit else 'misses'] += 1
+                entry = index['repos'].setdefault(key, {'size': 0})
+                entry['uri'] = normalise_uri(uri)
+                entry['last_used'] = time.time()
+            logger.info('repo cache {} for {}'.format(
+                'hit' if hit else 'miss', uri))
+            yield repo
+        size = disk_usage(path)
+        with self._index() as index:
+            if key in index['repos']:
+                index['repos'][key]['size'] = size
+        self.evict()
+
+    def evict(self):
+        """Evict least recently used repositories not in use.
+
+        Return the number of repositories evicted.
+
+        """
+        evicted = 0
+        with self._index() as index:
+            repos = index['repos']
+            total = sum(entry['size'] for entry in repos.values())
+            by_age = sorted(repos, key=lambda k: repos[k]['last_used'])
+            for key in by_age:
+                if total <= self.max_size:
+                    break
+                try:
+                    with flock(
+                        self._lock_path(key), fcntl.LOCK_EX | fcntl.LOCK_NB
+                    ):
+                        shutil.rmtree(
+                            os.path.join(self.root, key + '.git'),
+                            ignore_errors=True
+                        )
+                except BlockingIOError:
+                    continue  # in use
+                logger.info('repo cache evicted {}'.format(repos[key]['uri']))
+                total -= repos[key]['size']
+                del repos[key]
+                evicted += 1
+        return evicted
+
+    def uris(self):
+        """Return the sorted URIs of the cached repositories."""
+        with self._index() as index:
+            return sorted(e['uri'] for e in index['repos'].values())
+
+    def stats(self):
+        """Return cache statistics, including the hit rate."""
+        with self._index() as index:
+            hits, misses = index['hits'], index['misses']
+            return {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0,
+                'repos': len(index['repos']),
+                'size': sum(e['size'] for e in index['repos'].values()),
+            }
+
+
+class ProbeCache:
+    """Time-limited record of the build source that handles each URI.
+
+    ``path``
+      JSON file in which the record is kept; processes using the
+      same file share it.
+    ``ttl``
+      Seconds for which a record is believed.
+
+    """
+    def __init__(self, path=DEFAULT_PROBES, *, ttl=DEFAULT_PROBE_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, uri, now=None):
+        """Return the name of the source recorded for the URI, or None."""
+        now = time.time() if now is None else now
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with flock(self.path + '.lock', fcntl.LOCK_SH):
+            entry = self._read().get(normalise_uri(uri))
+        if entry is not None and entry['expires'] > now:
+            return entry['source']
+        return None
+
+    def put(self, uri, source, now=None):
+        """Record that the named source handles the URI."""
+        now = time.time() if now is None else now
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with flock(self.path + '.lock'):
+            probes = {
+                k: v for k, v in self._read().items() if v['expires'] > now}
+            probes[normalise_uri(uri)] = {
+                'source': source, 'expires': now + self.ttl}
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(probes, f)
+            os.rename(self.path + '.tmp', self.path)
+
+
+class WorkspacePool:
+    """Pool of build workspaces kept between orders.
+
+    ``root``
+      Directory holding the workspaces and their index.
+    ``max_workspaces``
+      Number of workspaces above which least recently used
+      workspaces are retired.
+    ``clean``
+      What is removed from a reused workspace; one of
+      ``build_source.CLEAN_POLICIES``.
+
+    There is a workspace for each source URI and spec ref.  Each is
+    locked while in use; an order whose workspace is in use builds
+    in a fresh one, retired afterwards.  Retired workspaces are
+    moved aside and deleted in the background.
+
+    """
+    INDEX = 'index.json'
+    TRASH = 'trash'
+
+    def __init__(
+        self, root=DEFAULT_WORKSPACES, *,
+        max_workspaces=DEFAULT_MAX_WORKSPACES, clean='untracked'
+    ):
+        self.root = root
+        self.max_workspaces = max_workspaces
+        self.clean = clean
+
+    @staticmethod
+    def key(uri, spec_ref):
+        return hashlib.sha256(
+            '{}\0{}'.format(normalise_uri(uri), spec_ref).encode('UTF-8')
+        ).hexdigest()
+
+    def path(self, uri, spec_ref):
+        """Return the path of the workspace for the URI and spec ref."""
+        return os.path.join(self.root, self.key(uri, spec_ref))
+
+    def _lock_path(self, key):
+        return os.path.join(self.root, key + '.lock')
+
+    @contextlib.contextmanager
+    def _index(self):
+        """Lock, read and yield the index, writing it back on exit."""
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, self.INDEX)
+        with flock(path + '.lock'):
+            try:
+                with open(path) as f:
+                    index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                index = {}
+            index.setdefault('workspaces', {})
+            index.setdefault('hits', 0)
+            index.setdefault('misses', 0)
+            index.setdefault('busy', 0)
+            yield index
+            with open(path + '.tmp', 'w') as f:
+                json.dump(index, f)
+            os.rename(path + '.tmp', path)
+
+    def retire(self, path):
+        """Move the workspace aside and delete it in the background."""
+        trash = os.path.join(self.root, self.TRASH)
+        os.makedirs(trash, exist_ok=True)
+        retired = os.path.join(trash, uuid.uuid4().hex)
+        try:
+            os.rename(path, retired)
+        except FileNotFoundError:
+            return None
+        return delete_in_background(retired)
+
+    def sweep(self):
+        """Delete workspaces retired but not yet deleted, in the background.
+
+        Deletion is cut short if the process that retired a
+        workspace exits.  Return the number of workspaces swept.
+
+        """
+        trash = os.path.join(self.root, self.TRASH)
+        try:
+            names = os.listdir(trash)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            delete_in_background(os.path.join(trash, name))
+        return len(names)
+
+    @contextlib.contextmanager
+    def open(self, uri, spec_ref):
+        """Yield the path of a workspace for the URI and spec ref.
+
+        The workspace may hold the checkout of an earlier order (see
+        ``build_source.BuildSource.update``).  It is protected from
+        eviction until the context exits, whereupon the pool is
+        trimmed.
+
+        """
+        key = self.key(uri, spec_ref)
+        path = self.path(uri, spec_ref)
+        os.makedirs(self.root, exist_ok=True)
+        with open(self._lock_path(key), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock = None  # in use by another order
+
+            with self._index() as index:
+                if lock is None:
+                    index['busy'] += 1
+                else:
+                    hit = os.path.isdir(path)
+                    index['hits' if hit else 'misses'] += 1
+                    index['workspaces'][key] = {
+                        'uri': normalise_uri(uri),
+                        'spec_ref': spec_ref,
+                        'last_used': time.time(),
+                    }
+
+            if lock is None:
+                logger.info('workspace busy for {} {}'.format(uri, spec_ref))
+                path = os.path.join(self.root, 'tmp-' + uuid.uuid4().hex)
+                os.makedirs(path)
+                try:
+                    yield path
+                finally:
+                    self.retire(path)
+            else:
+                logger.info('workspace {} for {} {}'.format(
+                    'hit' if hit else 'miss', uri, spec_ref))
+                os.makedirs(path, exist_ok=True)
+                yield path
+        self.evict()
+
+    def evict(self):
+        """Retire least recently used workspaces not in use.
+
+        Return the number of workspaces retired.
+
+        """
+        evicted = 0
+        with self._index() as index:
+            workspaces = index['workspaces']
+            by_age = sorted(
+                workspaces, key=lambda k: workspaces[k]['last_used'])
+            for key in by_age:
+                if len(workspaces) <= self.max_workspaces:
+                    break
+                try:
+                    with flock(
+                        self._lock_path(key), fcntl.LOCK_EX | fcntl.LOCK_NB
+                    ):
+                        self.retire(os.path.join(self.root, key))
+                except BlockingIOError:
+                    continue  # in use
+                logger.info('workspace evicted for {} {}'.format(
+                    workspaces[key]['uri'], workspaces[key]['spec_ref']))
+                del workspaces[key]
+                evicted += 1
+        return evicted
+
+    def stats(self):
+        """Return pool statistics, including the hit rate."""
+        with self._index() as index:
+            hits, misses = index['hits'], index['misses']
+            return {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0,
+                'busy': index['busy'],
+                'workspaces': len(index['workspaces']),
+            }
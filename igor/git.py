@@ -14,16 +14,25 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import contextlib
+import fcntl
 import json
+import logging
+import os
 import re
-import subprocess  # TODO use native clone and fetch when available
+import subprocess  # TODO use native clone when available
+import time
 
 import pygit2
 
+logger = logging.getLogger(__name__)
+
 
 class Repository(pygit2.Repository):
     """Git repository with Igor extensions."""
 
+    fetch_window = 0.5  # seconds; see ``fetch``
+
     @staticmethod
     def signature(
         name='Igor CI',
@@ -72,20 +81,116 @@ class Repository(pygit2.Repository):
         except KeyError:
             return cls.clone(source, dest)
 
-    def fetch(self):
-        self.remotes[0].fetch()  # TODO check for name 'origin'?
+    def fetch(self, window=None):
+        """Fetch from the remote, coalescing concurrent fetches.
+
+        Processes fetching the same repository take turns.  If a
+        fetch that started no more than ``window`` seconds (default
+        ``fetch_window``) before this call has completed, the fetch
+        is skipped.  A ``window`` of 0 ensures that refs are at least
+        as fresh as at the time of the call.  A failed fetch does not
+        count, so that the next call fetches again.
+
+        Return True if a fetch was performed and succeeded, otherwise
+        False.
+
+        """
+        window = self.fetch_window if window is None else window
+        t_call = time.time()
+        lock_path = os.path.join(self.path, 'igor-fetch.lock')
+        stamp_path = os.path.join(self.path, 'igor-fetch.stamp')
+        with open(lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(stamp_path) as f:
+                    t_last = float(f.read())
+            except (FileNotFoundError, ValueError):
+                t_last = None
+            if t_last is not None and t_last >= t_call - window:
+                return False
+            t_start = time.time()
+            if not self.session().fetch():
+                return False
+            with open(stamp_path, 'w') as f:
+                f.write(repr(t_start))
+            return True
+
+    def fetch_ref(self, ref):
+        """Fetch the single ref from the remote, overwriting it locally.
+
+        The local ref is left alone if the remote has no such ref.
+        Return True if the fetch succeeded, otherwise False.
+
+        """
+        return self.session().fetch(['+{0}:{0}'.format(ref)])
 
     def push(self, refspec):
-        """Push the repository.
+        """Push the refspec to the remote.
 
         Return True if the push succeeded, otherwise False.
 
-        TODO: with current Git, this can segfault if HEAD doesn't
-        point anywhere.  Submit a patch to git, but workaround
-        in meantime.
+        """
+        return self.session().push(refspec)
+
+    def session(self, name='origin'):
+        """Return the ``RemoteSession`` of the named remote.
+
+        The session is kept for the life of this object, so that
+        back-to-back fetches and pushes share it.
+
+        """
+        sessions = self.__dict__.setdefault('_igor_sessions', {})
+        if name not in sessions:
+            sessions[name] = RemoteSession(self, name)
+        return sessions[name]
+
+    def update_refs(self, updates):
+        """Update refs in a single transaction.
+
+        ``updates`` is a sequence of ``(ref, new, old)`` oids.  A
+        ``new`` of ``None`` deletes the ref; an ``old`` of ``None``
+        requires that the ref does not exist.  Either every ref is
+        updated, or (if any ref is not at its ``old`` value) none.
+
+        Return True if the refs were updated, otherwise False.
+
+        """
+        zero = '0' * 40
+        lines = []
+        for ref, new, old in updates:
+            old = old.hex if old is not None else zero
+            if new is None:
+                lines.append('delete {} {}\n'.format(ref, old))
+            else:
+                lines.append('update {} {} {}\n'.format(ref, new.hex, old))
+        try:
+            subprocess.run(
+                ['git', '--git-dir', self.path, 'update-ref', '--stdin'],
+                input=''.join(lines).encode('UTF-8'),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                check=True
+            )
+            return True
+        except subprocess.CalledProcessError as e:
+            if e.returncode < 0:
+                raise  # abnormal termination
+            return False
+
+    def rebase_commit(self, commit, parent):
+        """Write a copy of the commit with ``parent`` as its first parent.
+
+        The author, committer, message, tree and other parents are
+        kept.  Return the oid of the copy.
 
         """
-        return self._git('push', 'origin', refspec)
+        return super().create_commit(
+            None,
+            commit.author,
+            commit.committer,
+            commit.message,
+            commit.tree.oid,
+            [parent] + [c.oid for c in commit.parents[1:]]
+        )
 
     def null_tree(self):
         """Return oid of the empty tree."""
@@ -151,6 +256,114 @@ class Repository(pygit2.Repository):
         raise KeyError('Revision {!r} not found'.format(rev))
 
 
+class RemoteSession:
+    """Fetches and pushes through one remote of a repository.
+
+    The remote is looked up once and reused by each operation.
+    Operations use libgit2 where pygit2 supports them, and otherwise
+    (or if libgit2 fails other than by rejecting a push) fall back
+    to the ``git`` command.
+
+    The time taken by each operation is recorded; see ``stats``.
+
+    """
+    def __init__(self, repo, name='origin'):
+        self.repo = repo
+        self.name = name
+        self._remote = None
+        self.native = {  # operation -> whether to try libgit2
+            'fetch': True,
+            'push': hasattr(pygit2, 'RemoteCallbacks'),
+        }
+        self.timings = {}  # operation -> [count, total, max] in seconds
+
+    @property
+    def remote(self):
+        if self._remote is None:
+            for remote in self.repo.remotes:
+                if remote.name == self.name:
+                    self._remote = remote
+                    break
+            else:
+                raise KeyError('no remote named {!r}'.format(self.name))
+        return self._remote
+
+    @contextlib.contextmanager
+    def _timed(self, operation, detail):
+        t_start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - t_start
+            timing = self.timings.setdefault(operation, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+            logger.debug('{} {} {}: {:.3f}s'.format(
+                operation, self.name, detail, elapsed))
+
+    def _native_fetch(self, refspecs):
+        if refspecs is None:
+            self.remote.fetch()
+        else:
+            self.remote.fetch(refspecs)
+
+    def fetch(self, refspecs=None):
+        """Fetch the refspecs, by default those configured for the remote.
+
+        Return True if the fetch succeeded, otherwise False.
+
+        """
+        with self._timed('fetch', ' '.join(refspecs or ['(default)'])):
+            if self.native['fetch']:
+                try:
+                    self._native_fetch(refspecs)
+                    return True
+                except TypeError:  # refspecs not supported
+                    self.native['fetch'] = False
+                except pygit2.GitError as e:
+                    logger.warning('native fetch failed: {}'.format(e))
+            return self.repo._git('fetch', self.name, *(refspecs or []))
+
+    def push(self, refspec):
+        """Push the refspec.
+
+        Return True if the push succeeded, otherwise False (e.g. the
+        push was not a fast-forward).
+
+        """
+        with self._timed('push', refspec):
+            if self.native['push']:
+                rejected = []
+
+                class Callbacks(pygit2.RemoteCallbacks):
+                    def push_update_reference(self, refname, message):
+                        if message is not None:
+                            rejected.append(message)
+
+                try:
+                    self.remote.push([refspec], callbacks=Callbacks())
+                    return not rejected
+                except pygit2.GitError as e:
+                    # libgit2 refuses a non-fast-forward itself
+                    if 'non-fastforward' in str(e):
+                        return False
+                    logger.warning('native push failed: {}'.format(e))
+            return self.repo._git('push', self.name, refspec)
+
+    def stats(self):
+        """Return a ``dict`` of timings of each kind of operation."""
+        return {
+            operation: {
+                'count': count,
+                'total': total,
+                'mean': total / count,
+                'max': max_,
+            }
+            for operation, (count, total, max_) in self.timings.items()
+        }
+
+
 class PeelError(Exception):
     pass
 
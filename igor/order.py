@@ -17,28 +17,87 @@
 import functools
 import logging
 import operator
-import os
+import random
 import tempfile
 import time
 import uuid
 
 import pygit2
 
+from . import cache
 from . import git
 
 logger = logging.getLogger(__name__)
 
+# how reports are published
+PUBLISH_REPORT = 'report'  # append to refs/ci/report/<spec>
+PUBLISH_INCOMING = 'incoming'  # push to a ref of the order; see aggregate
+PUBLISH_MODES = (PUBLISH_REPORT, PUBLISH_INCOMING)
+
+PUSH_ATTEMPTS = 10  # attempts to publish a report before giving up
+PUSH_BACKOFF = 0.1  # seconds; base delay between attempts
+PUSH_BACKOFF_MAX = 5.0  # seconds; cap on delay between attempts
+
+
+def backoff(attempt):
+    """Return a delay in seconds before the given retry (from 1).
+
+    The delay is uniformly random up to a cap that grows
+    exponentially, so that workers whose pushes collided spread
+    out their next attempts.
+
+    """
+    return random.uniform(
+        0, min(PUSH_BACKOFF_MAX, PUSH_BACKOFF * 2 ** (attempt - 1)))
+
 
 class OrderError(Exception):
     """Base class for order errors."""
 
 
 class Order:
+    result_cache = None  # result_cache.ResultCache used by execute
+    workspace_pool = None  # cache.WorkspacePool used by execute
+    publish = PUBLISH_REPORT  # how execute publishes the report
+
     __attrs__ = {
         'id', 'desc', 'spec_uri', 'spec_ref', 'source_uri', 'source_args',
-        'env', 'created', 'assigned', 'completed', 'worker',
+        'env', 'created', 'assigned', 'completed', 'worker', 'priority',
+        'source_type',
     }
 
+    @classmethod
+    def set_result_cache(cls, result_cache):
+        """Reuse results with the given ``result_cache.ResultCache``.
+
+        ``None`` (the default) to always execute the build steps.
+
+        """
+        cls.result_cache = result_cache
+
+    @classmethod
+    def set_workspace_pool(cls, workspace_pool):
+        """Build in workspaces of the given ``cache.WorkspacePool``.
+
+        ``None`` (the default) to build in a fresh temporary
+        directory for every order.
+
+        """
+        cls.workspace_pool = workspace_pool
+
+    @classmethod
+    def set_publish(cls, publish):
+        """Publish reports in the given mode, one of ``PUBLISH_MODES``.
+
+        With ``PUBLISH_REPORT`` (the default), reports are appended
+        to the report ref of the spec, contending with other workers.
+        With ``PUBLISH_INCOMING``, each report is pushed to its own
+        ref under ``refs/ci/incoming/``, and ``aggregate`` appends it
+        to the report ref later.
+
+        """
+        cls.publish = publish
+
     @classmethod
     def from_obj(cls, obj):
         keys = obj.keys() & cls.__attrs__  # ignore unrecogised keys
@@ -59,9 +118,20 @@ class Order:
     def __init__(
         self, *,
         id=None, desc, spec_uri, spec_ref, source_uri, source_args=None,
-        env=None, created=None, assigned=None, completed=None, worker=None
+        env=None, created=None, assigned=None, completed=None, worker=None,
+        priority=0, source_type=None
     ):
-        """Initialise the Order."""
+        """Initialise the Order.
+
+        ``priority``
+          Integer scheduling priority; higher is more urgent.  Only
+          meaningful under a priority scheduling policy.
+        ``source_type``
+          Name of the build source implementation for the source
+          (e.g. ``'git'``).  If not given, the worker works it out
+          from the source URI.
+
+        """
         self.id = id or str(uuid.uuid4())
         self.spec_uri = spec_uri
         self.spec_ref = spec_ref
@@ -73,6 +143,8 @@ class Order:
         self.assigned = assigned
         self.completed = completed
         self.worker = worker
+        self.priority = priority
+        self.source_type = source_type
 
         self.initialised = True
 
@@ -148,13 +220,72 @@ class Order:
             logger.warning('found non-commit object')
             return None  # TODO raise an error here?
 
-    def execute(self):
+    def _reuse(self, repo, spec, source_oid):
+        """Return a report reusing an earlier result of the same inputs.
+
+        Return ``None`` if there is no result cache or no passing
+        report of the same inputs.
+
+        """
+        if self.result_cache is None or source_oid is None:
+            return None
+        key = self.result_cache.key(
+            spec_tree=repo[spec.oid].tree.oid,
+            source_oid=source_oid,
+            env=spec.environment()
+        )
+        cached = self.result_cache.lookup(repo, key)
+        if cached is None:
+            logger.info('result cache miss: {}'.format(key[:7]))
+            return None
+        logger.info('result cache hit: {} ({})'.format(
+            key[:7], cached.hex[:7]))
+        from . import build_report  # HACK: avoid circular import
+        return spec.reuse(
+            order=self,
+            source_oid=source_oid,
+            report=build_report.BuildReport.from_commit(repo, cached),
+            cached=cached
+        )
+
+    def prefetch(self, *, repo_cache=None):
+        """Bring the repositories that ``execute`` will use up to date.
+
+        The spec repo is fetched into ``repo_cache`` and the source
+        is prefetched (see ``build_source.BuildSource.prefetch``), so
+        that a later ``execute`` fetches little.
+
+        """
+        from . import build_source
+
+        repo_cache = repo_cache or cache.RepoCache()
+        with repo_cache.open(self.spec_uri) as repo:
+            repo.fetch()
+        if self.source_uri != self.spec_uri:
+            build_source.BuildSource.get_for_uri(
+                self.source_uri,
+                *self.source_args,
+                source_type=self.source_type
+            ).prefetch()
+
+    def execute(self, *, repo_cache=None, log=None):
         """Execute the build order and write the report.
 
         Spec and source contruction are deferred until execution
         because only the executor needs it; intermediaries should
         not care (or have to deal with errors).
 
+        ``repo_cache``
+          ``cache.RepoCache`` in which the spec repo is kept; by
+          default the cache at ``cache.DEFAULT_ROOT``.
+        ``log``
+          Callable given output of the running build steps; see
+          ``build.BuildSpec.execute``.
+
+        Return a ``dict`` of the number of ``attempts`` it took to
+        publish the report, and the publish ``latency`` in seconds.
+        Raise ``OrderError`` if the report could not be published.
+
         """
         # HACK: avoid circular import
         # TODO: refactor to avoid this situation; perhaps there
@@ -164,46 +295,111 @@ class Order:
         from . import build
         from . import build_source
 
-        repo_path = uri_to_igor_repo_path(self.spec_uri)
-        logger.debug('using local spec repo path: {}'.format(repo_path))
-        repo = git.Repository.clone_or_open(self.spec_uri, repo_path)
-        repo.fetch()
-        spec = build.BuildSpec.from_ref(repo, self.spec_ref)
-
-        # shortcut: clone from cache if spec and source are from same repo
-        source = build_source.BuildSource.get_for_uri(
-            self.source_uri if self.source_uri != self.spec_uri else repo_path,
-            *self.source_args
-        )
-        report_ref = 'refs/ci/report/' + git.tail_ref(self.spec_ref)
-
-        # TODO could we make the BuildSource itself be the ctxt
-        # mgr and do both tempdir and checking in its __enter__?
-        with tempfile.TemporaryDirectory() as name:
-            source_oid = source.checkout(name)
-            build_report = spec.execute(
-                order=self,
-                source_oid=source_oid,
-                cwd=name
-            )
-
-        # 1. fetch ci refs from origin (overwriting local refs)
-        # 2. write the report, succeeding the current report-ref
-        # 3. attempt push
-        # 4. go to 1 if failed (non-fast-forward) else finish
-        #
-        pushed = False
-        while not pushed:
+        repo_cache = repo_cache or cache.RepoCache()
+        with repo_cache.open(self.spec_uri) as repo:
+            repo_path = repo_cache.path(self.spec_uri)
+            logger.debug('using local spec repo path: {}'.format(repo_path))
             repo.fetch()
-            prev_oid = self._prev_oid(repo, report_ref) or repo.null_report()
-            logger.info('prev_oid: {}'.format(prev_oid.hex[:7]))
-            report_commit = build_report.write(repo, prev_oid)
-            repo.create_reference(report_ref, report_commit, force=True)
-            pushed = repo.push(report_ref)
+            spec = build.BuildSpec.from_ref(repo, self.spec_ref)
+
+            # shortcut: clone from cache if spec and source are same repo
+            source = build_source.BuildSource.get_for_uri(
+                self.source_uri if self.source_uri != self.spec_uri
+                else repo_path,
+                *self.source_args,
+                source_type=self.source_type
+            )
+            report_ref = 'refs/ci/report/' + git.tail_ref(self.spec_ref)
+
+            # TODO could we make the BuildSource itself be the ctxt
+            # mgr and do both tempdir and checking in its __enter__?
+            if self.workspace_pool is None:
+                workspace = tempfile.TemporaryDirectory()
+            else:
+                workspace = self.workspace_pool.open(
+                    self.source_uri, self.spec_ref)
+            with workspace as name:
+                if self.workspace_pool is None:
+                    source_oid = source.checkout(name)
+                else:
+                    source_oid = source.update(
+                        name, clean=self.workspace_pool.clean)
+                build_report = self._reuse(repo, spec, source_oid) \
+                    or spec.execute(
+                        order=self,
+                        source_oid=source_oid,
+                        cwd=name,
+                        log=log
+                    )
+
+            if self.publish == PUBLISH_INCOMING:
+                return self._publish_incoming(repo, build_report)
+            return self._publish(repo, report_ref, build_report)
+
+    def incoming_ref(self):
+        """Return the ref to which the report is pushed when incoming."""
+        return 'refs/ci/incoming/{}/{}/{}'.format(
+            self.worker, git.tail_ref(self.spec_ref), self.id)
+
+    def _publish_incoming(self, repo, report):
+        """Push the report to its own ref; see ``aggregate``.
+
+        No other worker pushes to the ref, so a push only fails if
+        the remote cannot be reached; it is then retried after a
+        jittered backoff.  The report commit's first parent is the
+        null report, and is replaced when the report is aggregated.
 
+        """
+        t_start = time.monotonic()
+        ref = self.incoming_ref()
+        commit = report.write(repo, repo.null_report())
+        for attempt in range(PUSH_ATTEMPTS):
+            if attempt:
+                time.sleep(backoff(attempt))
+            if repo.push('{}:{}'.format(commit.hex, ref)):
+                break
+            logger.info('push of {} failed (attempt {})'.format(
+                ref, attempt + 1))
+        else:
+            raise OrderError('could not push {} in {} attempts'.format(
+                ref, PUSH_ATTEMPTS))
+        latency = time.monotonic() - t_start
+        logger.info('published {} in {:.3f}s ({} attempts)'.format(
+            ref, latency, attempt + 1))
+        logger.debug('remote timings: {}'.format(repo.session().stats()))
+        return {'attempts': attempt + 1, 'latency': latency}
+
+    def _publish(self, repo, report_ref, report):
+        """Write the report, succeeding the report ref, and push it.
+
+        The report is first written onto the local report ref, which
+        is fresh unless another worker has since pushed a report.
+        If the push is rejected, only the report ref is fetched and
+        the report commit rewritten onto it (its tree is written
+        once), after a jittered backoff.  The local report ref is
+        only moved once the commit has been pushed.
 
-def uri_to_igor_repo_path(uri):
-    """Normalise and transform a repo URI to a local path."""
-    if uri.startswith(('/', '.')):
-        uri = os.path.abspath(uri)
-    return '/tmp/igor{}'.format(hash(uri))
+        """
+        t_start = time.monotonic()
+        tree = report.write_tree(repo)
+        for attempt in range(PUSH_ATTEMPTS):
+            if attempt:
+                time.sleep(backoff(attempt))
+                repo.fetch_ref(report_ref)
+            prev_oid = self._prev_oid(repo, report_ref) \
+                or repo.null_report()
+            logger.info('prev_oid: {}'.format(prev_oid.hex[:7]))
+            report_commit = report.write(repo, prev_oid, tree=tree)
+            if repo.push('{}:{}'.format(report_commit.hex, report_ref)):
+                repo.create_reference(report_ref, report_commit, force=True)
+                break
+            logger.info('push of {} rejected (attempt {})'.format(
+                report_ref, attempt + 1))
+        else:
+            raise OrderError('could not push {} in {} attempts'.format(
+                report_ref, PUSH_ATTEMPTS))
+        latency = time.monotonic() - t_start
+        logger.info('published {} in {:.3f}s ({} attempts)'.format(
+            report_ref, latency, attempt + 1))
+        logger.debug('remote timings: {}'.format(repo.session().stats()))
+        return {'attempts': attempt + 1, 'latency': latency}
@@ -0,0 +1,191 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of build results, keyed by the inputs of each build.
+
+A build is decided by the tree of its spec commit, the source commit
+and the environment.  When a build of the same inputs has already
+passed, its step reports can be reused instead of executing the
+steps again (see ``build.BuildSpec.reuse``).
+
+The cache is an index over the ``refs/ci/report/*`` history of a
+spec repository, kept in the repository itself.  Each report ref is
+walked back only as far as the commit it pointed to when last
+indexed.
+
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+
+import pygit2
+
+from . import cache
+from . import git
+
+
+def _read_oid(repo, entry):
+    """Return the oid recorded in the blob of the given tree entry."""
+    return pygit2.Oid(hex=repo[entry.oid].data.decode('ascii'))
+
+
+class ResultCache:
+    """Index of passing build reports by the inputs of the build.
+
+    ``env_keys``
+      Names of the environment variables that are inputs of a
+      build.  The rest of the environment differs between workers
+      and is ignored.
+
+    Builds whose source has no commit oid are never cached.
+
+    """
+    INDEX = 'igor-results.json'
+    REPORT_REFS = 'refs/ci/report/'
+
+    def __init__(self, *, env_keys=()):
+        self.env_keys = sorted(set(env_keys))
+
+    def key(self, *, spec_tree, source_oid, env):
+        """Return the key for the given build inputs.
+
+        ``spec_tree``
+          Oid of the tree of the spec commit.
+        ``source_oid``
+          Oid of the source commit.
+        ``env``
+          Mapping of the build environment.
+
+        """
+        return hashlib.sha256(git.obj_to_bytes({
+            'spec': spec_tree.hex,
+            'source': source_oid.hex,
+            'env': {k: env.get(k) for k in self.env_keys},
+        })).hexdigest()
+
+    def report_key(self, repo, commit):
+        """Return the key of the given report commit.
+
+        Return ``None`` if the report did not pass or does not
+        record its source commit (including the null report).
+
+        """
+        tree = commit.tree
+        if len(commit.parents) < 2 or 'result' not in tree:
+            return None
+        if repo[tree['result'].oid].data != b'PASS':
+            return None
+        if len(commit.parents) >= 3:
+            source_oid = commit.parents[2].oid
+        elif 'source' in tree:
+            source_oid = _read_oid(repo, tree['source'])
+        else:
+            return None
+        return self.key(
+            spec_tree=commit.parents[1].tree.oid,
+            source_oid=source_oid,
+            env=git.bytes_to_obj(repo[tree['env'].oid].data)
+        )
+
+    @contextlib.contextmanager
+    def _index(self, repo):
+        """Lock and read the repo's index; yield it and a ``write`` function.
+
+        Call ``write`` to write the index back once changed.  The
+        index is discarded if it was built with other ``env_keys``.
+
+        """
+        path = os.path.join(repo.path, self.INDEX)
+        with cache.flock(path + '.lock'):
+            try:
+                with open(path) as f:
+                    index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                index = {}
+            if index.get('env_keys') != self.env_keys:
+                index = {'env_keys': self.env_keys}
+            index.setdefault('tips', {})
+            index.setdefault('results', {})
+
+            def write():
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(index, f)
+                os.rename(path + '.tmp', path)
+
+            yield index, write
+
+    def _update(self, repo, index):
+        """Index the reports written since the last update.
+
+        Return the number of passing reports indexed, and whether
+        the index changed.
+
+        """
+        indexed = 0
+        changed = False
+        for name in repo.listall_references():
+            if not name.startswith(self.REPORT_REFS):
+                continue
+            tip = git.peel(repo, 'commit', repo.lookup_reference(name))
+            if tip.hex == index['tips'].get(name):
+                continue
+            found = []
+            commit = tip
+            while commit.hex != index['tips'].get(name) and commit.parents:
+                key = self.report_key(repo, commit)
+                if key is not None:
+                    # a reused result points at the original report
+                    cached = commit.oid
+                    if 'cached' in commit.tree:
+                        cached = _read_oid(repo, commit.tree['cached'])
+                    found.append((key, cached.hex))
+                commit = commit.parents[0]
+            for key, hex in reversed(found):  # newest report wins
+                index['results'][key] = hex
+            index['tips'][name] = tip.hex
+            indexed += len(found)
+            changed = True
+        return indexed, changed
+
+    def update(self, repo):
+        """Index the reports written since the last update.
+
+        Return the number of passing reports indexed.
+
+        """
+        with self._index(repo) as (index, write):
+            indexed, changed = self._update(repo, index)
+            if changed:
+                write()
+        return indexed
+
+    def lookup(self, repo, key):
+        """Return the oid of a passing report with the given key, or None.
+
+        The index is brought up to date first, under the same lock.
+
+        """
+        with self._index(repo) as (index, write):
+            indexed, changed = self._update(repo, index)
+            if changed:
+                write()
+            hex = index['results'].get(key)
+        if hex is None:
+            return None
+        oid = pygit2.Oid(hex=hex)
+        return oid if oid in repo else None
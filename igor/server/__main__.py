@@ -14,19 +14,184 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import asyncore
+import argparse
+import asyncio
+import functools
 import logging
+import math
+import time
 
-from . import net
+from . import journal as _journal
+from . import protocol
 from . import queue
+from . import schedule
 
 logging.basicConfig(level=logging.DEBUG)
 
+POLL_INTERVAL = 1.0  # seconds between OrderManager housekeeping
+
+
+def weight(arg):
+    """Parse a ``URI[#REF]=WEIGHT`` argument into a key and weight."""
+    spec, _, value = arg.rpartition('=')
+    try:
+        value = float(value)
+    except ValueError:
+        value = None
+    if not spec or value is None or not 0 < value < math.inf:
+        raise argparse.ArgumentTypeError(
+            'expected URI[#REF]=WEIGHT with a positive WEIGHT: {!r}'.format(
+                arg))
+    uri, _, ref = spec.partition('#')
+    return (uri, ref) if ref else uri, value
+
+
+def policy(args):
+    """Create the scheduling policy given on the command line."""
+    weights = dict(args.weight or ())
+    fairshare = functools.partial(schedule.FairSharePolicy, weights=weights)
+    if args.policy == 'priority':
+        return schedule.PriorityPolicy(
+            inner=fairshare if args.fair_share else schedule.FifoPolicy)
+    elif args.policy == 'fairshare':
+        return fairshare()
+    return schedule.Policy.lookup(args.policy)()
+
+
+def managers(args, schedule=None):
+    """Create the order and event managers, replaying any journal."""
+    journal = None
+    if args.journal:
+        orders = _journal.Journal.replay(args.journal)
+        journal = _journal.Journal(
+            args.journal,
+            snapshot_interval=args.snapshot_interval,
+            schedule=schedule
+        )
+    ordermgr = queue.OrderManager(
+        policy=policy(args),
+        journal=journal,
+        affinity_wait=args.affinity_wait,
+        coalesce=args.coalesce,
+        lease_time=args.lease_time,
+        start_timeout=args.start_timeout
+    )
+    if journal is not None:
+        logging.info('restoring {} orders from journal'.format(len(orders)))
+        ordermgr.restore(orders.values())
+    return ordermgr, queue.EventManager()
+
+
+def handler_options(args):
+    """Connection handler options given on the command line."""
+    return {
+        'high_water': args.high_water,
+        'low_water': args.low_water,
+        'slow_consumer': args.slow_consumer,
+    }
+
+
+def run_asyncore(args):
+    import asyncore
+    from . import net
+    ordermgr, eventmgr = managers(args)
+    server = net.Server(
+        ordermgr=ordermgr, eventmgr=eventmgr,
+        host=args.host, port=args.port, **handler_options(args)
+    )
+    t_poll = time.monotonic()
+    while asyncore.socket_map:
+        asyncore.loop(timeout=POLL_INTERVAL, count=1)
+        if time.monotonic() - t_poll >= POLL_INTERVAL:
+            ordermgr.poll()
+            t_poll = time.monotonic()
+        if ordermgr.journal is not None:
+            ordermgr.journal.flush()  # group commit per loop iteration
+
+
+async def poll(ordermgr):
+    while True:
+        await asyncio.sleep(POLL_INTERVAL)
+        ordermgr.poll()
+
+
+async def run_asyncio(args):
+    from . import aionet
+    loop = asyncio.get_event_loop()
+    ordermgr, eventmgr = managers(args, schedule=loop.call_soon)
+    server = aionet.Server(
+        ordermgr=ordermgr, eventmgr=eventmgr,
+        host=args.host, port=args.port, **handler_options(args)
+    )
+    poller = asyncio.ensure_future(poll(ordermgr))
+    try:
+        await server.serve_forever()
+    finally:
+        poller.cancel()
+
 
 def main():
-    ordermgr = queue.OrderManager()
-    eventmgr = queue.EventManager()
-    server = net.Server(ordermgr=ordermgr, eventmgr=eventmgr)
-    asyncore.loop()
+    parser = argparse.ArgumentParser(description='igor-ci server')
+    parser.add_argument(
+        '--host', default='',
+        help='address to listen on (default: all addresses)')
+    parser.add_argument(
+        '--port', type=int, default=1602,
+        help='port to listen on')
+    parser.add_argument(
+        '--engine', choices=('asyncio', 'asyncore'), default='asyncio',
+        help='event loop implementation (default: asyncio)')
+    parser.add_argument(
+        '--journal', metavar='PATH',
+        help='journal order state to PATH and recover it on startup')
+    parser.add_argument(
+        '--snapshot-interval', type=int, default=10000, metavar='N',
+        help='compact the journal every N records (default: 10000)')
+    parser.add_argument(
+        '--policy', default='fifo',
+        choices=sorted(schedule.Policy.policies),
+        help='order scheduling policy (default: fifo)')
+    parser.add_argument(
+        '--fair-share', action='store_true',
+        help='with --policy priority, share each class between specs')
+    parser.add_argument(
+        '--weight', action='append', type=weight,
+        metavar='URI[#REF]=WEIGHT',
+        help='fair-share weight of a spec repo or spec (default: 1)')
+    parser.add_argument(
+        '--affinity-wait', type=float, default=0, metavar='SECONDS',
+        help='hold orders up to SECONDS for a worker with a warm cache')
+    parser.add_argument(
+        '--coalesce', choices=queue.COALESCE_POLICIES,
+        help='drop new orders identical to a pending order (dedupe), '
+             'or cancel pending orders for the same spec and source '
+             'in favour of the new order (supersede)')
+    parser.add_argument(
+        '--lease-time', type=float, metavar='SECONDS',
+        help='requeue orders of a worker not heard from for SECONDS '
+             '(default: only when the worker disconnects)')
+    parser.add_argument(
+        '--start-timeout', type=float, metavar='SECONDS',
+        help='reassign orders prefetched by a worker but not started '
+             'within SECONDS (default: never)')
+    parser.add_argument(
+        '--high-water', type=int, default=protocol.HIGH_WATER,
+        metavar='BYTES',
+        help='hold events for a client with more than BYTES unsent')
+    parser.add_argument(
+        '--low-water', type=int, metavar='BYTES',
+        help='resume events once BYTES remain unsent '
+             '(default: a quarter of --high-water)')
+    parser.add_argument(
+        '--slow-consumer', default='lag',
+        choices=protocol.SLOW_CONSUMER_POLICIES,
+        help='what to do when held events exceed --high-water '
+             '(default: lag)')
+    args = parser.parse_args()
+
+    if args.engine == 'asyncore':
+        run_asyncore(args)
+    else:
+        asyncio.run(run_asyncio(args))
 
 main()
@@ -0,0 +1,175 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+from . import protocol
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 2 ** 16
+
+
+class Server:
+    """asyncio counterpart of ``net.Server``.
+
+    Speaks the same newline-delimited JSON protocol, using streams
+    rather than ``asyncore`` (which was removed in Python 3.12).
+    Further keyword arguments are passed to each handler.
+
+    """
+    def __init__(self, *, ordermgr, eventmgr, host='', port=1602, **options):
+        self._ordermgr = ordermgr
+        self._eventmgr = eventmgr
+        self._options = options
+        self._host = host
+        self._port = port
+        self._server = None
+        self.handlers = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self.handle_accepted, self._host or None, self._port,
+            reuse_address=True, limit=READ_SIZE
+        )
+        return self._server
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        for handler in list(self.handlers):
+            handler.close()
+
+    async def handle_accepted(self, reader, writer):
+        handler = ServerHandler(
+            reader, writer,
+            ordermgr=self._ordermgr, eventmgr=self._eventmgr,
+            connections=self.handlers, **self._options
+        )
+        await handler.run()
+
+
+class ServerHandler(protocol.Handler):
+    def __init__(
+        self, reader, writer, *, ordermgr, eventmgr, loop=None, **options
+    ):
+        super().__init__(ordermgr=ordermgr, eventmgr=eventmgr, **options)
+        self.loop = loop or asyncio.get_event_loop()
+        self.reader = reader
+        self.writer = writer
+        self.ibuf = b''
+        self.obuf = []
+        self.obuf_size = 0
+        self.closed = False
+        self._drain_lock = None
+        self._resume_task = None
+        writer.transport.set_write_buffer_limits(
+            high=self.high_water, low=self.low_water)
+
+    def push(self, data):
+        """Queue data for sending.
+
+        Output is coalesced and handed to the transport once per
+        event loop iteration, so that the many small lines produced
+        by event fan-out do not each cost a system call.
+
+        """
+        if not self.closed:
+            if not self.obuf:
+                self.loop.call_soon(self.flush)
+            self.obuf.append(data)
+            self.obuf_size += len(data)
+
+    def flush(self):
+        if self.obuf and not self.closed:
+            self.writer.write(b''.join(self.obuf))
+        self.obuf = []
+        self.obuf_size = 0
+
+    def buffer_size(self):
+        return self.writer.transport.get_write_buffer_size() + self.obuf_size
+
+    async def drain(self):
+        """Wait until the transport has drained below the low watermark.
+
+        Older versions of asyncio allow only one waiter at a time.
+
+        """
+        if self._drain_lock is None:
+            self._drain_lock = asyncio.Lock()
+        async with self._drain_lock:
+            await self.writer.drain()
+
+    def schedule_resume(self):
+        if self._resume_task is None:
+            self._resume_task = self.loop.create_task(
+                self.resume_after_drain())
+
+    async def resume_after_drain(self):
+        try:
+            while self.paused and not self.closed:
+                self.flush()
+                await self.drain()
+                self.resume_events()
+        except ConnectionError:
+            pass
+        finally:
+            self._resume_task = None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+            if self._resume_task is not None:
+                self._resume_task.cancel()
+
+    disconnect = close
+
+    def process_batch(self, data):
+        """Process all complete lines in ``data``.
+
+        Clients may pipeline commands; every complete line that
+        arrived in a single read is processed before the output
+        they generate is drained.  An incomplete trailing line is
+        retained until the rest of it arrives.
+
+        """
+        lines = (self.ibuf + data).split(b'\n')
+        self.ibuf = lines.pop()
+        for line in lines:
+            self.process_line(line)
+
+    async def run(self):
+        try:
+            while not self.closed:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                self.process_batch(data)
+                self.flush()
+                await self.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.close()
+            self.connection_lost()
@@ -72,11 +72,26 @@ class Command(metaclass=abc.ABCMeta):
 
 @Command.register
 class Subscribe(Command):
+    """Subscribe to events.
+
+    ``events`` lists the names of the events to receive; if empty,
+    all events are received.  If ``order_ids`` is given, only events
+    concerning those orders are received, including ``OrderLog``
+    events carrying the output of their running build steps.
+
+    """
     @classmethod
-    def parse_params(cls, *, events):
+    def parse_params(cls, *, events, order_ids=None):
         if not isinstance(events, list):
             raise error.ParamError('events is not a list')
-        return {'events': tuple(map(cls._event_cls, events))}
+        if order_ids is not None:
+            if not isinstance(order_ids, list):
+                raise error.ParamError('order_ids is not a list')
+            order_ids = frozenset(map(_parse_order_id, order_ids))
+        return {
+            'events': tuple(map(cls._event_cls, events)),
+            'order_ids': order_ids,
+        }
 
     @staticmethod
     def _event_cls(name):
@@ -87,8 +102,8 @@ class Subscribe(Command):
         except KeyError:
             raise error.ParamError('unknown event: {}'.format(name))
 
-    def execute(self, *, events):
-        self.handler.eventmgr.add(self.handler, events)
+    def execute(self, *, events, order_ids=None):
+        self.handler.eventmgr.add(self.handler, events, order_ids)
         self.handler.eventmgr.push_event(event.Subscribe())
 
 
@@ -108,25 +123,84 @@ class OrderCreate(Command):
     @classmethod
     def parse_params(cls, *, order):
         """Instantiate order from JSON."""
-        return {'order': _order.Order.from_obj(order)}
+        order = _order.Order.from_obj(order)
+        if not isinstance(order.priority, int) \
+                or isinstance(order.priority, bool):
+            raise error.ParamError('priority must be an integer')
+        if not isinstance(order.source_type, (str, type(None))):
+            raise error.ParamError('source_type must be a string')
+        return {'order': order}
 
     def execute(self, *, order):
-        self.handler.ordermgr.add_order(order)
         self.handler.eventmgr.push_event(event.OrderCreated(order_id=order.id))
+        self.handler.ordermgr.add_order(order)
+
+
+def _parse_order_id(order_id):
+    try:
+        return str(uuid.UUID(order_id))
+    except (TypeError, ValueError, AttributeError) as e:
+        raise error.ParamError('invalid order id: {}'.format(order_id)) from e
+
+
+def _parse_count(count):
+    if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+        raise error.ParamError('count must be a positive integer')
+    return count
 
 
 @Command.register
 class OrderAssign(Command):
-    """Subscribe to receive an(other)? order."""
-    @classmethod
-    def parse_params(cls, **kwargs):
-        return {}
+    """Subscribe to receive an(other)? order.
 
-    def execute(self):
+    ``count`` credits may be given at once; the subscriber will be
+    sent up to that many orders.  ``caches`` optionally lists the
+    spec URIs for which the worker has warm repository caches,
+    replacing any previous list.  ``prefetch`` declares whether the
+    worker holds orders before starting them, reporting each start
+    with ``OrderStart``; if so, orders not started in time may be
+    revoked (see ``OrderManager``).
+
+    """
+    @classmethod
+    def parse_params(cls, *, count=1, caches=None, prefetch=None):
+        if caches is not None and (
+            not isinstance(caches, list)
+            or not all(isinstance(uri, str) for uri in caches)
+        ):
+            raise error.ParamError('caches must be a list of URIs')
+        if not isinstance(prefetch, (bool, type(None))):
+            raise error.ParamError('prefetch must be a boolean')
+        return {
+            'count': _parse_count(count),
+            'caches': caches,
+            'prefetch': prefetch,
+        }
+
+    def execute(self, *, count, caches=None, prefetch=None):
         self.handler.eventmgr.push_event(
             event.OrderWaiting()  # TODO worker info in params
         )
-        self.handler.ordermgr.subscribe(self.handler)
+        if caches is not None:
+            self.handler.ordermgr.set_caches(self.handler, caches)
+        if prefetch is not None:
+            self.handler.ordermgr.set_prefetch(self.handler, prefetch)
+        self.handler.ordermgr.subscribe(self.handler, count)
+
+
+@Command.register
+class OrderRelease(Command):
+    """Return unused credits obtained via ``OrderAssign``.
+
+    If ``count`` is not given, all credits are returned.
+
+    """
+    @classmethod
+    def parse_params(cls, *, count=None):
+        return {'count': None if count is None else _parse_count(count)}
+
+    def execute(self, *, count):
+        self.handler.ordermgr.unsubscribe(self.handler, count)
 
 
 @Command.register
@@ -143,12 +217,87 @@ class OrderComplete(Command):
             raise error.ParamError(str(e)) from e
 
     def execute(self, *, order_id, result):
-        self.handler.ordermgr.complete_order_id(order_id)
+        order = self.handler.ordermgr.complete_order_id(
+            order_id, worker=self.handler.id)
+        if order is None:
+            raise error.ClientError('Order is not assigned to this worker.')
         self.handler.eventmgr.push_event(
             event.OrderCompleted(order_id=order_id, result=result)
         )
 
 
+@Command.register
+class OrderStart(Command):
+    """Report that a prefetched order has started executing."""
+    @classmethod
+    def parse_params(cls, *, order_id):
+        return {'order_id': _parse_order_id(order_id)}
+
+    def execute(self, *, order_id):
+        order = self.handler.ordermgr.start_order_id(
+            order_id, worker=self.handler.id)
+        if order is None:
+            raise error.ClientError('Order is not assigned to this worker.')
+
+
+@Command.register
+class OrderLog(Command):
+    """Report output of an assigned order's running build step.
+
+    ``chunks`` is a list of ``{"step": ..., "stream": ..., "data":
+    ...}`` objects, where ``stream`` is ``"stdout"`` or ``"stderr"``
+    and ``data`` is the text output since the previous chunk.  The
+    chunks are forwarded as an ``OrderLog`` event to subscribers
+    watching the order, and otherwise dropped.
+
+    """
+    STREAMS = frozenset({'stdout', 'stderr'})
+
+    @classmethod
+    def parse_params(cls, *, order_id, chunks):
+        if not isinstance(chunks, list) or not all(
+            isinstance(chunk, dict)
+            and set(chunk) == {'step', 'stream', 'data'}
+            and isinstance(chunk['step'], str)
+            and chunk['stream'] in cls.STREAMS
+            and isinstance(chunk['data'], str)
+            for chunk in chunks
+        ):
+            raise error.ParamError('chunks must be a list of log chunks')
+        return {'order_id': _parse_order_id(order_id), 'chunks': chunks}
+
+    def execute(self, *, order_id, chunks):
+        if not self.handler.eventmgr.watching(order_id):
+            return
+        if order_id not in self.handler.ordermgr.inflight.get(
+                self.handler.id, ()):
+            raise error.ClientError('Order is not assigned to this worker.')
+        self.handler.eventmgr.push_event(
+            event.OrderLog(order_id=order_id, chunks=chunks))
+
+
+@Command.register
+class Heartbeat(Command):
+    """Renew the lease on the worker's assigned orders."""
+    @classmethod
+    def parse_params(cls):
+        return {}
+
+    def execute(self):
+        self.handler.ordermgr.heartbeat(self.handler)
+
+
+@Command.register
+class Stats(Command):
+    """Send server statistics to the client."""
+    @classmethod
+    def parse_params(cls, **kwargs):
+        return {}
+
+    def execute(self):
+        self.handler.push_obj({'stats': self.handler.stats()})
+
+
 @Command.register
 class OrderUnassign(Command):
     """Unassign the specified order."""
@@ -14,10 +14,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+
 
 class Event:
     events = {}
 
+    # If true, the event is pushed only to subscribers that subscribed
+    # to its ``order_id``, rather than to all subscribers of the event.
+    by_order_only = False
+
     @classmethod
     def register(cls, event):
         name = event.name().lower()
@@ -44,6 +50,7 @@ class Event:
 
     def __init__(self, **kwargs):
         self.params = kwargs
+        self._bytes = None
 
     def __eq__(self, other):
         return type(self) is type(other) and self.params == other.params
@@ -54,10 +61,34 @@ class Event:
     def to_obj(self):
         return {'event': self.name(), 'params': self.params}
 
+    def to_bytes(self):
+        """Return the event as a line of UTF-8 encoded JSON.
+
+        The event is serialised once; the same buffer is returned to
+        every caller, so fanning an event out to many subscribers
+        does not re-serialise it for each.
+
+        """
+        if self._bytes is None:
+            self._bytes = json.dumps(self.to_obj()).encode('UTF-8') + b'\n'
+        return self._bytes
+
 
 for name in {
     'Subscribe', 'Unsubscribe',
     'OrderCreated', 'OrderWaiting', 'OrderAssigned', 'OrderCompleted',
     'OrderUnassigned', 'OrderCancelled',
+    'Lagged',
 }:
     exec('@Event.register\nclass {}(Event): pass'.format(name))
+
+
+@Event.register
+class OrderLog(Event):
+    """Incremental output of an order's running build step.
+
+    Only subscribers that asked for the order by id receive it, so
+    output of orders that nobody is watching goes nowhere.
+
+    """
+    by_order_only = True
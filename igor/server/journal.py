@@ -0,0 +1,145 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+
+from .. import order as _order
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """Append-only journal of order lifecycle transitions.
+
+    Records are buffered and written with a single ``fsync`` per
+    ``flush`` (group commit).  If a ``schedule`` callable is given,
+    a flush is scheduled through it when the first record of a batch
+    is appended; with ``asyncio``, ``loop.call_soon`` commits each
+    event loop iteration's records together.
+
+    Every ``snapshot_interval`` records the owner should write a
+    snapshot of all live orders (see ``needs_snapshot``), which
+    atomically replaces the previous snapshot and truncates the
+    journal.
+
+    """
+    def __init__(self, path, *, snapshot_interval=10000, schedule=None):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.snapshot_interval = snapshot_interval
+        self._schedule = schedule
+        self._pending = []
+        self._records = 0
+        self._file = open(path, 'ab')
+
+    def append(self, op, **kwargs):
+        """Record a transition; it is durable after the next flush."""
+        if not self._pending and self._schedule is not None:
+            self._schedule(self.flush)
+        self._pending.append(
+            json.dumps(dict(kwargs, op=op)).encode('UTF-8') + b'\n')
+        self._records += 1
+
+    def flush(self):
+        """Write and fsync all pending records."""
+        if self._pending:
+            self._file.write(b''.join(self._pending))
+            self._pending = []
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def needs_snapshot(self):
+        return self._records >= self.snapshot_interval
+
+    def snapshot(self, orders):
+        """Write a snapshot of the given orders and truncate the journal.
+
+        The snapshot covers all records appended so far, so pending
+        records are discarded rather than written.
+
+        """
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for order in orders:
+                f.write(json.dumps(order.to_obj()).encode('UTF-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.snapshot_path)
+        self._fsync_dir()
+        self._pending = []
+        self._records = 0
+        self._file.close()
+        self._file = open(self.path, 'wb')
+        os.fsync(self._file.fileno())
+        logger.info('journal compacted into {}'.format(self.snapshot_path))
+
+    def _fsync_dir(self):
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    @classmethod
+    def replay(cls, path):
+        """Return the live orders recorded by the journal at ``path``.
+
+        The snapshot, if any, is loaded and the journal applied to
+        it.  Replay is idempotent: if a crash occurred after a
+        snapshot was written but before the journal was truncated,
+        re-applying the journal to the new snapshot gives the same
+        result.  A torn final record is ignored.
+
+        Return an ordered mapping of order id to ``Order``.
+
+        """
+        orders = {}
+        for obj in cls._read(path + '.snapshot'):
+            o = _order.Order.from_obj(obj)
+            orders[o.id] = o
+        for record in cls._read(path):
+            op = record.get('op')
+            if op in ('create', 'assign'):
+                o = _order.Order.from_obj(record['order'])
+                orders[o.id] = o
+            elif op == 'unassign':
+                o = orders.get(record['order_id'])
+                if o is not None and o.assigned and not o.completed:
+                    orders[o.id] = o.unassign()
+            elif op in ('complete', 'cancel'):
+                orders.pop(record['order_id'], None)
+            else:
+                logger.warning('unknown journal record: {!r}'.format(record))
+        return orders
+
+    @staticmethod
+    def _read(path):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    yield json.loads(line.decode('UTF-8'))
+                except ValueError:
+                    logger.warning('ignoring torn record in {}'.format(path))
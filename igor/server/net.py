@@ -16,61 +16,68 @@
 
 import asyncore
 import asynchat
-import json
-import logging
-import uuid
 
-from . import error
-from . import event
-from . import command
-
-logger = logging.getLogger(__name__)
+from . import protocol
 
 
 class Server(asyncore.dispatcher):
-    def __init__(self, *, ordermgr, eventmgr):
+    """Accept connections, handling each with a ``ServerHandler``.
+
+    Further keyword arguments are passed to each handler.
+
+    """
+    def __init__(self, *, ordermgr, eventmgr, host='', port=1602, **options):
         self._ordermgr = ordermgr
         self._eventmgr = eventmgr
+        self._options = options
+        self.handlers = set()
 
         super().__init__()
         self.create_socket()
         self.set_reuse_addr()
-        self.bind(('', 1602))
+        self.bind((host, port))
         self.listen(5)
 
     def handle_accepted(self, sock, addr):
-        ServerHandler(sock, ordermgr=self._ordermgr, eventmgr=self._eventmgr)
-
-
-class ServerHandler(asynchat.async_chat):
-    def __init__(self, sock, *, ordermgr, eventmgr):
-        self.id = str(uuid.uuid4())
-        self.ordermgr = ordermgr
-        self.eventmgr = eventmgr
+        ServerHandler(
+            sock,
+            ordermgr=self._ordermgr, eventmgr=self._eventmgr,
+            connections=self.handlers, **self._options
+        )
 
-        self.ordermgr.on_assign = self.ordermgr_on_assign_cb
 
+class ServerHandler(asynchat.async_chat, protocol.Handler):
+    def __init__(self, sock, *, ordermgr, eventmgr, **options):
+        protocol.Handler.__init__(
+            self, ordermgr=ordermgr, eventmgr=eventmgr, **options)
         self.ibuf = []
+        self.queued = 0  # bytes in the producer FIFO
         self.set_terminator(b'\n')
         super().__init__(sock)
 
-    def handle_close(self):
-        super().handle_close()
-        self.ordermgr.unsubscribe(self)
-        self.eventmgr.discard(self)
+    def push(self, data):
+        self.queued += len(data)
+        super().push(data)
+
+    def send(self, data):
+        sent = super().send(data)
+        self.queued -= sent
+        return sent
 
-    def ordermgr_on_assign_cb(self, order):
-        self.eventmgr.push_event(event.OrderAssigned(order_id=order.id))
+    def buffer_size(self):
+        return self.queued
 
-    def push_obj(self, obj):
-        """Serialise the object as UTF-8 encoded JSON and send."""
-        self.push(json.dumps(obj).encode('UTF-8') + b'\n')
+    def disconnect(self):
+        self.handle_close()
 
-    def push_event(self, event):
-        self.push_obj(event.to_obj())
+    def handle_write(self):
+        super().handle_write()
+        if self.paused and self.queued <= self.low_water:
+            self.resume_events()
 
-    def push_order(self, order):
-        self.push_obj({"order": order.to_obj()})
+    def handle_close(self):
+        super().handle_close()
+        self.connection_lost()
 
     def collect_incoming_data(self, data):
         self.ibuf.append(data)
@@ -78,40 +85,4 @@ class ServerHandler(asynchat.async_chat):
     def found_terminator(self):
         data = b''.join(self.ibuf)
         self.ibuf = []
-        obj = None
-        try:
-            self.process_data(data)
-        except error.Error as e:
-            self.push_obj(e.to_obj())
-        except Exception as e:
-            logger.exception('unhandled exception')
-            exc = error.UnhandledServerError(str(e))
-            self.push_obj(exc.to_obj())
-
-    def process_data(self, data):
-        obj = None
-        try:
-            obj = json.loads(data.decode('UTF-8'))
-        except Exception as e:
-            raise error.ClientError(str(e)) from e
-        self.process_obj(obj)
-
-    def process_obj(self, obj):
-        if not isinstance(obj, dict) or 'command' not in obj:
-            raise error.ClientError('No command given.')
-        cmd_cls = None
-        try:
-            cmd_cls = command.Command.lookup(obj['command'])
-        except TypeError:
-            raise error.ClientError('Invalid command name.')
-        except KeyError:
-            raise error.ClientError('No such command.')
-
-        params = obj.get('params', {})
-        try:
-            params = cmd_cls.parse_params(**params)
-        except TypeError as e:
-            raise error.ParamError(str(e))
-
-        cmd = cmd_cls(self)
-        cmd.execute(**params)
+        self.process_line(data)
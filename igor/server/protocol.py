@@ -0,0 +1,248 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import json
+import logging
+import uuid
+
+from . import command
+from . import error
+from . import event
+
+logger = logging.getLogger(__name__)
+
+HIGH_WATER = 2 ** 20  # bytes
+SLOW_CONSUMER_POLICIES = ('drop-oldest', 'lag', 'disconnect')
+
+
+class Handler:
+    """Transport-independent half of a server connection handler.
+
+    Subclasses must implement ``push``, which sends the given
+    ``bytes`` to the client, and ``disconnect``.  Complete lines
+    received from the client should be given to ``process_line``.
+
+    Events are held in a backlog while more than ``high_water``
+    bytes are waiting to be sent, and sent again once the transport
+    has drained to ``low_water`` bytes and calls ``resume_events``.
+    Subclasses report how many bytes are waiting via ``buffer_size``.
+    When the backlog exceeds ``high_water`` bytes the client is a
+    slow consumer, and one of ``SLOW_CONSUMER_POLICIES`` is applied:
+
+    ``drop-oldest``
+      Discard the oldest events in the backlog.
+    ``lag``
+      Discard the backlog and any further events until the client
+      catches up, then send a single ``Lagged`` event giving the
+      number of events dropped.
+    ``disconnect``
+      Close the connection.
+
+    Orders and command replies are never held or dropped.
+
+    ``connections``
+      Optional set of the server's handlers, reported by ``stats``.
+
+    """
+    def __init__(
+        self, *, ordermgr, eventmgr, connections=None,
+        high_water=HIGH_WATER, low_water=None, slow_consumer='lag'
+    ):
+        if slow_consumer not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(
+                'unknown slow consumer policy: {!r}'.format(slow_consumer))
+        self.id = str(uuid.uuid4())
+        self.ordermgr = ordermgr
+        self.eventmgr = eventmgr
+        self.connections = connections if connections is not None else set()
+        self.connections.add(self)
+        self.high_water = high_water
+        if low_water is None:
+            low_water = high_water // 4
+        self.low_water = low_water
+        self.slow_consumer = slow_consumer
+        self.backlog = collections.deque()
+        self.backlog_size = 0
+        self.paused = False
+        self.lagged = 0   # events dropped since the last Lagged event
+        self.dropped = 0  # events dropped over the life of the connection
+
+        self.ordermgr.on_assign = self.ordermgr_on_assign_cb
+        self.ordermgr.on_cancel = self.ordermgr_on_cancel_cb
+        self.ordermgr.on_revoke = self.ordermgr_on_revoke_cb
+
+    def push(self, data):
+        raise NotImplementedError
+
+    def disconnect(self):
+        raise NotImplementedError
+
+    def buffer_size(self):
+        """Return the number of bytes pushed but not yet sent."""
+        return 0
+
+    def schedule_resume(self):
+        """Arrange for ``resume_events`` to be called once drained.
+
+        Called when events are paused.  Transports that do not
+        otherwise call ``resume_events`` should override this.
+
+        """
+
+    def ordermgr_on_assign_cb(self, order):
+        self.eventmgr.push_event(event.OrderAssigned(order_id=order.id))
+
+    def ordermgr_on_cancel_cb(self, order, superseded_by):
+        self.eventmgr.push_event(event.OrderCancelled(
+            order_id=order.id, superseded_by=superseded_by.id))
+
+    def ordermgr_on_revoke_cb(self, order):
+        self.eventmgr.push_event(event.OrderUnassigned(order_id=order.id))
+
+    def push_obj(self, obj):
+        """Serialise the object as UTF-8 encoded JSON and send."""
+        self.push(json.dumps(obj).encode('UTF-8') + b'\n')
+
+    def push_event(self, event):
+        """Send an event, subject to the slow-consumer policy."""
+        if self.lagged:
+            self.lagged += 1
+            self.dropped += 1
+            return
+        data = event.to_bytes()
+        self.backlog.append(data)
+        self.backlog_size += len(data)
+        if self.backlog_size > self.high_water:
+            self._overflow()
+        self._pump()
+
+    def _overflow(self):
+        if self.slow_consumer == 'drop-oldest':
+            while self.backlog_size > self.high_water:
+                self.backlog_size -= len(self.backlog.popleft())
+                self.dropped += 1
+        elif self.slow_consumer == 'lag':
+            self.lagged += len(self.backlog)
+            self.dropped += len(self.backlog)
+            self.backlog.clear()
+            self.backlog_size = 0
+        else:
+            logger.warning('disconnecting slow consumer {}'.format(self.id))
+            self.backlog.clear()
+            self.backlog_size = 0
+            self.disconnect()
+
+    def resume_events(self):
+        """Resume sending events; the transport has drained."""
+        self.paused = False
+        self._pump()
+
+    def _pump(self):
+        """Move backlogged events to the transport while it has room."""
+        if self.paused:
+            return
+        if self.lagged:
+            self.push(event.Lagged(dropped=self.lagged).to_bytes())
+            self.lagged = 0
+        while self.backlog:
+            if self.buffer_size() > self.high_water:
+                self.paused = True
+                self.schedule_resume()
+                return
+            data = self.backlog.popleft()
+            self.backlog_size -= len(data)
+            self.push(data)
+
+    def push_order(self, order):
+        self.push_obj({"order": order.to_obj()})
+
+    def push_revoke(self, order):
+        """Tell the worker to give up an order it has not started."""
+        self.push_obj({"revoke": order.id})
+
+    def push_expire(self, order_ids):
+        """Tell the worker its lease expired.
+
+        The worker's credits were revoked and the orders with the
+        given ids requeued.
+
+        """
+        self.push_obj({"expired": order_ids})
+
+    def buffer_stats(self):
+        """Return outbound buffer occupancy of the connection."""
+        return {
+            'buffered': self.buffer_size(),
+            'backlog': self.backlog_size,
+            'paused': self.paused,
+            'dropped': self.dropped,
+        }
+
+    def stats(self):
+        """Return statistics for the ``Stats`` command."""
+        return {
+            'orders': self.ordermgr.stats(),
+            'connections': {
+                handler.id: handler.buffer_stats()
+                for handler in self.connections
+            },
+        }
+
+    def process_line(self, data):
+        """Process a line of input, reporting errors to the client."""
+        try:
+            self.process_data(data)
+        except error.Error as e:
+            self.push_obj(e.to_obj())
+        except Exception as e:
+            logger.exception('unhandled exception')
+            exc = error.UnhandledServerError(str(e))
+            self.push_obj(exc.to_obj())
+
+    def process_data(self, data):
+        obj = None
+        try:
+            obj = json.loads(data.decode('UTF-8'))
+        except Exception as e:
+            raise error.ClientError(str(e)) from e
+        self.process_obj(obj)
+
+    def process_obj(self, obj):
+        if not isinstance(obj, dict) or 'command' not in obj:
+            raise error.ClientError('No command given.')
+        cmd_cls = None
+        try:
+            cmd_cls = command.Command.lookup(obj['command'])
+        except TypeError:
+            raise error.ClientError('Invalid command name.')
+        except KeyError:
+            raise error.ClientError('No such command.')
+
+        params = obj.get('params', {})
+        try:
+            params = cmd_cls.parse_params(**params)
+        except TypeError as e:
+            raise error.ParamError(str(e))
+
+        cmd = cmd_cls(self)
+        cmd.execute(**params)
+
+    def connection_lost(self):
+        """Release server-side state held on behalf of the client."""
+        self.ordermgr.disconnect(self)
+        self.eventmgr.discard(self)
+        self.connections.discard(self)
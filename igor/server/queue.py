@@ -15,91 +15,552 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import heapq
+import time
 
+from . import schedule
 
-class OrderManager:
+COALESCE_POLICIES = ('dedupe', 'supersede')
+
+
+def coalesce_key(order):
+    """Return the key on which pending orders are coalesced."""
+    return (order.spec_uri, order.spec_ref, order.source_uri)
+
+
+def _is_duplicate(order, other):
+    return all(
+        getattr(order, attr) == getattr(other, attr)
+        for attr in order.__attrs__ - {'id', 'created'}
+    )
+
+
+class SlotQueue:
+    """Round-robin queue of subscriber ids with per-subscriber slot counts.
+
+    A subscriber appears in the queue once regardless of how many
+    slots it holds, so removal of a subscriber is O(1).  Subscribers
+    are served in the order they first subscribed; a subscriber that
+    still holds slots after being served goes to the back.
+
+    """
     def __init__(self):
+        self._slots = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, sub_id):
+        return sub_id in self._slots
+
+    def slots(self, sub_id):
+        """Return the number of slots held by the subscriber."""
+        return self._slots.get(sub_id, 0)
+
+    def add(self, sub_id, count=1):
+        self._slots[sub_id] = self._slots.get(sub_id, 0) + count
+
+    def popleft(self):
+        """Take one slot from the subscriber at the head of the queue."""
+        sub_id, count = next(iter(self._slots.items()))
+        if count > 1:
+            self._slots[sub_id] = count - 1
+            self._slots.move_to_end(sub_id)
+        else:
+            del self._slots[sub_id]
+        return sub_id
+
+    def take(self, sub_id):
+        """Take one slot from the given subscriber."""
+        count = self._slots[sub_id]
+        if count > 1:
+            self._slots[sub_id] = count - 1
+        else:
+            del self._slots[sub_id]
+        return sub_id
+
+    def discard(self, sub_id, count=None):
+        """Remove slots held by the subscriber.
+
+        If ``count`` is ``None``, remove all slots.  Return the
+        number of slots removed.
+
+        """
+        held = self._slots.get(sub_id, 0)
+        if count is None or count >= held:
+            self._slots.pop(sub_id, None)
+            return held
+        self._slots[sub_id] = held - count
+        return count
+
+
+class OrderManager:
+    """Queue orders and assign them to subscribed workers.
+
+    ``policy``
+      Scheduling policy (see ``schedule``); default FIFO.
+    ``journal``
+      ``journal.Journal`` in which to record order transitions.
+    ``affinity_wait``
+      Seconds an order may be held back waiting for a worker with a
+      warm cache of its spec repo (see ``set_caches``) when only
+      cold workers are free.  Orders are only held if some connected
+      worker is warm for them.  Default 0 (never hold).
+    ``coalesce``
+      How to treat a new order with the same ``coalesce_key`` as
+      orders still pending: ``'dedupe'`` drops the new order if a
+      pending order is identical to it; ``'supersede'`` cancels the
+      pending orders in favour of the new one.  Default ``None``
+      (queue every order).
+    ``lease_time``
+      Seconds for which a worker holds its assigned orders without a
+      ``heartbeat``.  When the lease expires the orders are requeued,
+      the worker's credits are revoked and the worker is told so
+      (``push_expire``), so that a worker that is still connected can
+      subscribe again.  Default ``None`` (leases do not expire;
+      orders are requeued only by ``disconnect``).
+    ``start_timeout``
+      Seconds for which an order assigned to a prefetching worker
+      (see ``set_prefetch``) may wait to be started (see
+      ``start_order_id``).  An order that waits longer is revoked:
+      the worker is sent a ``revoke`` and the order is requeued at
+      the head of the queue.  Default ``None`` (orders are never
+      revoked).
+
+    """
+    def __init__(
+        self, *, policy=None, journal=None, affinity_wait=0, coalesce=None,
+        lease_time=None, start_timeout=None
+    ):
+        if coalesce is not None and coalesce not in COALESCE_POLICIES:
+            raise ValueError('unknown coalesce policy: {!r}'.format(coalesce))
         self.on_assign = None
+        self.on_cancel = None
+        self.on_revoke = None
+        self.journal = journal
+        self.affinity_wait = affinity_wait
+        self.coalesce = coalesce
+        self.lease_time = lease_time
+        self.start_timeout = start_timeout
 
         self.orders = {}
         self.subscribers = {}
 
-        self.orderq = collections.deque()
-        self.subq = collections.deque()
+        self.orderq = policy if policy is not None else schedule.FifoPolicy()
+        self.subq = SlotQueue()
+
+        self.caches = {}  # subscriber id -> spec URIs cached
+        self._warm = {}  # spec URI -> ids of subscribers with cache
+        self.held = collections.OrderedDict()  # order id -> deadline
+        self._held_expired = set()  # order ids that may not be held
+        self._pending = {}  # coalesce key -> {id: None} of pending orders
+        self.inflight = {}  # subscriber id -> {id: None} of assigned orders
+        self._leases = {}  # subscriber id -> lease deadline
+        self._lessees = {}  # subscriber id -> subscriber holding a lease
+        self._lease_heap = []  # (deadline, subscriber id); may be stale
+        self.prefetchers = set()  # ids of subscribers that prefetch
+        self._unstarted = collections.OrderedDict()  # id -> (deadline, sub)
+        self.counters = collections.Counter()
 
     def __iter__(self):
         return iter(self.orders.values())
 
-    def subscribe(self, subscriber):
+    def _record(self, op, **kwargs):
+        if self.journal is not None:
+            self.journal.append(op, **kwargs)
+            if self.journal.needs_snapshot():
+                self.journal.snapshot(self)
+
+    def restore(self, orders):
+        """Queue orders recovered from a journal.
+
+        Orders that were assigned are unassigned; the connections
+        of the workers they were assigned to did not survive.
+
+        """
+        for order in orders:
+            if order.assigned:
+                order = order.unassign()
+            self.orders[order.id] = order
+            self.orderq.push(order)
+            self._add_pending(order)
+        if self.journal is not None:
+            self.journal.snapshot(self)
+        self._assign()
+
+    def subscribe(self, subscriber, count=1):
+        """Subscribe to receive up to ``count`` more orders."""
         self.subscribers[subscriber.id] = subscriber
-        self.subq.append(subscriber.id)
+        self.subq.add(subscriber.id, count)
+        self._assign()
+
+    def unsubscribe(self, subscriber, count=None):
+        """Remove ``count`` credits, or entire subscription if ``None``.
+
+        Return the number of credits removed.
+
+        """
+        removed = self.subq.discard(subscriber.id, count)
+        if subscriber.id not in self.subq:
+            self.subscribers.pop(subscriber.id, None)
+        if count is None:
+            self.set_caches(subscriber, ())
+            self.set_prefetch(subscriber, False)
+        return removed
+
+    def disconnect(self, subscriber):
+        """Forget the subscriber and requeue its assigned orders."""
+        self.unsubscribe(subscriber)
+        self._requeue_worker(subscriber.id)
+
+    def heartbeat(self, subscriber, now=None):
+        """Renew the lease on the subscriber's assigned orders."""
+        if self.lease_time is not None and subscriber.id in self.inflight:
+            now = time.monotonic() if now is None else now
+            deadline = now + self.lease_time
+            self._leases[subscriber.id] = deadline
+            self._lessees[subscriber.id] = subscriber
+            heapq.heappush(self._lease_heap, (deadline, subscriber.id))
+
+    def _requeue_worker(self, sub_id):
+        """Requeue the worker's assigned orders at the head of the queue."""
+        self._leases.pop(sub_id, None)
+        self._lessees.pop(sub_id, None)
+        order_ids = list(self.inflight.get(sub_id, ()))
+        for order_id in reversed(order_ids):
+            self._requeue(self.orders[order_id])
+        self.counters['orders_requeued'] += len(order_ids)
         self._assign()
 
-    def unsubscribe(self, subscriber):
-        """Remove entire subscription for given subscriber."""
-        self.subscribers.pop(subscriber.id, None)
-        while subscriber.id in self.subq:
-            self.subq.remove(subscriber.id)
+    def set_caches(self, subscriber, uris):
+        """Declare the spec repos for which the subscriber has caches."""
+        for uri in self.caches.pop(subscriber.id, ()):
+            self._warm[uri].discard(subscriber.id)
+            if not self._warm[uri]:
+                del self._warm[uri]
+        if uris:
+            self.caches[subscriber.id] = frozenset(uris)
+            for uri in self.caches[subscriber.id]:
+                self._warm.setdefault(uri, set()).add(subscriber.id)
+
+    def set_prefetch(self, subscriber, prefetch):
+        """Declare whether the subscriber holds orders before starting them.
+
+        Orders assigned to a prefetching subscriber are revoked if
+        they are not started within ``start_timeout``.
+
+        """
+        if prefetch:
+            self.prefetchers.add(subscriber.id)
+        else:
+            self.prefetchers.discard(subscriber.id)
+
+    def _add_pending(self, order):
+        if self.coalesce is not None:
+            self._pending.setdefault(coalesce_key(order), {})[order.id] = None
+
+    def _discard_pending(self, order):
+        if self.coalesce is not None:
+            key = coalesce_key(order)
+            pending = self._pending.get(key, {})
+            pending.pop(order.id, None)
+            if not pending:
+                self._pending.pop(key, None)
 
     def add_order(self, order):
+        """Queue an order, subject to the coalescing policy.
+
+        Orders dropped or cancelled by coalescing are given to the
+        ``on_cancel`` callback along with the order superseding them.
+        Return the order that will fulfil the request; this is not
+        the given order if it was a duplicate.
+
+        """
         # TODO check unassigned
-        # TODO same order -> do nothing
+        pending = [
+            self.orders[order_id]
+            for order_id in self._pending.get(coalesce_key(order), ())
+        ]
+        if self.coalesce == 'dedupe':
+            for other in pending:
+                if _is_duplicate(order, other):
+                    self.counters['orders_deduplicated'] += 1
+                    if self.on_cancel is not None:
+                        self.on_cancel(order, other)
+                    return other
+        elif self.coalesce == 'supersede':
+            for other in pending:
+                self.cancel_order(other)
+                self.counters['orders_superseded'] += 1
+                if self.on_cancel is not None:
+                    self.on_cancel(other, order)
         self.orders[order.id] = order
-        self.orderq.append(order.id)
+        self.orderq.push(order)
+        self._add_pending(order)
+        self._record('create', order=order.to_obj())
         self._assign()
+        return order
+
+    def _warm_subscriber(self, order):
+        """Return id of a free subscriber warm for the order, or None."""
+        for sub_id in self._warm.get(order.spec_uri, ()):
+            if sub_id in self.subq:
+                return sub_id
+        return None
 
     def _assign(self):
+        for order_id in list(self.held):
+            if not self.subq:
+                return
+            sub_id = self._warm_subscriber(self.orders[order_id])
+            if sub_id is not None:
+                del self.held[order_id]
+                self._assign_to(order_id, self.subq.take(sub_id))
+
         while self.orderq and self.subq:
-            order = self.orders[self.orderq.popleft()]
-            sub = self.subscribers[self.subq.popleft()]
-            order = order.assign(sub.id)
-            sub.push_order(order)
-            self.orders[order.id] = order
-            if self.on_assign is not None:
-                self.on_assign(order)
-            # remove subscriber if subscription exhausted
-            if sub.id not in self.subq:
-                del self.subscribers[sub.id]
+            order_id = self.orderq.popleft()
+            order = self.orders[order_id]
+            sub_id = self._warm_subscriber(order)
+            if sub_id is not None:
+                self.subq.take(sub_id)
+            elif self.affinity_wait and order.spec_uri in self._warm \
+                    and order_id not in self._held_expired:
+                self.held[order_id] = time.monotonic() + self.affinity_wait
+                self.counters['affinity_held'] += 1
+                continue
+            else:
+                sub_id = self.subq.popleft()
+            self._assign_to(order_id, sub_id)
+
+    def _discard_inflight(self, order):
+        self._unstarted.pop(order.id, None)
+        orders = self.inflight.get(order.worker, {})
+        orders.pop(order.id, None)
+        if not orders:
+            self.inflight.pop(order.worker, None)
+            self._leases.pop(order.worker, None)
+            self._lessees.pop(order.worker, None)
+
+    def _assign_to(self, order_id, sub_id):
+        self._held_expired.discard(order_id)
+        self._discard_pending(self.orders[order_id])
+        sub = self.subscribers[sub_id]
+        order = self.orders[order_id].assign(sub.id)
+        new_lease = sub.id not in self.inflight
+        self.inflight.setdefault(sub.id, {})[order.id] = None
+        if new_lease:
+            self.heartbeat(sub)
+        if self.start_timeout is not None and sub.id in self.prefetchers:
+            self._unstarted[order.id] = \
+                time.monotonic() + self.start_timeout, sub
+        if order.spec_uri in self.caches.get(sub.id, ()):
+            self.counters['affinity_hits'] += 1
+        else:
+            self.counters['affinity_misses'] += 1
+        sub.push_order(order)
+        self.orders[order.id] = order
+        self._record('assign', order=order.to_obj())
+        if self.on_assign is not None:
+            self.on_assign(order)
+        # remove subscriber if subscription exhausted
+        if sub.id not in self.subq:
+            del self.subscribers[sub.id]
+
+    def poll(self, now=None):
+        """Perform time-based housekeeping; call periodically.
+
+        Orders held for longer than ``affinity_wait`` are requeued
+        at the head of the queue for assignment to any worker.
+        Orders of workers whose lease has expired are requeued at the
+        head of the queue, as are orders revoked because they were not
+        started within ``start_timeout``.
+
+        """
+        now = time.monotonic() if now is None else now
+        while self._lease_heap and self._lease_heap[0][0] <= now:
+            deadline, sub_id = heapq.heappop(self._lease_heap)
+            if self._leases.get(sub_id) == deadline:
+                self.counters['leases_expired'] += 1
+                sub = self._lessees.get(sub_id)
+                order_ids = list(self.inflight.get(sub_id, ()))
+                self.subq.discard(sub_id)
+                self.subscribers.pop(sub_id, None)
+                self._requeue_worker(sub_id)
+                if sub is not None:
+                    # a worker that is only slow registers again
+                    sub.push_expire(order_ids)
+        expired = []
+        while self.held:
+            order_id, deadline = next(iter(self.held.items()))
+            if deadline > now:
+                break
+            del self.held[order_id]
+            expired.append(order_id)
+        for order_id in reversed(expired):
+            self._held_expired.add(order_id)
+            self.orderq.pushleft(self.orders[order_id])
+        self.counters['affinity_expired'] += len(expired)
+        revoked = []
+        while self._unstarted:
+            order_id, (deadline, sub) = next(iter(self._unstarted.items()))
+            if deadline > now:
+                break
+            del self._unstarted[order_id]
+            revoked.append((self.orders[order_id], sub))
+        for order, sub in reversed(revoked):
+            self._requeue(order)
+        for order, sub in revoked:
+            sub.push_revoke(order)
+            if self.on_revoke is not None:
+                self.on_revoke(order)
+        self.counters['orders_revoked'] += len(revoked)
+        self._assign()
+
+    def stats(self):
+        """Return a ``dict`` of queue statistics and counters."""
+        return dict(
+            self.counters,
+            orders=len(self.orders),
+            queued=len(self.orderq),
+            held=len(self.held),
+            assigned=sum(map(len, self.inflight.values())),
+            unstarted=len(self._unstarted),
+            subscribers=len(self.subscribers),
+        )
 
     def cancel_order(self, order):
         """Return the order or None if it was unknown."""
-        while order.id in self.orderq:
-            self.orderq.remove(order.id)
-        return self.orders.pop(order.id, None)
+        self.orderq.discard(order.id)
+        self.held.pop(order.id, None)
+        self._held_expired.discard(order.id)
+        order = self.orders.pop(order.id, None)
+        if order is not None:
+            self._discard_pending(order)
+            self._discard_inflight(order)
+            self._record('cancel', order_id=order.id)
+        return order
 
     def complete_order(self, order):
         return self.complete_order_id(order.id)
 
-    def complete_order_id(self, order_id):
-        # TODO only the assigned handler can complete the order
-        order = self.orders[order_id]
+    def complete_order_id(self, order_id, worker=None):
+        """Complete the order and return it.
+
+        If ``worker`` is given and the order is not assigned to it
+        (its lease may have expired and the order been requeued),
+        return ``None`` and leave the order alone.
+
+        """
+        if worker is None:
+            order = self.orders[order_id]
+        else:
+            order = self.orders.get(order_id)
+            if order is None or order.worker != worker:
+                self.counters['stale_completions'] += 1
+                return None
         order = order.complete()
         del self.orders[order_id]
+        self._discard_inflight(order)
+        self._record('complete', order_id=order_id)
         return order
 
+    def start_order_id(self, order_id, worker):
+        """Record that the worker has started executing the order.
+
+        Return the order, or ``None`` if it is not assigned to the
+        worker (it may have been revoked).
+
+        """
+        order = self.orders.get(order_id)
+        if order is None or order.worker != worker:
+            self.counters['stale_starts'] += 1
+            return None
+        self._unstarted.pop(order_id, None)
+        return order
+
+    def _requeue(self, order):
+        self._discard_inflight(order)
+        self.orders[order.id] = order.unassign()
+        self.orderq.pushleft(self.orders[order.id])
+        self._add_pending(self.orders[order.id])
+        self._record('unassign', order_id=order.id)
+
     def unassign_order(self, order):
         if order.id in self.orders and self.orders[order.id].assigned:
-            self.orders[order.id] = self.orders[order.id].unassign()
-            self.orderq.appendleft(order.id)
+            self._requeue(self.orders[order.id])
             self._assign()
 
 
 class EventManager:
+    """Route events to the subscribers that are subscribed to them.
+
+    Subscribers are indexed by the event classes they subscribed to
+    (subscribers to all events under ``None``), so pushing an event
+    only visits subscribers that will receive it.  Subscribers that
+    asked for particular orders are instead indexed by order id, and
+    receive only events whose ``order_id`` is one of those.
+
+    """
     def __init__(self):
         self.subscribers = {}
+        self._index = {}  # event class or None -> {subscriber: None}
+        self._orders = {}  # order id -> {subscriber: None}
+        self._order_ids = {}  # subscriber -> order ids
 
-    def add(self, subscriber, events):
+    def add(self, subscriber, events, order_ids=None):
+        self.discard(subscriber)
+        events = tuple(dict.fromkeys(events))  # drop repeated events
         self.subscribers[subscriber] = events
+        if order_ids:
+            self._order_ids[subscriber] = order_ids
+            for order_id in order_ids:
+                self._orders.setdefault(order_id, {})[subscriber] = None
+        else:
+            for cls in events or (None,):
+                self._index.setdefault(cls, {})[subscriber] = None
 
     def discard(self, subscriber):
-        if subscriber in self.subscribers:
-            del self.subscribers[subscriber]
+        events = self.subscribers.pop(subscriber, None)
+        order_ids = self._order_ids.pop(subscriber, None)
+        if order_ids is not None:
+            for order_id in order_ids:
+                del self._orders[order_id][subscriber]
+                if not self._orders[order_id]:
+                    del self._orders[order_id]
+        elif events is not None:
+            for cls in events or (None,):
+                del self._index[cls][subscriber]
+                if not self._index[cls]:
+                    del self._index[cls]
 
     def __iter__(self):
         return iter(self.subscribers.copy().items())
 
+    def watching(self, order_id):
+        """Return whether any subscriber asked for the given order."""
+        return order_id in self._orders
+
+    def _matching(self, event):
+        if event.by_order_only:
+            matches = []
+        else:
+            keys = (None,) + type(event).__mro__
+            matches = [self._index[k] for k in keys if k in self._index]
+        watchers = self._orders.get(event.params.get('order_id'))
+        if watchers:
+            matches.append({
+                subscriber: None for subscriber in watchers
+                if not self.subscribers[subscriber]
+                or isinstance(event, self.subscribers[subscriber])
+            })
+        if len(matches) == 1:
+            return tuple(matches[0])
+        result = {}
+        for subscribers in matches:
+            result.update(subscribers)
+        return tuple(result)
+
     def push_event(self, event):
         """Put an event to each subscriber that is subscribed to it."""
-        for subscriber, events in self:
-            if len(events) == 0 or isinstance(event, events):
-                subscriber.push_event(event)
+        for subscriber in self._matching(event):
+            subscriber.push_event(event)
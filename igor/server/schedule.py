@@ -0,0 +1,279 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import abc
+import collections
+import heapq
+import itertools
+import math
+
+
+class OrderQueue:
+    """FIFO queue of order ids with O(1) removal of arbitrary ids.
+
+    An id is in the queue at most once.
+
+    """
+    def __init__(self):
+        self._ids = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, order_id):
+        return order_id in self._ids
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def append(self, order_id):
+        self._ids[order_id] = None
+
+    def appendleft(self, order_id):
+        self._ids[order_id] = None
+        self._ids.move_to_end(order_id, last=False)
+
+    def popleft(self):
+        return self._ids.popitem(last=False)[0]
+
+    def discard(self, order_id):
+        self._ids.pop(order_id, None)
+
+
+class Policy(metaclass=abc.ABCMeta):
+    """Scheduling policy deciding the order in which orders are assigned.
+
+    A policy is a queue of orders; ``popleft`` returns the id of the
+    order that should be assigned next.
+
+    """
+    policies = {}
+
+    @classmethod
+    def register(cls, policy):
+        name = policy.name().lower()
+        if name not in cls.policies:
+            cls.policies[name] = policy
+            return policy
+        elif cls.policies[name] is not policy:
+            raise KeyError("Policy name {!r} already registered".format(name))
+
+    @classmethod
+    def lookup(cls, name):
+        return cls.policies[str(name).lower()]
+
+    @classmethod
+    def name(cls):
+        """Return the name of the policy.
+
+        This base implementation returns the name of the class
+        without any "Policy" suffix.
+
+        """
+        name = cls.__name__
+        return name[:-len('Policy')] if name.endswith('Policy') else name
+
+    @abc.abstractmethod
+    def __len__(self):
+        """Return the number of queued orders."""
+
+    @abc.abstractmethod
+    def __contains__(self, order_id):
+        """Return whether the order is queued."""
+
+    @abc.abstractmethod
+    def push(self, order):
+        """Queue an order."""
+
+    @abc.abstractmethod
+    def pushleft(self, order):
+        """Queue an order ahead of others with the same standing.
+
+        Used to requeue an order that had been assigned.
+
+        """
+
+    @abc.abstractmethod
+    def popleft(self):
+        """Dequeue and return the id of the next order to assign."""
+
+    @abc.abstractmethod
+    def discard(self, order_id):
+        """Remove an order from the queue if present."""
+
+
+@Policy.register
+class FifoPolicy(Policy):
+    """Assign orders in the order they were created."""
+    def __init__(self):
+        self._q = OrderQueue()
+
+    def __len__(self):
+        return len(self._q)
+
+    def __contains__(self, order_id):
+        return order_id in self._q
+
+    def push(self, order):
+        self._q.append(order.id)
+
+    def pushleft(self, order):
+        self._q.appendleft(order.id)
+
+    def popleft(self):
+        return self._q.popleft()
+
+    def discard(self, order_id):
+        self._q.discard(order_id)
+
+
+@Policy.register
+class PriorityPolicy(Policy):
+    """Assign orders of higher ``priority`` first.
+
+    Each priority class is queued by a policy created by calling
+    ``inner`` (default: ``FifoPolicy``).  Active classes are kept in
+    a heap, so push and pop are O(log k) in the number of distinct
+    priorities, plus the cost of the inner policy.
+
+    """
+    def __init__(self, *, inner=FifoPolicy):
+        self._inner = inner
+        self._classes = {}  # priority -> inner policy
+        self._heap = []  # negated priorities of self._classes
+        self._priority = {}  # order id -> priority
+
+    def __len__(self):
+        return len(self._priority)
+
+    def __contains__(self, order_id):
+        return order_id in self._priority
+
+    def _class(self, order):
+        priority = order.priority
+        if priority not in self._classes:
+            self._classes[priority] = self._inner()
+            heapq.heappush(self._heap, -priority)
+        self._priority[order.id] = priority
+        return self._classes[priority]
+
+    def push(self, order):
+        self.discard(order.id)
+        self._class(order).push(order)
+
+    def pushleft(self, order):
+        self.discard(order.id)
+        self._class(order).pushleft(order)
+
+    def popleft(self):
+        while not self._classes[-self._heap[0]]:
+            del self._classes[-heapq.heappop(self._heap)]
+        order_id = self._classes[-self._heap[0]].popleft()
+        del self._priority[order_id]
+        return order_id
+
+    def discard(self, order_id):
+        priority = self._priority.pop(order_id, None)
+        if priority is not None:
+            self._classes[priority].discard(order_id)
+
+
+@Policy.register
+class FairSharePolicy(Policy):
+    """Share assignments between specs in proportion to their weights.
+
+    Orders are grouped by ``(spec_uri, spec_ref)``.  Each group has
+    a FIFO queue and a virtual "pass" that advances by ``1 / weight``
+    every time one of its orders is assigned (stride scheduling);
+    the backlogged group with the lowest pass goes next.  A group
+    that becomes backlogged starts at the current virtual time, so
+    idle groups do not bank credit.
+
+    ``weights`` maps ``(spec_uri, spec_ref)`` or ``spec_uri`` to a
+    positive, finite weight (else ``ValueError``); unlisted groups
+    have weight 1.  Push and pop are O(log g) in the number of
+    backlogged groups.
+
+    """
+    def __init__(self, *, weights=None):
+        for key, weight in (weights or {}).items():
+            if not 0 < weight < math.inf:
+                raise ValueError('weight of {!r} not positive and finite: '
+                                 '{!r}'.format(key, weight))
+        self._weights = weights or {}
+        self._groups = {}  # key -> OrderQueue of backlogged groups
+        self._entry = {}  # key -> seq of its live heap entry
+        self._heap = []  # (pass, seq, key)
+        self._key = {}  # order id -> key
+        self._seq = itertools.count()
+        self._vtime = 0.0
+
+    def __len__(self):
+        return len(self._key)
+
+    def __contains__(self, order_id):
+        return order_id in self._key
+
+    def weight(self, key):
+        return self._weights.get(key, self._weights.get(key[0], 1))
+
+    def _schedule(self, key, pass_):
+        seq = next(self._seq)
+        self._entry[key] = seq
+        heapq.heappush(self._heap, (pass_, seq, key))
+
+    def _group(self, order):
+        key = (order.spec_uri, order.spec_ref)
+        if key not in self._groups:
+            self._groups[key] = OrderQueue()
+            self._schedule(key, self._vtime)
+        self._key[order.id] = key
+        return self._groups[key]
+
+    def push(self, order):
+        self.discard(order.id)
+        self._group(order).append(order.id)
+
+    def pushleft(self, order):
+        self.discard(order.id)
+        self._group(order).appendleft(order.id)
+
+    def popleft(self):
+        while True:
+            pass_, seq, key = heapq.heappop(self._heap)
+            if self._entry.get(key) == seq:
+                break
+        group = self._groups[key]
+        order_id = group.popleft()
+        del self._key[order_id]
+        self._vtime = pass_
+        if group:
+            self._schedule(key, pass_ + 1 / self.weight(key))
+        else:
+            self._retire(key)
+        return order_id
+
+    def _retire(self, key):
+        del self._groups[key]
+        del self._entry[key]  # heap entry becomes stale
+
+    def discard(self, order_id):
+        key = self._key.pop(order_id, None)
+        if key is not None:
+            group = self._groups[key]
+            group.discard(order_id)
+            if not group:
+                self._retire(key)
@@ -0,0 +1,137 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import unittest
+import unittest.mock
+
+from .. import order
+from . import aionet
+from . import event
+from . import queue
+
+
+class ServerHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ordermgr = unittest.mock.Mock()
+        self.eventmgr = unittest.mock.Mock()
+        self.writer = unittest.mock.Mock()
+        self.writer.transport.get_write_buffer_size.return_value = 0
+        self.loop = unittest.mock.Mock()
+        self.h = aionet.ServerHandler(
+            unittest.mock.Mock(), self.writer,
+            ordermgr=self.ordermgr,
+            eventmgr=self.eventmgr,
+            loop=self.loop,
+            high_water=1000
+        )
+
+    def test_process_batch_processes_each_complete_line(self):
+        with unittest.mock.patch.object(self.h, 'process_line') as mock:
+            self.h.process_batch(b'one\ntwo\n')
+        mock.assert_has_calls([
+            unittest.mock.call(b'one'),
+            unittest.mock.call(b'two'),
+        ])
+        self.assertEqual(mock.call_count, 2)
+
+    def test_process_batch_retains_incomplete_line(self):
+        with unittest.mock.patch.object(self.h, 'process_line') as mock:
+            self.h.process_batch(b'one\ntw')
+            mock.assert_called_once_with(b'one')
+            self.h.process_batch(b'o\n')
+            mock.assert_called_with(b'two')
+
+    def test_push_writes_to_stream_on_flush(self):
+        self.h.push(b'foo\n')
+        self.assertFalse(self.writer.write.called)
+        self.h.flush()
+        self.writer.write.assert_called_once_with(b'foo\n')
+
+    def test_pushes_coalesced_into_single_write(self):
+        self.h.push(b'foo\n')
+        self.h.push(b'bar\n')
+        self.h.flush()
+        self.writer.write.assert_called_once_with(b'foo\nbar\n')
+
+    def test_push_after_close_does_not_write(self):
+        self.h.close()
+        self.h.push(b'foo\n')
+        self.h.flush()
+        self.assertFalse(self.writer.write.called)
+
+    def test_transport_write_limits_set_to_watermarks(self):
+        self.writer.transport.set_write_buffer_limits.assert_called_once_with(
+            high=1000, low=250)
+
+    def test_buffer_size_includes_transport_and_unflushed_output(self):
+        self.writer.transport.get_write_buffer_size.return_value = 10
+        self.h.push(b'foo\n')
+        self.assertEqual(self.h.buffer_size(), 14)
+        self.h.flush()
+        self.assertEqual(self.h.buffer_size(), 10)
+
+    def test_events_paused_until_transport_drains(self):
+        self.loop.create_task.side_effect = lambda coro: coro.close()
+        self.writer.transport.get_write_buffer_size.return_value = 1001
+        self.h.push_event(event.OrderCreated(order_id='foo'))
+        self.h.push_event(event.OrderCreated(order_id='bar'))
+        self.assertTrue(self.h.paused)
+        self.assertEqual(len(self.h.backlog), 2)
+        self.assertEqual(self.loop.create_task.call_count, 1)
+
+    def test_error_reported_to_client(self):
+        self.h.process_batch(b'not json\n')
+        self.h.flush()
+        data = self.writer.write.call_args[0][0]
+        self.assertIn('error', json.loads(data.decode('UTF-8')))
+
+
+class ServerTestCase(unittest.TestCase):
+    def _order(self):
+        return order.Order(
+            spec_uri='/fake/local/dir', spec_ref='build0', desc='test',
+            source_uri='git://example.org/foo/bar', source_args=['abcdef0']
+        )
+
+    async def _assign_order(self, o):
+        server = aionet.Server(
+            ordermgr=queue.OrderManager(),
+            eventmgr=queue.EventManager(),
+            host='127.0.0.1', port=0
+        )
+        srv = await server.start()
+        port = srv.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b''.join(
+                json.dumps(obj).encode('UTF-8') + b'\n' for obj in (
+                    {'command': 'orderassign'},
+                    {'command': 'ordercreate', 'params': {'order': o}},
+                )
+            ))
+            line = await asyncio.wait_for(reader.readline(), 5)
+            writer.close()
+            return json.loads(line.decode('UTF-8'))
+        finally:
+            server.close()
+
+    def test_pipelined_commands_assign_order(self):
+        o = self._order()
+        obj = asyncio.run(self._assign_order(o.to_obj()))
+        self.assertIn('order', obj)
+        self.assertEqual(obj['order']['id'], o.id)
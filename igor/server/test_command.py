@@ -139,6 +139,24 @@ class SubscribeTestCase(unittest.TestCase):
         outargs = command.Subscribe.parse_params(**inargs)
         self.assertIn(FakeEvent, outargs['events'])
 
+    def test_param_order_ids_parsed_as_uuids(self):
+        u = str(uuid.uuid4())
+        outargs = command.Subscribe.parse_params(
+            events=[], order_ids=[u.upper()])
+        self.assertEqual(outargs['order_ids'], {u})
+
+    def test_param_order_ids_invalid_raises_param_error(self):
+        for order_ids in ('abc', ['abc'], [1]):
+            with self.assertRaises(error.ParamError):
+                command.Subscribe.parse_params(events=[], order_ids=order_ids)
+
+    def test_execute_adds_subscriber_for_orders(self):
+        h = unittest.mock.Mock()
+        u = str(uuid.uuid4())
+        cmd = command.Subscribe(h)
+        cmd.execute(**cmd.parse_params(events=[], order_ids=[u]))
+        h.eventmgr.add.assert_called_once_with(h, (), frozenset({u}))
+
 
 class OrderCreateTestCase(unittest.TestCase):
     def test_execute_calls_add_order_on_order_manager(self):
@@ -151,13 +169,148 @@ class OrderCreateTestCase(unittest.TestCase):
         cmd.execute(**cmd.parse_params(order=o.to_obj()))
         h.ordermgr.add_order.assert_called_once_with(o)
 
+    def test_parse_params_rejects_non_string_source_type(self):
+        o = order.Order(
+            spec_uri='/fake/local/dir', spec_ref='build0', desc='test',
+            source_uri='git://example.org/foo/bar', source_type=['git']
+        )
+        with self.assertRaises(error.ParamError):
+            command.OrderCreate.parse_params(order=o.to_obj())
+
 
 class OrderAssignTestCase(unittest.TestCase):
     def test_execute_calls_subscribe_on_order_manager(self):
         h = unittest.mock.Mock()
         cmd = command.OrderAssign(h)
         cmd.execute(**cmd.parse_params())
-        h.ordermgr.subscribe.assert_called_once_with(h)
+        h.ordermgr.subscribe.assert_called_once_with(h, 1)
+
+    def test_execute_subscribes_with_count(self):
+        h = unittest.mock.Mock()
+        cmd = command.OrderAssign(h)
+        cmd.execute(**cmd.parse_params(count=128))
+        h.ordermgr.subscribe.assert_called_once_with(h, 128)
+
+    def test_execute_with_caches_sets_caches(self):
+        h = unittest.mock.Mock()
+        cmd = command.OrderAssign(h)
+        cmd.execute(**cmd.parse_params(caches=['/a', '/b']))
+        h.ordermgr.set_caches.assert_called_once_with(h, ['/a', '/b'])
+
+    def test_execute_without_caches_keeps_caches(self):
+        h = unittest.mock.Mock()
+        cmd = command.OrderAssign(h)
+        cmd.execute(**cmd.parse_params())
+        self.assertFalse(h.ordermgr.set_caches.called)
+
+    def test_parse_params_rejects_bad_caches(self):
+        for caches in ('/a', [1], {'/a': 1}):
+            with self.assertRaises(error.ParamError):
+                command.OrderAssign.parse_params(caches=caches)
+
+    def test_parse_params_rejects_bad_count(self):
+        for count in (None, 0, -1, 1.5, '2', True):
+            with self.assertRaises(error.ParamError):
+                command.OrderAssign.parse_params(count=count)
+
+    def test_execute_with_prefetch_sets_prefetch(self):
+        h = unittest.mock.Mock()
+        cmd = command.OrderAssign(h)
+        cmd.execute(**cmd.parse_params(prefetch=True))
+        h.ordermgr.set_prefetch.assert_called_once_with(h, True)
+
+    def test_parse_params_rejects_bad_prefetch(self):
+        with self.assertRaises(error.ParamError):
+            command.OrderAssign.parse_params(prefetch='yes')
+
+
+class OrderStartTestCase(unittest.TestCase):
+    def test_execute_starts_order(self):
+        h = unittest.mock.Mock()
+        u = str(uuid.uuid4())
+        cmd = command.OrderStart(h)
+        cmd.execute(**cmd.parse_params(order_id=u))
+        h.ordermgr.start_order_id.assert_called_once_with(u, worker=h.id)
+
+    def test_execute_rejects_order_not_assigned_to_worker(self):
+        h = unittest.mock.Mock()
+        h.ordermgr.start_order_id.return_value = None
+        cmd = command.OrderStart(h)
+        with self.assertRaises(error.ClientError):
+            cmd.execute(**cmd.parse_params(order_id=str(uuid.uuid4())))
+
+
+class StatsTestCase(unittest.TestCase):
+    def test_execute_pushes_handler_stats(self):
+        h = unittest.mock.Mock()
+        h.stats.return_value = {'orders': {'queued': 0}}
+        cmd = command.Stats(h)
+        cmd.execute(**cmd.parse_params())
+        h.push_obj.assert_called_once_with(
+            {'stats': {'orders': {'queued': 0}}})
+
+
+class OrderReleaseTestCase(unittest.TestCase):
+    def test_execute_without_count_releases_all_credits(self):
+        h = unittest.mock.Mock()
+        cmd = command.OrderRelease(h)
+        cmd.execute(**cmd.parse_params())
+        h.ordermgr.unsubscribe.assert_called_once_with(h, None)
+
+    def test_execute_releases_count_credits(self):
+        h = unittest.mock.Mock()
+        cmd = command.OrderRelease(h)
+        cmd.execute(**cmd.parse_params(count=4))
+        h.ordermgr.unsubscribe.assert_called_once_with(h, 4)
+
+
+class OrderLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.order_id = str(uuid.uuid4())
+        self.chunks = [{'step': 'a', 'stream': 'stdout', 'data': 'x\n'}]
+        self.h = unittest.mock.Mock()
+        self.h.ordermgr.inflight = {self.h.id: {self.order_id: None}}
+        self.cmd = command.OrderLog(self.h)
+
+    def test_parse_params_rejects_bad_chunks(self):
+        for chunks in (
+            'x', [1], [{'step': 'a', 'stream': 'stdin', 'data': ''}],
+            [{'step': 'a', 'stream': 'stdout', 'data': b''}],
+            [{'step': 'a', 'stream': 'stdout'}],
+        ):
+            with self.assertRaises(error.ParamError):
+                command.OrderLog.parse_params(
+                    order_id=self.order_id, chunks=chunks)
+
+    def test_execute_pushes_event_to_watchers(self):
+        self.h.eventmgr.watching.return_value = True
+        self.cmd.execute(**self.cmd.parse_params(
+            order_id=self.order_id, chunks=self.chunks))
+        self.h.eventmgr.watching.assert_called_once_with(self.order_id)
+        self.h.eventmgr.push_event.assert_called_once_with(
+            event.OrderLog(order_id=self.order_id, chunks=self.chunks))
+
+    def test_execute_drops_output_when_nobody_watching(self):
+        self.h.eventmgr.watching.return_value = False
+        self.cmd.execute(**self.cmd.parse_params(
+            order_id=self.order_id, chunks=self.chunks))
+        self.assertFalse(self.h.eventmgr.push_event.called)
+
+    def test_execute_rejects_output_of_order_not_assigned_to_worker(self):
+        self.h.eventmgr.watching.return_value = True
+        self.h.ordermgr.inflight = {}
+        with self.assertRaises(error.ClientError):
+            self.cmd.execute(**self.cmd.parse_params(
+                order_id=self.order_id, chunks=self.chunks))
+        self.assertFalse(self.h.eventmgr.push_event.called)
+
+
+class HeartbeatTestCase(unittest.TestCase):
+    def test_execute_renews_lease(self):
+        h = unittest.mock.Mock()
+        cmd = command.Heartbeat(h)
+        cmd.execute(**cmd.parse_params())
+        h.ordermgr.heartbeat.assert_called_once_with(h)
 
 
 class OrderCompleteTestCase(unittest.TestCase):
@@ -188,7 +341,16 @@ class OrderCompleteTestCase(unittest.TestCase):
         u = str(uuid.uuid4())
         cmd = command.OrderComplete(h)
         cmd.execute(**cmd.parse_params(order_id=u, result='C'))
-        h.ordermgr.complete_order_id.assert_called_once_with(u)
+        h.ordermgr.complete_order_id.assert_called_once_with(
+            u, worker=h.id)
+
+    def test_execute_rejects_order_not_assigned_to_worker(self):
+        h = unittest.mock.Mock()
+        h.ordermgr.complete_order_id.return_value = None
+        cmd = command.OrderComplete(h)
+        with self.assertRaises(error.ClientError):
+            cmd.execute(order_id=str(uuid.uuid4()), result='C')
+        self.assertFalse(h.eventmgr.push_event.called)
 
     def test_execute_emits_OrderCompleted_event(self):
         h = unittest.mock.Mock()
@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import json
 import unittest
 import unittest.mock
 
@@ -75,3 +76,13 @@ class EventTestCase(unittest.TestCase):
         self.assertTrue(A(x=1) != B(x=1))
         self.assertFalse(A(x=1) == A(x=2))
         self.assertTrue(A(x=1) != A(x=2))
+
+    def test_to_bytes_is_json_line_of_obj(self):
+        ev = event.Event(foo='bar')
+        self.assertEqual(
+            json.loads(ev.to_bytes().decode('UTF-8')), ev.to_obj())
+        self.assertTrue(ev.to_bytes().endswith(b'\n'))
+
+    def test_to_bytes_serialises_once(self):
+        ev = event.Event(foo='bar')
+        self.assertIs(ev.to_bytes(), ev.to_bytes())
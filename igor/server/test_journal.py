@@ -0,0 +1,141 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+import uuid
+
+from .. import order
+from . import journal
+from . import queue
+
+
+class JournalTestCase(unittest.TestCase):
+    def _order(self):
+        return order.Order(
+            spec_uri='/fake/local/dir', spec_ref='build0', desc='test',
+            source_uri='git://example.org/foo/bar', source_args=['abcdef0']
+        )
+
+    def _handler(self):
+        m = unittest.mock.Mock()
+        m.id = str(uuid.uuid4())
+        return m
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'journal')
+        self.j = journal.Journal(self.path)
+        self.om = queue.OrderManager(journal=self.j)
+
+    def tearDown(self):
+        self.j.close()
+        self._dir.cleanup()
+
+    def _replay(self):
+        self.j.flush()
+        return journal.Journal.replay(self.path)
+
+    def test_replay_of_missing_journal_is_empty(self):
+        self.assertEqual(
+            journal.Journal.replay(os.path.join(self._dir.name, 'x')), {})
+
+    def test_records_not_written_until_flush(self):
+        self.om.add_order(self._order())
+        self.assertEqual(journal.Journal.replay(self.path), {})
+        self.assertEqual(len(self._replay()), 1)
+
+    def test_schedule_called_once_per_batch(self):
+        schedule = unittest.mock.Mock()
+        self.j._schedule = schedule
+        self.om.add_order(self._order())
+        self.om.add_order(self._order())
+        schedule.assert_called_once_with(self.j.flush)
+        self.j.flush()
+        self.om.add_order(self._order())
+        self.assertEqual(schedule.call_count, 2)
+
+    def test_replay_yields_pending_and_assigned_orders(self):
+        o1, o2 = self._order(), self._order()
+        h = self._handler()
+        self.om.add_order(o1)
+        self.om.add_order(o2)
+        self.om.subscribe(h)
+        self.assertEqual(
+            list(self._replay().values()),
+            [o1.assign(h.id), o2]
+        )
+
+    def test_replay_omits_completed_and_cancelled_orders(self):
+        o1, o2, o3 = self._order(), self._order(), self._order()
+        for o in (o1, o2, o3):
+            self.om.add_order(o)
+        self.om.subscribe(self._handler())
+        self.om.complete_order(o1)
+        self.om.cancel_order(o2)
+        self.assertEqual(list(self._replay()), [o3.id])
+
+    def test_replay_applies_unassign(self):
+        self.om.add_order(self._order())
+        self.om.subscribe(self._handler())
+        o = next(iter(self.om))
+        self.om.unassign_order(o)
+        self.assertEqual(self._replay()[o.id], o.unassign())
+
+    def test_replay_ignores_torn_record(self):
+        o = self._order()
+        self.om.add_order(o)
+        self.j.flush()
+        with open(self.path, 'ab') as f:
+            f.write(b'{"op": "cre')
+        self.assertEqual(list(journal.Journal.replay(self.path)), [o.id])
+
+    def test_snapshot_truncates_journal_and_preserves_state(self):
+        self.j.snapshot_interval = 3
+        orders = [self._order() for i in range(4)]
+        for o in orders:
+            self.om.add_order(o)
+        self.j.flush()
+        with open(self.path, 'rb') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertEqual(list(self._replay()), [o.id for o in orders])
+
+    def test_replay_after_snapshot_of_stale_journal_is_idempotent(self):
+        o1, o2 = self._order(), self._order()
+        self.om.add_order(o1)
+        self.om.add_order(o2)
+        self.om.cancel_order(o1)
+        self.j.flush()
+        with open(self.path, 'rb') as f:
+            stale = f.read()
+        self.j.snapshot(self.om)
+        with open(self.path, 'ab') as f:
+            f.write(stale)  # crash before truncation
+        self.assertEqual(list(journal.Journal.replay(self.path)), [o2.id])
+
+    def test_restore_requeues_assigned_orders(self):
+        o = self._order()
+        self.om.add_order(o)
+        self.om.subscribe(self._handler())
+        orders = self._replay()
+
+        om = queue.OrderManager()
+        om.restore(orders.values())
+        h = self._handler()
+        om.subscribe(h)
+        h.push_order.assert_called_once_with(o.assign(h.id))
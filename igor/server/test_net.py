@@ -42,6 +42,14 @@ class ServerHandlerTestCase(unittest.TestCase):
         self.assertTrue(hasattr(self.h, 'eventmgr'))
         self.assertIs(self.h.eventmgr, self.eventmgr)
 
+    def test_buffer_size_counts_bytes_pushed_but_not_sent(self):
+        with unittest.mock.patch('asynchat.async_chat.push'):
+            self.h.push(b'foo\n')
+        self.assertEqual(self.h.buffer_size(), 4)
+        with unittest.mock.patch('asyncore.dispatcher.send', return_value=3):
+            self.h.send(b'foo\n')
+        self.assertEqual(self.h.buffer_size(), 1)
+
     def test_handle_close_discards_handler_from_eventmgr(self):
         self.h.handle_close()
         self.eventmgr.discard.assert_called_once_with(self.h)
@@ -0,0 +1,146 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import unittest
+import unittest.mock
+
+from .. import order
+from . import event
+from . import protocol
+
+
+class Handler(protocol.Handler):
+    """Handler whose transport buffers everything until drained."""
+    def __init__(self, **kwargs):
+        super().__init__(
+            ordermgr=unittest.mock.Mock(), eventmgr=unittest.mock.Mock(),
+            high_water=200, low_water=40, **kwargs
+        )
+        self.buffered = []
+        self.sent = []
+        self.disconnected = False
+
+    def push(self, data):
+        self.buffered.append(data)
+
+    def buffer_size(self):
+        return sum(len(data) for data in self.buffered)
+
+    def disconnect(self):
+        self.disconnected = True
+
+    def drain(self):
+        self.sent.extend(self.buffered)
+        self.buffered = []
+        self.resume_events()
+
+    def received(self):
+        return [json.loads(data.decode('UTF-8')) for data in self.sent]
+
+
+class HandlerTestCase(unittest.TestCase):
+    def event(self, n):
+        return event.OrderCreated(order_id='{:046}'.format(n))  # 100 bytes
+
+    def received_ids(self, h):
+        return [int(obj['params']['order_id']) for obj in h.received()]
+
+    def test_rejects_unknown_slow_consumer_policy(self):
+        with self.assertRaises(ValueError):
+            Handler(slow_consumer='ignore')
+
+    def test_events_held_above_high_water_until_drained(self):
+        h = Handler()
+        for n in range(4):
+            h.push_event(self.event(n))
+        self.assertTrue(h.paused)
+        self.assertEqual(len(h.buffered), 3)
+        self.assertEqual(len(h.backlog), 1)
+        h.drain()
+        h.drain()
+        self.assertFalse(h.paused)
+        self.assertEqual(self.received_ids(h), [0, 1, 2, 3])
+
+    def test_drop_oldest_discards_oldest_backlogged_events(self):
+        h = Handler(slow_consumer='drop-oldest')
+        for n in range(8):
+            h.push_event(self.event(n))
+        h.drain()
+        h.drain()
+        self.assertEqual(h.dropped, 3)
+        self.assertEqual(self.received_ids(h), [0, 1, 2, 6, 7])
+
+    def test_lag_coalesces_dropped_events_into_lagged_event(self):
+        h = Handler(slow_consumer='lag')
+        for n in range(10):
+            h.push_event(self.event(n))
+        h.drain()
+        h.push_event(self.event(10))
+        h.drain()
+        self.assertEqual(h.dropped, 7)
+        self.assertEqual(h.received()[3], event.Lagged(dropped=7).to_obj())
+        self.assertEqual(int(h.received()[4]['params']['order_id']), 10)
+
+    def test_disconnect_closes_slow_consumer(self):
+        h = Handler(slow_consumer='disconnect')
+        for n in range(5):
+            h.push_event(self.event(n))
+        self.assertFalse(h.disconnected)
+        for n in range(5):
+            h.push_event(self.event(n))
+        self.assertTrue(h.disconnected)
+
+    def test_orders_are_never_held_or_dropped(self):
+        h = Handler(slow_consumer='drop-oldest')
+        for n in range(10):
+            h.push_event(self.event(n))
+        o = order.Order(
+            desc='foo', spec_uri='/spec', spec_ref='master', source_uri='/src')
+        h.push_order(o)
+        self.assertEqual(h.buffered[-1], json.dumps(
+            {'order': o.to_obj()}).encode('UTF-8') + b'\n')
+
+    def test_stats_reports_buffer_occupancy_of_connections(self):
+        connections = set()
+        h1 = Handler(connections=connections)
+        h2 = Handler(connections=connections)
+        for n in range(4):
+            h2.push_event(self.event(n))
+        stats = h1.stats()['connections']
+        self.assertEqual(set(stats), {h1.id, h2.id})
+        self.assertEqual(stats[h2.id]['buffered'], 300)
+        self.assertEqual(stats[h2.id]['backlog'], 100)
+        self.assertTrue(stats[h2.id]['paused'])
+
+    def test_cancel_callback_pushes_order_cancelled_event(self):
+        h = Handler()
+        o1, o2 = unittest.mock.Mock(id='old'), unittest.mock.Mock(id='new')
+        h.ordermgr.on_cancel(o1, o2)
+        h.eventmgr.push_event.assert_called_once_with(
+            event.OrderCancelled(order_id='old', superseded_by='new'))
+
+    def test_connection_lost_disconnects_from_ordermgr(self):
+        h = Handler()
+        h.connection_lost()
+        h.ordermgr.disconnect.assert_called_once_with(h)
+        h.eventmgr.discard.assert_called_once_with(h)
+
+    def test_connection_lost_removes_handler_from_connections(self):
+        connections = set()
+        h = Handler(connections=connections)
+        h.connection_lost()
+        self.assertEqual(connections, set())
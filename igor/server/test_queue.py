@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
 import unittest
 import unittest.mock
 import uuid
@@ -21,6 +22,53 @@ import uuid
 from .. import order
 from . import event
 from . import queue
+from . import schedule
+
+
+class SlotQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.q = queue.SlotQueue()
+
+    def test_add_accumulates_slots(self):
+        self.q.add('a')
+        self.q.add('a', 3)
+        self.assertEqual(self.q.slots('a'), 4)
+        self.assertEqual(len(self.q), 1)
+
+    def test_popleft_takes_one_slot_round_robin(self):
+        self.q.add('a', 2)
+        self.q.add('b')
+        self.assertEqual(
+            [self.q.popleft() for i in range(3)],
+            ['a', 'b', 'a']
+        )
+        self.assertFalse(self.q)
+
+    def test_discard_removes_all_slots(self):
+        self.q.add('a', 5)
+        self.q.add('b')
+        self.assertEqual(self.q.discard('a'), 5)
+        self.assertNotIn('a', self.q)
+        self.assertEqual(self.q.popleft(), 'b')
+
+    def test_discard_unknown_subscriber_returns_zero(self):
+        self.assertEqual(self.q.discard('a'), 0)
+
+    def test_take_takes_slot_from_given_subscriber(self):
+        self.q.add('a')
+        self.q.add('b', 2)
+        self.assertEqual(self.q.take('b'), 'b')
+        self.assertEqual(self.q.slots('b'), 1)
+        self.q.take('b')
+        self.assertNotIn('b', self.q)
+        self.assertEqual(self.q.popleft(), 'a')
+
+    def test_discard_count_removes_some_slots(self):
+        self.q.add('a', 5)
+        self.assertEqual(self.q.discard('a', 2), 2)
+        self.assertEqual(self.q.slots('a'), 3)
+        self.assertEqual(self.q.discard('a', 10), 3)
+        self.assertNotIn('a', self.q)
 
 
 class OrderManagerTestCase(unittest.TestCase):
@@ -53,6 +101,23 @@ class OrderManagerTestCase(unittest.TestCase):
             unittest.mock.call(o2.assign(m.id))
         ])
 
+    def test_subscribe_with_count_increases_subscription_by_count(self):
+        m = self._handler()
+        self.om.subscribe(m, 2)
+        o1, o2, o3 = self._order(), self._order(), self._order()
+        self.om.add_order(o1)
+        self.om.add_order(o2)
+        self.om.add_order(o3)  # should not be pushed to m
+        self.assertEqual(m.push_order.call_count, 2)
+
+    def test_unsubscribe_with_count_returns_some_credits(self):
+        m = self._handler()
+        self.om.subscribe(m, 3)
+        self.assertEqual(self.om.unsubscribe(m, 2), 2)
+        self.om.add_order(self._order())
+        self.om.add_order(self._order())
+        self.assertEqual(m.push_order.call_count, 1)
+
     def test_unsubscribe_voids_multiple_subscriptions(self):
         m = self._handler()
         self.om.subscribe(m)
@@ -176,6 +241,99 @@ class OrderManagerTestCase(unittest.TestCase):
         o = self.om.complete_order_id(self.o.id)
         self.assertEqual(o, self.o.assign(h.id).complete())
 
+    def test_policy_decides_assignment_order(self):
+        self.om = queue.OrderManager(policy=schedule.PriorityPolicy())
+        low = self._order()
+        high = order.Order(
+            spec_uri='/fake/local/dir', spec_ref='build0', desc='test',
+            source_uri='git://example.org/foo/bar', priority=1
+        )
+        self.om.add_order(low)
+        self.om.add_order(high)
+        h = self._handler()
+        self.om.subscribe(h)
+        h.push_order.assert_called_once_with(high.assign(h.id))
+
+    def test_cold_order_not_held_without_affinity_wait(self):
+        warm, cold = self._handler(), self._handler()
+        self.om.set_caches(warm, ['/fake/local/dir'])
+        self.om.subscribe(cold)
+        self.om.add_order(self.o)
+        cold.push_order.assert_called_once_with(self.o.assign(cold.id))
+        self.assertEqual(self.om.stats()['affinity_misses'], 1)
+
+    def test_order_prefers_free_warm_subscriber(self):
+        warm, cold = self._handler(), self._handler()
+        self.om.subscribe(cold)
+        self.om.set_caches(warm, ['/fake/local/dir'])
+        self.om.subscribe(warm)
+        self.om.add_order(self.o)
+        warm.push_order.assert_called_once_with(self.o.assign(warm.id))
+        self.assertFalse(cold.push_order.called)
+        self.assertEqual(self.om.stats()['affinity_hits'], 1)
+
+    def test_order_held_for_busy_warm_subscriber(self):
+        self.om.affinity_wait = 10
+        warm, cold = self._handler(), self._handler()
+        self.om.set_caches(warm, ['/fake/local/dir'])
+        self.om.subscribe(cold)
+        self.om.add_order(self.o)
+        self.assertFalse(cold.push_order.called)
+        self.om.subscribe(warm)
+        warm.push_order.assert_called_once_with(self.o.assign(warm.id))
+        self.assertEqual(self.om.stats()['held'], 0)
+
+    def test_held_order_not_held_without_warm_subscriber(self):
+        self.om.affinity_wait = 10
+        h = self._handler()
+        self.om.set_caches(h, ['/some/other/dir'])
+        self.om.subscribe(h)
+        self.om.add_order(self.o)
+        h.push_order.assert_called_once_with(self.o.assign(h.id))
+
+    def test_held_order_goes_to_cold_subscriber_after_wait(self):
+        self.om.affinity_wait = 10
+        warm, cold = self._handler(), self._handler()
+        self.om.set_caches(warm, ['/fake/local/dir'])
+        self.om.subscribe(cold)
+        self.om.add_order(self.o)
+        self.om.poll(time.monotonic() + 5)
+        self.assertFalse(cold.push_order.called)
+        self.om.poll(time.monotonic() + 11)
+        cold.push_order.assert_called_once_with(self.o.assign(cold.id))
+        self.assertEqual(self.om.stats()['affinity_expired'], 1)
+
+    def test_held_order_does_not_block_other_orders(self):
+        self.om.affinity_wait = 10
+        warm, cold = self._handler(), self._handler()
+        self.om.set_caches(warm, ['/fake/local/dir'])
+        self.om.subscribe(cold)
+        other = order.Order(
+            spec_uri='/other/dir', spec_ref='build0', desc='test',
+            source_uri='git://example.org/foo/bar'
+        )
+        self.om.add_order(self.o)
+        self.om.add_order(other)
+        cold.push_order.assert_called_once_with(other.assign(cold.id))
+
+    def test_cancel_held_order(self):
+        self.om.affinity_wait = 10
+        self.om.set_caches(self._handler(), ['/fake/local/dir'])
+        self.om.subscribe(self._handler())
+        self.om.add_order(self.o)
+        self.om.cancel_order(self.o)
+        self.assertNotIn(self.o, self.om)
+        self.assertEqual(self.om.stats()['held'], 0)
+
+    def test_unsubscribe_forgets_caches(self):
+        self.om.affinity_wait = 10
+        warm, cold = self._handler(), self._handler()
+        self.om.set_caches(warm, ['/fake/local/dir'])
+        self.om.unsubscribe(warm)
+        self.om.subscribe(cold)
+        self.om.add_order(self.o)
+        cold.push_order.assert_called_once_with(self.o.assign(cold.id))
+
     def test_on_assign_callback_is_called_with_assigned_order(self):
         cb = unittest.mock.Mock()
         self.om.on_assign = cb
@@ -185,6 +343,228 @@ class OrderManagerTestCase(unittest.TestCase):
         self.om.add_order(self.o)
         cb.assert_called_once_with(self.o.assign(h.id))
 
+    def test_unknown_coalesce_policy_rejected(self):
+        with self.assertRaises(ValueError):
+            queue.OrderManager(coalesce='merge')
+
+    def test_identical_orders_queued_without_coalescing(self):
+        self.om.add_order(self.o)
+        self.om.add_order(self._order())
+        self.assertEqual(self.om.stats()['queued'], 2)
+
+    def test_dedupe_drops_identical_pending_order(self):
+        self.om = queue.OrderManager(coalesce='dedupe')
+        cb = self.om.on_cancel = unittest.mock.Mock()
+        dup = self._order()
+        self.om.add_order(self.o)
+        self.assertIs(self.om.add_order(dup), self.o)
+        self.assertNotIn(dup, self.om)
+        self.assertEqual(self.om.stats()['queued'], 1)
+        self.assertEqual(self.om.stats()['orders_deduplicated'], 1)
+        cb.assert_called_once_with(dup, self.o)
+
+    def test_dedupe_queues_order_with_different_source_args(self):
+        self.om = queue.OrderManager(coalesce='dedupe')
+        newer = order.Order(
+            spec_uri='/fake/local/dir', spec_ref='build0', desc='test',
+            source_uri='git://example.org/foo/bar', source_args=['1234567']
+        )
+        self.om.add_order(self.o)
+        self.assertIs(self.om.add_order(newer), newer)
+        self.assertEqual(self.om.stats()['queued'], 2)
+
+    def test_dedupe_queues_duplicate_of_assigned_order(self):
+        self.om = queue.OrderManager(coalesce='dedupe')
+        self.om.subscribe(self._handler())
+        self.om.add_order(self.o)
+        dup = self._order()
+        self.assertIs(self.om.add_order(dup), dup)
+        self.assertEqual(self.om.stats()['queued'], 1)
+
+    def test_supersede_cancels_pending_orders_for_same_key(self):
+        self.om = queue.OrderManager(coalesce='supersede')
+        cb = self.om.on_cancel = unittest.mock.Mock()
+        newer = order.Order(
+            spec_uri='/fake/local/dir', spec_ref='build0', desc='test',
+            source_uri='git://example.org/foo/bar', source_args=['1234567']
+        )
+        self.om.add_order(self.o)
+        self.om.add_order(newer)
+        self.assertNotIn(self.o, self.om)
+        self.assertEqual(self.om.stats()['orders_superseded'], 1)
+        cb.assert_called_once_with(self.o, newer)
+        h = self._handler()
+        self.om.subscribe(h, 2)
+        h.push_order.assert_called_once_with(newer.assign(h.id))
+
+    def test_supersede_does_not_cancel_assigned_order(self):
+        self.om = queue.OrderManager(coalesce='supersede')
+        h = self._handler()
+        self.om.subscribe(h)
+        self.om.add_order(self.o)
+        self.om.add_order(self._order())
+        self.assertEqual(len(self.om.orders), 2)
+
+    def test_supersede_cancels_unassigned_order(self):
+        self.om = queue.OrderManager(coalesce='supersede')
+        h = self._handler()
+        self.om.subscribe(h)
+        self.om.add_order(self.o)
+        self.om.unassign_order(self.o)
+        self.om.add_order(self._order())
+        self.assertNotIn(self.o.id, self.om.orders)
+
+    def test_supersede_cancels_held_order(self):
+        self.om = queue.OrderManager(coalesce='supersede', affinity_wait=10)
+        self.om.set_caches(self._handler(), ['/fake/local/dir'])
+        self.om.subscribe(self._handler())
+        self.om.add_order(self.o)
+        self.om.add_order(self._order())
+        self.assertNotIn(self.o.id, self.om.orders)
+        self.assertEqual(self.om.stats()['held'], 1)
+
+    def test_disconnect_requeues_assigned_orders_at_head(self):
+        h1, h2 = self._handler(), self._handler()
+        o2, o3 = self._order(), self._order()
+        self.om.subscribe(h1, 2)
+        self.om.add_order(self.o)
+        self.om.add_order(o2)
+        self.om.add_order(o3)
+        self.om.disconnect(h1)
+        self.assertEqual(self.om.stats()['orders_requeued'], 2)
+        self.om.subscribe(h2, 3)
+        self.assertEqual(
+            [c[0][0].id for c in h2.push_order.call_args_list],
+            [self.o.id, o2.id, o3.id])
+
+    def test_disconnect_without_assigned_orders_unsubscribes(self):
+        h = self._handler()
+        self.om.subscribe(h)
+        self.om.disconnect(h)
+        self.om.add_order(self.o)
+        self.assertFalse(h.push_order.called)
+
+    def test_completed_order_not_requeued_on_disconnect(self):
+        h = self._handler()
+        self.om.subscribe(h)
+        self.om.add_order(self.o)
+        self.om.complete_order(self.o)
+        self.om.disconnect(h)
+        self.assertNotIn(self.o.id, self.om.orders)
+        self.assertEqual(self.om.stats()['queued'], 0)
+
+    def test_expired_lease_requeues_orders_and_revokes_credits(self):
+        self.om = queue.OrderManager(lease_time=30)
+        h1, h2 = self._handler(), self._handler()
+        self.om.subscribe(h1, 2)
+        self.om.add_order(self.o)
+        self.om.poll(time.monotonic() + 20)
+        self.assertEqual(self.om.stats()['assigned'], 1)
+        self.om.poll(time.monotonic() + 31)
+        self.assertEqual(self.om.stats()['leases_expired'], 1)
+        self.assertEqual(self.om.stats()['assigned'], 0)
+        self.om.subscribe(h2)
+        h2.push_order.assert_called_once_with(self.o.assign(h2.id))
+        self.om.add_order(self._order())
+        self.assertEqual(h1.push_order.call_count, 1)
+        h1.push_expire.assert_called_once_with([self.o.id])
+
+    def test_expired_worker_subscribes_again(self):
+        self.om = queue.OrderManager(lease_time=30)
+        h = self._handler()
+        self.om.subscribe(h, 2)
+        self.om.add_order(self.o)
+        now = time.monotonic()
+        self.om.poll(now + 31)
+        h.push_expire.assert_called_once_with([self.o.id])
+        # the slow worker registers its credits again on being told
+        self.om.subscribe(h, 2)
+        self.assertEqual(h.push_order.call_count, 2)
+        self.om.heartbeat(h, now + 50)
+        self.om.poll(now + 61)
+        self.assertEqual(self.om.stats()['leases_expired'], 1)
+        self.om.add_order(self._order())
+        self.assertEqual(h.push_order.call_count, 3)
+
+    def test_heartbeat_renews_lease(self):
+        self.om = queue.OrderManager(lease_time=30)
+        h = self._handler()
+        self.om.subscribe(h)
+        self.om.add_order(self.o)
+        now = time.monotonic()
+        self.om.heartbeat(h, now + 20)
+        self.om.poll(now + 31)
+        self.assertEqual(self.om.stats()['assigned'], 1)
+        self.om.poll(now + 51)
+        self.assertEqual(self.om.stats()['assigned'], 0)
+
+    def test_completion_by_worker_after_lease_expiry_is_stale(self):
+        self.om = queue.OrderManager(lease_time=30)
+        h1, h2 = self._handler(), self._handler()
+        self.om.subscribe(h1)
+        self.om.add_order(self.o)
+        self.om.poll(time.monotonic() + 31)
+        self.om.subscribe(h2)
+        self.assertIsNone(self.om.complete_order_id(self.o.id, worker=h1.id))
+        self.assertEqual(self.om.stats()['stale_completions'], 1)
+        o = self.om.complete_order_id(self.o.id, worker=h2.id)
+        self.assertEqual(o.worker, h2.id)
+
+    def test_leases_do_not_expire_without_lease_time(self):
+        h = self._handler()
+        self.om.subscribe(h)
+        self.om.add_order(self.o)
+        self.om.poll(time.monotonic() + 86400)
+        self.assertEqual(self.om.stats()['assigned'], 1)
+
+    def test_unstarted_prefetched_order_revoked_and_requeued(self):
+        self.om = queue.OrderManager(start_timeout=30)
+        self.om.on_revoke = unittest.mock.Mock()
+        h1, h2 = self._handler(), self._handler()
+        self.om.set_prefetch(h1, True)
+        self.om.subscribe(h1)
+        self.om.add_order(self.o)
+        self.assertEqual(self.om.stats()['unstarted'], 1)
+        self.om.poll(time.monotonic() + 20)
+        self.assertFalse(h1.push_revoke.called)
+        self.om.poll(time.monotonic() + 31)
+        h1.push_revoke.assert_called_once_with(self.o.assign(h1.id))
+        self.om.on_revoke.assert_called_once_with(self.o.assign(h1.id))
+        self.assertEqual(self.om.stats()['orders_revoked'], 1)
+        self.assertEqual(self.om.stats()['unstarted'], 0)
+        self.om.subscribe(h2)
+        h2.push_order.assert_called_once_with(self.o.assign(h2.id))
+
+    def test_started_order_not_revoked(self):
+        self.om = queue.OrderManager(start_timeout=30)
+        h = self._handler()
+        self.om.set_prefetch(h, True)
+        self.om.subscribe(h)
+        self.om.add_order(self.o)
+        self.assertEqual(self.om.start_order_id(self.o.id, h.id).id, self.o.id)
+        self.om.poll(time.monotonic() + 31)
+        self.assertFalse(h.push_revoke.called)
+        self.assertEqual(self.om.stats()['assigned'], 1)
+
+    def test_start_of_revoked_order_is_stale(self):
+        self.om = queue.OrderManager(start_timeout=30)
+        h = self._handler()
+        self.om.set_prefetch(h, True)
+        self.om.subscribe(h)
+        self.om.add_order(self.o)
+        self.om.poll(time.monotonic() + 31)
+        self.assertIsNone(self.om.start_order_id(self.o.id, h.id))
+        self.assertEqual(self.om.stats()['stale_starts'], 1)
+
+    def test_orders_of_non_prefetching_worker_not_revoked(self):
+        self.om = queue.OrderManager(start_timeout=30)
+        h = self._handler()
+        self.om.subscribe(h)
+        self.om.add_order(self.o)
+        self.om.poll(time.monotonic() + 31)
+        self.assertFalse(h.push_revoke.called)
+        self.assertEqual(self.om.stats()['assigned'], 1)
+
 
 class EventManagerTestCase(unittest.TestCase):
     def setUp(self):
@@ -211,6 +591,23 @@ class EventManagerTestCase(unittest.TestCase):
         self.em.push_event(Foo())
         m.push_event.assert_called_once_with(ev)  # subscription changed
 
+    @unittest.mock.patch(event.__package__ + '.event.Event.events', {})
+    def test_repeated_events_subscribe_once_and_discard(self):
+        @event.Event.register
+        class Foo(event.Event):
+            pass
+
+        m = unittest.mock.Mock()
+        self.em.add(m, (Foo, Foo))
+        ev = Foo()
+        self.em.push_event(ev)
+        m.push_event.assert_called_once_with(ev)
+        self.em.discard(m)
+        self.em.add(m, (Foo, Foo))  # resubscribe
+        self.em.discard(m)
+        self.em.push_event(Foo())
+        m.push_event.assert_called_once_with(ev)
+
     def test_discard_nonsubscriber_has_no_effect(self):
         @event.Event.register
         class Foo(event.Event):
@@ -271,3 +668,98 @@ class EventManagerTestCase(unittest.TestCase):
         with self.assertRaises(StopIteration, msg="only 2 items in iterator"):
             next(iterator)
         self.assertEqual(len(list(self.em)), 3, "item added during iteration")
+
+    @unittest.mock.patch(event.__package__ + '.event.Event.events', {})
+    def test_push_event_pushes_subclass_once_to_overlapping_subscribers(self):
+        @event.Event.register
+        class Foo(event.Event):
+            pass
+
+        @event.Event.register
+        class Bar(Foo):
+            pass
+
+        m1 = unittest.mock.Mock()
+        m2 = unittest.mock.Mock()
+        self.em.add(m1, ())
+        self.em.add(m2, (Foo, Bar))
+
+        ev = Bar()
+        self.em.push_event(ev)
+
+        m1.push_event.assert_called_once_with(ev)
+        m2.push_event.assert_called_once_with(ev)
+
+    @unittest.mock.patch(event.__package__ + '.event.Event.events', {})
+    def test_subscriber_may_discard_itself_during_push(self):
+        @event.Event.register
+        class Foo(event.Event):
+            pass
+
+        m1 = unittest.mock.Mock()
+        m2 = unittest.mock.Mock()
+        m1.push_event.side_effect = lambda ev: self.em.discard(m1)
+        self.em.add(m1, (Foo,))
+        self.em.add(m2, (Foo,))
+
+        ev = Foo()
+        self.em.push_event(ev)
+        self.em.push_event(ev)
+
+        m1.push_event.assert_called_once_with(ev)
+        self.assertEqual(m2.push_event.call_count, 2)
+
+    @unittest.mock.patch(event.__package__ + '.event.Event.events', {})
+    def test_order_subscriber_receives_only_events_for_its_orders(self):
+        @event.Event.register
+        class Foo(event.Event):
+            pass
+
+        m = unittest.mock.Mock()
+        self.em.add(m, (), order_ids={'a'})
+        self.assertTrue(self.em.watching('a'))
+        self.assertFalse(self.em.watching('b'))
+
+        ev = Foo(order_id='a')
+        self.em.push_event(ev)
+        self.em.push_event(Foo(order_id='b'))
+        self.em.push_event(Foo())
+        m.push_event.assert_called_once_with(ev)
+
+    @unittest.mock.patch(event.__package__ + '.event.Event.events', {})
+    def test_order_subscriber_receives_only_subscribed_events(self):
+        @event.Event.register
+        class Foo(event.Event):
+            pass
+
+        @event.Event.register
+        class Bar(event.Event):
+            pass
+
+        m = unittest.mock.Mock()
+        self.em.add(m, (Foo,), order_ids={'a'})
+        ev = Foo(order_id='a')
+        self.em.push_event(ev)
+        self.em.push_event(Bar(order_id='a'))
+        m.push_event.assert_called_once_with(ev)
+
+    def test_order_log_only_pushed_to_watchers(self):
+        m1, m2, m3 = (unittest.mock.Mock() for i in range(3))
+        self.em.add(m1, ())
+        self.em.add(m2, (event.OrderLog,))
+        self.em.add(m3, (), order_ids={'a'})
+        ev = event.OrderLog(order_id='a', chunks=[])
+        self.em.push_event(ev)
+        self.assertFalse(m1.push_event.called)
+        self.assertFalse(m2.push_event.called)
+        m3.push_event.assert_called_once_with(ev)
+
+    def test_discard_order_subscriber_stops_watching(self):
+        m = unittest.mock.Mock()
+        self.em.add(m, (), order_ids={'a', 'b'})
+        self.em.add(m, ())  # resubscribe to everything
+        self.assertFalse(self.em.watching('a'))
+        self.em.add(m, (), order_ids={'b'})
+        self.em.discard(m)
+        self.assertFalse(self.em.watching('b'))
+        self.assertEqual(self.em._index, {})
@@ -0,0 +1,209 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import unittest
+
+from .. import order
+from . import schedule
+
+
+def _order(spec_uri='/fake/local/dir', spec_ref='build0', priority=0):
+    return order.Order(
+        spec_uri=spec_uri, spec_ref=spec_ref, desc='test',
+        source_uri='git://example.org/foo/bar', priority=priority
+    )
+
+
+class OrderQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.q = schedule.OrderQueue()
+        for order_id in 'abc':
+            self.q.append(order_id)
+
+    def test_popleft_is_fifo(self):
+        self.assertEqual([self.q.popleft() for i in range(3)], list('abc'))
+
+    def test_appendleft_puts_id_at_head(self):
+        self.q.appendleft('z')
+        self.assertEqual(list(self.q), list('zabc'))
+
+    def test_appendleft_moves_queued_id_to_head(self):
+        self.q.appendleft('c')
+        self.assertEqual(list(self.q), list('cab'))
+
+    def test_discard_removes_id(self):
+        self.q.discard('b')
+        self.assertNotIn('b', self.q)
+        self.assertEqual(list(self.q), list('ac'))
+
+    def test_discard_unknown_id_has_no_effect(self):
+        self.q.discard('z')
+        self.assertEqual(len(self.q), 3)
+
+
+class PolicyTestCase(unittest.TestCase):
+    def test_lookup_finds_policy_by_name_without_suffix(self):
+        self.assertIs(schedule.Policy.lookup('fifo'), schedule.FifoPolicy)
+        self.assertIs(
+            schedule.Policy.lookup('FairShare'), schedule.FairSharePolicy)
+
+    def test_lookup_raises_key_error_on_missing_policy(self):
+        with self.assertRaises(KeyError):
+            schedule.Policy.lookup('bogo')
+
+
+class PolicyBehaviourMixin:
+    """Behaviour common to all policies."""
+    def test_single_group_is_fifo(self):
+        orders = [_order() for i in range(3)]
+        for o in orders:
+            self.p.push(o)
+        self.assertEqual(
+            [self.p.popleft() for o in orders],
+            [o.id for o in orders]
+        )
+        self.assertFalse(self.p)
+
+    def test_pushleft_goes_first(self):
+        o1, o2 = _order(), _order()
+        self.p.push(o1)
+        self.p.pushleft(o2)
+        self.assertEqual(self.p.popleft(), o2.id)
+
+    def test_discard_removes_order(self):
+        o1, o2 = _order(), _order()
+        self.p.push(o1)
+        self.p.push(o2)
+        self.p.discard(o1.id)
+        self.assertNotIn(o1.id, self.p)
+        self.assertEqual(len(self.p), 1)
+        self.assertEqual(self.p.popleft(), o2.id)
+
+    def test_discard_unknown_order_has_no_effect(self):
+        self.p.discard('bogo')
+        self.assertEqual(len(self.p), 0)
+
+    def test_discard_all_then_push(self):
+        o1, o2 = _order(), _order()
+        self.p.push(o1)
+        self.p.discard(o1.id)
+        self.p.push(o2)
+        self.assertEqual(self.p.popleft(), o2.id)
+        self.assertFalse(self.p)
+
+
+class FifoPolicyTestCase(PolicyBehaviourMixin, unittest.TestCase):
+    def setUp(self):
+        self.p = schedule.FifoPolicy()
+
+
+class PriorityPolicyTestCase(PolicyBehaviourMixin, unittest.TestCase):
+    def setUp(self):
+        self.p = schedule.PriorityPolicy()
+
+    def test_higher_priority_goes_first(self):
+        low, mid, high = _order(priority=-1), _order(), _order(priority=5)
+        for o in (low, mid, high):
+            self.p.push(o)
+        self.assertEqual(
+            [self.p.popleft() for i in range(3)],
+            [high.id, mid.id, low.id]
+        )
+
+    def test_emptied_class_is_reused(self):
+        o1, o2, o3 = _order(priority=1), _order(priority=1), _order()
+        self.p.push(o1)
+        self.p.push(o3)
+        self.p.discard(o1.id)
+        self.p.push(o2)
+        self.assertEqual(self.p.popleft(), o2.id)
+        self.assertEqual(self.p.popleft(), o3.id)
+
+
+class FairSharePolicyTestCase(PolicyBehaviourMixin, unittest.TestCase):
+    def setUp(self):
+        self.p = schedule.FairSharePolicy()
+
+    def _specs(self, n):
+        return [self.p.popleft() for i in range(n)]
+
+    def test_rejects_weight_not_positive_and_finite(self):
+        for weight in (0, -1, float('nan'), float('inf')):
+            with self.assertRaises(ValueError):
+                schedule.FairSharePolicy(weights={'/fake/local/dir': weight})
+
+    def test_backlogged_specs_alternate(self):
+        busy = [_order(spec_ref='busy') for i in range(4)]
+        quiet = [_order(spec_ref='quiet') for i in range(2)]
+        for o in busy + quiet:
+            self.p.push(o)
+        self.assertEqual(
+            self._specs(6),
+            [busy[0].id, quiet[0].id, busy[1].id, quiet[1].id,
+                busy[2].id, busy[3].id]
+        )
+
+    def test_weights_share_assignments_proportionally(self):
+        self.p = schedule.FairSharePolicy(weights={
+            ('/fake/local/dir', 'heavy'): 3,
+        })
+        refs = {}
+        for i in range(40):
+            for ref in ('heavy', 'light'):
+                o = _order(spec_ref=ref)
+                refs[o.id] = ref
+                self.p.push(o)
+        counts = collections.Counter(refs[i] for i in self._specs(20))
+        self.assertEqual(counts, {'heavy': 15, 'light': 5})
+
+    def test_weight_by_spec_uri(self):
+        p = schedule.FairSharePolicy(weights={'/a': 2})
+        self.assertEqual(p.weight(('/a', 'x')), 2)
+        self.assertEqual(p.weight(('/b', 'x')), 1)
+
+    def test_idle_spec_does_not_bank_credit(self):
+        old = _order(spec_ref='old')
+        self.p.push(old)
+        self.assertEqual(self.p.popleft(), old.id)
+        busy = [_order(spec_ref='busy') for i in range(10)]
+        for o in busy:
+            self.p.push(o)
+        for o in busy[:5]:
+            self.assertEqual(self.p.popleft(), o.id)
+        new = [_order(spec_ref='new') for i in range(3)]
+        for o in new:
+            self.p.push(o)
+        self.assertEqual(
+            self._specs(4),
+            [new[0].id, busy[5].id, new[1].id, busy[6].id]
+        )
+
+
+class PriorityFairSharePolicyTestCase(PolicyBehaviourMixin, unittest.TestCase):
+    def setUp(self):
+        self.p = schedule.PriorityPolicy(inner=schedule.FairSharePolicy)
+
+    def test_fair_share_within_priority_class(self):
+        a1, a2 = _order(spec_ref='a'), _order(spec_ref='a')
+        b1 = _order(spec_ref='b')
+        urgent = _order(spec_ref='a', priority=1)
+        for o in (a1, a2, b1, urgent):
+            self.p.push(o)
+        self.assertEqual(
+            [self.p.popleft() for i in range(4)],
+            [urgent.id, a1.id, b1.id, a2.id]
+        )
@@ -0,0 +1,199 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Capture of process output to size-bounded spool files.
+
+Output is held in memory up to a threshold and thereafter written to
+a temporary file, so a build step's output need never be held in
+memory in full.  Optionally the output kept is capped; the head and
+tail are kept and the middle is replaced with a note of how much was
+omitted.
+
+"""
+
+import io
+import os
+import select
+import selectors
+import tempfile
+
+DEFAULT_MAX_MEMORY = 2 ** 20  # bytes
+READ_SIZE = 2 ** 16
+OMITTED = '\n[igor-ci: {} bytes omitted]\n'
+
+
+class Spool:
+    """Write-once store of output.
+
+    ``max_memory``
+      Bytes held in memory before the output is spilled to a
+      temporary file.
+    ``max_size``
+      If not ``None``, the number of bytes of output to keep.  Half
+      is taken from the start of the output and half from the end.
+    ``tee``
+      If not ``None``, a callable that is given each chunk of output
+      as it is written, before any truncation.
+
+    Call ``finish`` once all output has been written.
+
+    """
+    def __init__(
+        self, *, max_memory=DEFAULT_MAX_MEMORY, max_size=None, tee=None
+    ):
+        self.max_memory = max_memory
+        self.max_size = max_size
+        self.tee = tee
+        self.size = 0  # bytes written, including any omitted
+        self._file = io.BytesIO()
+        self._on_disk = False
+        self._kept = 0  # bytes written to _file
+        self._tail = None  # ring buffer file, once output exceeds cap
+        self._tail_pos = 0
+        self._tail_len = 0
+
+    @property
+    def _head_size(self):
+        return self.max_size - self.max_size // 2
+
+    @property
+    def _tail_size(self):
+        return self.max_size // 2
+
+    def _write_file(self, data):
+        if not self._on_disk and self._kept + len(data) > self.max_memory:
+            f = tempfile.NamedTemporaryFile(prefix='igor-spool-')
+            f.write(self._file.getvalue())
+            self._file = f
+            self._on_disk = True
+        self._file.write(data)
+        self._kept += len(data)
+
+    def _write_tail(self, data):
+        capacity = self._tail_size
+        if capacity == 0:
+            return
+        if self._tail is None:
+            self._tail = tempfile.TemporaryFile(prefix='igor-spool-')
+        data = data[-capacity:]
+        while data:
+            n = min(len(data), capacity - self._tail_pos)
+            self._tail.seek(self._tail_pos)
+            self._tail.write(data[:n])
+            self._tail_pos = (self._tail_pos + n) % capacity
+            self._tail_len = min(capacity, self._tail_len + n)
+            data = data[n:]
+
+    def write(self, data):
+        if self.tee is not None:
+            self.tee(data)
+        self.size += len(data)
+        if self.max_size is None:
+            self._write_file(data)
+            return
+        room = self._head_size - self._kept
+        if room > 0:
+            self._write_file(data[:room])
+            data = data[room:]
+        if data:
+            self._write_tail(data)
+
+    def _tail_chunks(self):
+        if self._tail_len < self._tail_size:
+            spans = [(0, self._tail_len)]
+        else:
+            spans = [(self._tail_pos, self._tail_size), (0, self._tail_pos)]
+        for start, end in spans:
+            self._tail.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = self._tail.read(min(remaining, READ_SIZE))
+                remaining -= len(chunk)
+                yield chunk
+
+    def finish(self):
+        """Complete the output, assembling any truncated output."""
+        omitted = self.size - self._kept - self._tail_len
+        if omitted:
+            self._write_file(OMITTED.format(omitted).encode('UTF-8'))
+        if self._tail is not None:
+            for chunk in self._tail_chunks():
+                self._write_file(chunk)
+            self._tail.close()
+            self._tail = None
+        self._file.flush()
+
+    def getvalue(self):
+        """Return the kept output as ``bytes``."""
+        if not self._on_disk:
+            return self._file.getvalue()
+        with open(self._file.name, 'rb') as f:
+            return f.read()
+
+    def create_blob(self, repo):
+        """Write the kept output as a blob and return its oid.
+
+        Output spilled to disk is not read into memory.
+
+        """
+        if not self._on_disk:
+            return repo.create_blob(self._file.getvalue())
+        return repo.create_blob_fromdisk(self._file.name)
+
+    def close(self):
+        """Discard the output."""
+        self._file.close()
+
+
+def communicate(proc, input, outputs):
+    """Write ``input`` to the process and spool its output.
+
+    Like ``Popen.communicate``, but each of the process's output pipes
+    is copied, as it arrives, to the ``Spool`` it maps to in
+    ``outputs``.  Wait for the process to exit and return its exit
+    status.  The spools are finished.
+
+    """
+    view = memoryview(input or b'')
+    offset = 0
+    with selectors.DefaultSelector() as selector:
+        if view:
+            selector.register(proc.stdin, selectors.EVENT_WRITE)
+        elif proc.stdin:
+            proc.stdin.close()
+        for pipe in outputs:
+            selector.register(pipe, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, events in selector.select():
+                if key.fileobj is proc.stdin:
+                    try:
+                        offset += os.write(
+                            key.fd, view[offset:offset + select.PIPE_BUF])
+                    except BrokenPipeError:
+                        offset = len(view)
+                    if offset >= len(view):
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                else:
+                    data = os.read(key.fd, READ_SIZE)
+                    if data:
+                        outputs[key.fileobj].write(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+    for spool in outputs.values():
+        spool.finish()
+    return proc.wait()
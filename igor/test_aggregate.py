@@ -0,0 +1,87 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pygit2
+
+from . import aggregate
+from . import test
+
+
+class AggregateTestCase(test.EmptyRepoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.spec_oid = self.repo.create_commit(
+            None, 'bogo spec', self.repo.null_tree(), [])
+        self.t = 1000
+
+    def report(self, worker, spec, order_id, message='[PASS] foo'):
+        """Write an incoming report as a worker would."""
+        self.t += 1
+        sig = self.repo.signature(time=self.t)
+        oid = pygit2.Repository.create_commit(
+            self.repo, None, sig, sig, message, self.repo.null_tree(),
+            [self.repo.null_report(), self.spec_oid]
+        )
+        ref = 'refs/ci/incoming/{}/{}/{}'.format(worker, spec, order_id)
+        self.repo.create_reference(ref, oid)
+        return ref
+
+    def chain(self, spec):
+        """Return the messages of the spec's report chain, oldest first."""
+        commit = self.repo.revparse_single('refs/ci/report/' + spec)
+        messages = []
+        while commit.parents:
+            messages.append(commit.message)
+            self.assertEqual(commit.parents[1].oid, self.spec_oid)
+            commit = commit.parents[0]
+        return messages[::-1]
+
+    def test_incoming_groups_by_spec_oldest_first(self):
+        a = self.report('w2', 'build0', 'o1')
+        b = self.report('w1', 'build0', 'o2')
+        c = self.report('w1', 'build1', 'o3')
+        reports = aggregate.incoming(self.repo)
+        self.assertEqual(
+            {spec: [ref for ref, commit in v] for spec, v in reports.items()},
+            {'build0': [a, b], 'build1': [c]}
+        )
+
+    def test_aggregate_appends_to_chain_and_deletes_incoming(self):
+        self.report('w1', 'build0', 'o1', '[PASS] one')
+        self.assertEqual(aggregate.aggregate(self.repo), 1)
+        self.report('w2', 'build0', 'o2', '[FAIL] two')
+        self.report('w1', 'build0', 'o3', '[PASS] three')
+        self.assertEqual(aggregate.aggregate(self.repo), 2)
+        self.assertEqual(
+            self.chain('build0'), ['[PASS] one', '[FAIL] two', '[PASS] three'])
+        self.assertEqual(aggregate.incoming(self.repo), {})
+
+    def test_aggregate_appends_batch_size_reports_at_once(self):
+        for i in range(3):
+            self.report('w1', 'build0', 'o{}'.format(i))
+        self.assertEqual(aggregate.aggregate(self.repo, batch_size=2), 2)
+        self.assertEqual(len(aggregate.incoming(self.repo)['build0']), 1)
+        self.assertEqual(aggregate.aggregate(self.repo, batch_size=2), 1)
+        self.assertEqual(len(self.chain('build0')), 3)
+
+    def test_append_fails_if_incoming_ref_moved(self):
+        ref = self.report('w1', 'build0', 'o1')
+        reports = aggregate.incoming(self.repo)['build0']
+        self.repo.create_reference(ref, self.repo.null_report(), force=True)
+        self.assertFalse(aggregate.append(self.repo, 'build0', reports))
+        self.assertNotIn(
+            'refs/ci/report/build0', self.repo.listall_references())
+        self.assertEqual(len(aggregate.incoming(self.repo)['build0']), 1)
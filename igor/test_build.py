@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import tempfile
 import time
 import unittest
 import unittest.mock
@@ -59,6 +60,119 @@ class BuildSpecReadTestCase(test.EmptyRepoTestCase):
             )
         )
 
+    def test_reads_step_trees_with_dependencies(self):
+        def step_tree(script, after=None):
+            tb = self.repo.TreeBuilder()
+            tb.insert(
+                'script', self.repo.create_blob(script),
+                pygit2.GIT_FILEMODE_BLOB)
+            if after is not None:
+                tb.insert(
+                    'after', self.repo.create_blob(after),
+                    pygit2.GIT_FILEMODE_BLOB)
+            return tb.write()
+
+        steps_tb = self.repo.TreeBuilder()
+        steps_tb.insert(
+            'build', self.repo.create_blob(b'make'), pygit2.GIT_FILEMODE_BLOB)
+        steps_tb.insert(
+            'lint', step_tree(b'flake8'), pygit2.GIT_FILEMODE_TREE)
+        steps_tb.insert(
+            'test', step_tree(b'make test', b'build\nlint\n'),
+            pygit2.GIT_FILEMODE_TREE)
+        tb = self.repo.TreeBuilder()
+        tb.insert('steps', steps_tb.write(), pygit2.GIT_FILEMODE_TREE)
+        tree = self.repo[tb.write()]
+
+        spec = build.BuildSpec.from_tree(self.repo, 'test', None, tree)
+        self.assertEqual(spec.steps, {
+            'build': build.BuildStep(script=b'make'),
+            'lint': build.BuildStep(script=b'flake8', after=()),
+            'test': build.BuildStep(
+                script=b'make test', after=('build', 'lint')),
+        })
+        self.assertEqual(spec.dependencies(), {
+            'build': set(), 'lint': set(), 'test': {'build', 'lint'}})
+
+
+class BuildSpecDependenciesTestCase(unittest.TestCase):
+    def spec(self, **steps):
+        return build.BuildSpec(name='foo', oid=None, env=None, steps={
+            name: build.BuildStep(script=b'true', after=after)
+            for name, after in steps.items()
+        })
+
+    def test_steps_without_dependencies_run_in_sequence(self):
+        self.assertEqual(self.spec(a=None, b=None, c=None).dependencies(), {
+            'a': set(), 'b': {'a'}, 'c': {'b'}})
+
+    def test_declared_dependencies(self):
+        self.assertEqual(self.spec(a=(), b=(), c=('a', 'b')).dependencies(), {
+            'a': set(), 'b': set(), 'c': {'a', 'b'}})
+
+    def test_unknown_dependency_raises_spec_error(self):
+        with self.assertRaises(build.SpecError):
+            self.spec(a=('z',)).dependencies()
+
+    def test_cyclic_dependencies_raise_spec_error(self):
+        with self.assertRaises(build.SpecError):
+            self.spec(a=('c',), b=('a',), c=('b',)).dependencies()
+        with self.assertRaises(build.SpecError):
+            self.spec(a=('a',)).dependencies()
+
+
+class BuildSpecExecuteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.o = order.Order(
+            spec_uri='/tmp/fake/local/dir',
+            spec_ref='build0',
+            desc='test',
+            source_uri='git://example.org/foo/bar',
+            source_args=['abcdef0']
+        ).assign('bob')
+        self.addCleanup(
+            build.BuildSpec.set_parallelism, build.BuildSpec.parallelism)
+
+    def execute(self, steps, parallelism):
+        build.BuildSpec.set_parallelism(parallelism)
+        bs = build.BuildSpec(name='foo', oid=None, env=None, steps={
+            name: build.BuildStep(script=script, after=after)
+            for name, (script, after) in steps.items()
+        })
+        with tempfile.TemporaryDirectory() as cwd, \
+                unittest.mock.patch.object(build_report, 'BuildReport') as m:
+            bs.execute(order=self.o, source_oid=None, cwd=cwd)
+        return m.call_args[1]['step_reports']
+
+    def test_independent_steps_run_concurrently(self):
+        # each step waits (for up to 10s) for the other to start
+        wait = b'touch {}; for i in $(seq 1000); do ' \
+            b'[ -e {} ] && exit 0; sleep 0.01; done; exit 1'
+        reports = self.execute({
+            'a': (wait.replace(b'{}', b'a', 1).replace(b'{}', b'b'), ()),
+            'b': (wait.replace(b'{}', b'b', 1).replace(b'{}', b'a'), ()),
+            'c': (b'true', ('a', 'b')),
+        }, parallelism=2)
+        self.assertEqual(
+            {name: r.exit for name, r in reports.items()},
+            {'a': 0, 'b': 0, 'c': 0})
+
+    def test_dependent_step_runs_after_its_dependencies(self):
+        reports = self.execute({
+            'a': (b'sleep 0.1; touch a', ()),
+            'b': (b'test -e a', ('a',)),
+        }, parallelism=2)
+        self.assertEqual(reports['b'].exit, 0)
+
+    def test_no_steps_started_after_failure(self):
+        reports = self.execute({
+            'a': (b'false', ()),
+            'b': (b'true', ()),
+            'c': (b'true', ('a',)),
+        }, parallelism=1)
+        self.assertEqual(list(reports), ['a'])
+        self.assertEqual(reports['a'].exit, 1)
+
 
 class BuildSpecTestCase(unittest.TestCase):
     def setUp(self):
@@ -131,3 +245,40 @@ class BuildSpecTestCase(unittest.TestCase):
         with unittest.mock.patch.object(build_report, 'BuildReport') as mock:
             br = bs.execute(order=o, source_oid=None, cwd='.')
         self.assertEqual(mock.call_args[1]['env'], expected, 'overrides env')
+
+    def test_execute_passes_step_output_to_log(self):
+        o = self.o.assign('bob')
+        bs = build.BuildSpec(name='foo', oid=None, env=None, steps={
+            'a': build.BuildStep(script=b'echo out; echo err >&2'),
+            'b': build.BuildStep(script=b'echo done'),
+        })
+        log = unittest.mock.Mock()
+        with unittest.mock.patch.object(build_report, 'BuildReport'):
+            bs.execute(order=o, source_oid=None, cwd='.', log=log)
+        self.assertEqual(sorted(log.call_args_list), [
+            unittest.mock.call('a', 'stderr', b'err\n'),
+            unittest.mock.call('a', 'stdout', b'out\n'),
+            unittest.mock.call('b', 'stdout', b'done\n'),
+        ])
+
+    def test_reuse_runs_no_steps_and_keeps_step_reports(self):
+        o = self.o.assign('bob')
+        step = unittest.mock.Mock(spec_set=build.BuildStep)
+        bs = build.BuildSpec(name='foo', oid=None, env=None, steps={'a': step})
+        report = unittest.mock.Mock()
+        with unittest.mock.patch.object(build_report, 'BuildReport') as mock:
+            bs.reuse(order=o, source_oid=None, report=report, cached='abc')
+        step.execute.assert_not_called()
+        kwargs = mock.call_args[1]
+        self.assertEqual(kwargs['step_reports'], report.step_reports)
+        self.assertEqual(kwargs['cached'], 'abc')
+        self.assertEqual(kwargs['order'].worker, 'bob')
+        self.assertTrue(kwargs['order'].completed)
+
+    def test_reuse_with_completed_order_raises_spec_error(self):
+        o = self.o.assign('bob').complete()
+        with self.assertRaises(build.SpecError):
+            self.bs.reuse(
+                order=o, source_oid=None,
+                report=unittest.mock.Mock(), cached=None
+            )
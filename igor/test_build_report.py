@@ -23,6 +23,7 @@ from . import build
 from . import build_report
 from . import git
 from . import order
+from . import spool
 from . import test
 
 order = order.Order(
@@ -68,6 +69,16 @@ class BuildStepReportTestCase(test.EmptyRepoTestCase):
             pass_bsr
         )
 
+    def test_spooled_output_compared_and_shown_by_content(self):
+        outputs = {}
+        for name in ('stdout', 'stderr'):
+            outputs[name] = spool.Spool()
+            outputs[name].write(pass_map[name])
+            outputs[name].finish()
+        bsr = build_report.BuildStepReport(**dict(pass_map, **outputs))
+        self.assertEqual(bsr, pass_bsr)
+        self.assertEqual(repr(bsr), repr(pass_bsr))
+
     def test_ok_return_true_if_exit_code_is_zero(self):
         self.assertTrue(pass_bsr.ok())
 
@@ -198,3 +209,18 @@ class BuildReportTestCase(test.EmptyRepoTestCase):
         ):
             self.assertEqual(getattr(br, name), getattr(br2, name), name)
         self.assertEqual(br, br2)
+
+    def test_write_then_read_yields_cached_and_foreign_source(self):
+        br = build_report.BuildReport(
+            name='foo',
+            order=order.assign('bob').complete(),
+            spec_oid=self.spec_oid,
+            source_oid=pygit2.Oid(hex='ab' * 20),
+            env={},
+            step_reports={'100': pass_bsr},
+            cached=self.source_oid
+        )
+        oid = br.write(self.repo, self.repo.null_report())
+        br2 = build_report.BuildReport.from_commit(self.repo, oid)
+        self.assertEqual(br2.source_oid, br.source_oid)
+        self.assertEqual(br2.cached, self.source_oid)
@@ -14,7 +14,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import os
 import tempfile
+import unittest
+import unittest.mock
 
 import pygit2
 
@@ -22,6 +26,51 @@ from . import build_source
 from . import test
 
 
+class GetForUriTestCase(unittest.TestCase):
+    def setUp(self):
+        self.foo = unittest.mock.Mock()
+        self.bar = unittest.mock.Mock()
+        self.foo.handles_uri.return_value = False
+        self.bar.handles_uri.return_value = True
+        impls = collections.OrderedDict([('foo', self.foo), ('bar', self.bar)])
+        patcher = unittest.mock.patch.object(
+            build_source.BuildSource, 'impls', impls)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(build_source.BuildSource.set_probe_cache, None)
+
+    def test_probes_impls_in_order(self):
+        source = build_source.BuildSource.get_for_uri('/src', 'rev')
+        self.assertIs(source, self.bar.return_value)
+        self.bar.assert_called_once_with('/src', 'rev')
+        self.foo.handles_uri.assert_called_once_with('/src')
+
+    def test_source_type_skips_probe(self):
+        source = build_source.BuildSource.get_for_uri(
+            '/src', 'rev', source_type='foo')
+        self.assertIs(source, self.foo.return_value)
+        self.assertFalse(self.foo.handles_uri.called)
+        self.assertFalse(self.bar.handles_uri.called)
+
+    def test_probe_cache_records_and_skips_probe(self):
+        probes = unittest.mock.Mock()
+        probes.get.return_value = None
+        build_source.BuildSource.set_probe_cache(probes)
+        build_source.BuildSource.get_for_uri('/src')
+        probes.put.assert_called_once_with('/src', 'bar')
+
+        probes.get.return_value = 'bar'
+        self.bar.handles_uri.reset_mock()
+        build_source.BuildSource.get_for_uri('/src')
+        self.assertFalse(self.bar.handles_uri.called)
+        self.assertEqual(self.bar.call_count, 2)
+
+    def test_raises_if_no_impl_handles_uri(self):
+        self.bar.handles_uri.return_value = False
+        with self.assertRaises(RuntimeError):
+            build_source.BuildSource.get_for_uri('/src')
+
+
 class GitBuildSourceTestCase(test.EmptyRepoTestCase):
     def setUp(self):
         super().setUp()
@@ -29,8 +78,11 @@ class GitBuildSourceTestCase(test.EmptyRepoTestCase):
         self._commit = self._oid.hex[:7]
         self.repo.create_reference('refs/heads/master', self._oid)
         self._target_dir = tempfile.TemporaryDirectory()
+        self._mirror_dir = tempfile.TemporaryDirectory()
 
     def tearDown(self):
+        build_source.GitBuildSource.set_mirror_root(None)
+        self._mirror_dir.cleanup()
         self._target_dir.cleanup()
         super().tearDown()
 
@@ -46,3 +98,66 @@ class GitBuildSourceTestCase(test.EmptyRepoTestCase):
         bs.checkout(self._target_dir.name)
         repo = pygit2.Repository(self._target_dir.name)
         self.assertIn(self._oid, repo)
+
+    def test_mirror_clone_shares_mirror_objects(self):
+        build_source.GitBuildSource.set_mirror_root(self._mirror_dir.name)
+        bs = build_source.GitBuildSource(self.repo.path, self._commit)
+        self.assertEqual(bs.checkout(self._target_dir.name), self._oid)
+        repo = pygit2.Repository(self._target_dir.name)
+        self.assertIn(self._oid, repo)
+        alternates = os.path.join(
+            self._target_dir.name, '.git', 'objects', 'info', 'alternates')
+        with open(alternates) as f:
+            self.assertTrue(f.read().startswith(self._mirror_dir.name))
+
+    def test_mirror_reused_between_checkouts(self):
+        build_source.GitBuildSource.set_mirror_root(self._mirror_dir.name)
+        bs = build_source.GitBuildSource(self.repo.path, self._commit)
+        with tempfile.TemporaryDirectory() as dest:
+            bs.checkout(dest)
+        mirror = bs.mirror()
+        bs.checkout(self._target_dir.name)
+        self.assertEqual(
+            [name for name in os.listdir(self._mirror_dir.name)
+             if name.endswith('.git')],
+            [os.path.basename(mirror)]
+        )
+
+    def commit(self, name):
+        """Commit an empty file of the given name on master."""
+        tb = self.repo.TreeBuilder(self.repo[self._oid].tree)
+        tb.insert(name, self.repo.create_blob(b''), pygit2.GIT_FILEMODE_BLOB)
+        self._oid = self.repo.create_commit(
+            'refs/heads/master', 'add ' + name, tb.write(), [self._oid])
+        return self._oid
+
+    def test_update_empty_dest_checks_out(self):
+        build_source.GitBuildSource.set_mirror_root(self._mirror_dir.name)
+        bs = build_source.GitBuildSource(self.repo.path, 'master')
+        self.assertEqual(bs.update(self._target_dir.name), self._oid)
+
+    def test_update_fetches_and_resets_earlier_checkout(self):
+        build_source.GitBuildSource.set_mirror_root(self._mirror_dir.name)
+        dest = self._target_dir.name
+        bs = build_source.GitBuildSource(self.repo.path, 'master')
+        bs.update(dest)
+        oid = self.commit('new')
+        with open(os.path.join(dest, 'untracked'), 'w'):
+            pass
+        self.assertEqual(bs.update(dest), oid)
+        self.assertTrue(os.path.exists(os.path.join(dest, 'new')))
+        self.assertFalse(os.path.exists(os.path.join(dest, 'untracked')))
+
+    def test_update_keeps_ignored_files_unless_clean_all(self):
+        build_source.GitBuildSource.set_mirror_root(self._mirror_dir.name)
+        dest = self._target_dir.name
+        bs = build_source.GitBuildSource(self.repo.path, 'master')
+        bs.update(dest)
+        with open(os.path.join(dest, '.git', 'info', 'exclude'), 'w') as f:
+            f.write('output\n')
+        with open(os.path.join(dest, 'output'), 'w'):
+            pass
+        bs.update(dest)
+        self.assertTrue(os.path.exists(os.path.join(dest, 'output')))
+        bs.update(dest, clean=build_source.CLEAN_ALL)
+        self.assertFalse(os.path.exists(os.path.join(dest, 'output')))
@@ -0,0 +1,196 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+from . import cache
+
+
+def fake_clone_or_open(uri, path, size=1000):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'pack'), 'wb') as f:
+        f.write(b'\0' * size)
+    return unittest.mock.Mock(path=path)
+
+
+@unittest.mock.patch(
+    cache.__name__ + '.git.Repository.clone_or_open',
+    side_effect=fake_clone_or_open
+)
+class RepoCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = cache.RepoCache(self.tmpdir.name, max_size=2500)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_path_is_stable_and_under_root(self, mock):
+        path = self.cache.path('git://example.org/foo')
+        self.assertEqual(path, self.cache.path('git://example.org/foo'))
+        self.assertEqual(os.path.dirname(path), self.tmpdir.name)
+        self.assertNotEqual(path, self.cache.path('git://example.org/bar'))
+
+    def test_key_does_not_depend_on_hash_seed(self, mock):
+        self.assertEqual(
+            cache.RepoCache.key('git://example.org/foo'),
+            '7f91107dbc62588d52a5f6fdb33968dee67c612813f3cc3de55d51fb3b9231bc'
+        )
+
+    def test_local_paths_normalised(self, mock):
+        self.assertEqual(
+            self.cache.path('.'), self.cache.path(os.path.abspath('.')))
+
+    def test_open_counts_misses_and_hits(self, mock):
+        with self.cache.open('git://example.org/foo'):
+            pass
+        with self.cache.open('git://example.org/foo'):
+            pass
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertEqual(stats['repos'], 1)
+        self.assertEqual(stats['size'], 1000)
+
+    def test_evicts_least_recently_used_above_max_size(self, mock):
+        for uri in ('/a', '/b', '/c', '/a'):
+            with self.cache.open(uri):
+                pass
+        self.assertTrue(os.path.isdir(self.cache.path('/a')))
+        self.assertFalse(os.path.isdir(self.cache.path('/b')))
+        self.assertTrue(os.path.isdir(self.cache.path('/c')))
+        self.assertEqual(self.cache.stats()['repos'], 2)
+        self.assertEqual(self.cache.uris(), ['/a', '/c'])
+
+    def test_repo_in_use_not_evicted(self, mock):
+        with self.cache.open('/a'):
+            with self.cache.open('/b'):
+                pass
+            with self.cache.open('/c'):
+                pass
+            self.assertTrue(os.path.isdir(self.cache.path('/a')))
+        self.assertEqual(self.cache.stats()['size'], 2000)
+
+    def test_users_of_same_repo_overlap(self, mock):
+        inside = threading.Event()
+        release = threading.Event()
+
+        def first():
+            with self.cache.open('/a'):
+                inside.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=first)
+        thread.start()
+        try:
+            self.assertTrue(inside.wait(5))
+            with self.cache.open('/a'):
+                self.assertTrue(thread.is_alive())  # first still inside
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(mock.call_count, 2)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+
+class ProbeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.probes = cache.ProbeCache(
+            os.path.join(self.tmpdir.name, 'probes.json'), ttl=60)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get_unknown_uri_returns_none(self):
+        self.assertIsNone(self.probes.get('git://example.org/foo'))
+
+    def test_put_shared_with_other_instances(self):
+        self.probes.put('git://example.org/foo', 'git')
+        other = cache.ProbeCache(self.probes.path)
+        self.assertEqual(other.get('git://example.org/foo'), 'git')
+
+    def test_record_expires_after_ttl(self):
+        self.probes.put('git://example.org/foo', 'git', now=1000)
+        self.assertEqual(
+            self.probes.get('git://example.org/foo', now=1059), 'git')
+        self.assertIsNone(self.probes.get('git://example.org/foo', now=1060))
+
+
+class WorkspacePoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.pool = cache.WorkspacePool(self.tmpdir.name, max_workspaces=2)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_workspace_reused_for_same_source_and_spec(self):
+        with self.pool.open('/src', 'build0') as path:
+            with open(os.path.join(path, 'output'), 'w'):
+                pass
+        with self.pool.open('/src', 'build0') as path2:
+            self.assertEqual(path2, path)
+            self.assertTrue(os.path.exists(os.path.join(path, 'output')))
+        with self.pool.open('/src', 'build1') as path3:
+            self.assertNotEqual(path3, path)
+        stats = self.pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertEqual(stats['workspaces'], 2)
+
+    def test_workspace_in_use_gives_fresh_workspace_retired_after(self):
+        with self.pool.open('/src', 'build0') as path:
+            with self.pool.open('/src', 'build0') as path2:
+                self.assertNotEqual(path2, path)
+                self.assertEqual(os.listdir(path2), [])
+            self.assertFalse(os.path.exists(path2))
+        self.assertEqual(self.pool.stats()['busy'], 1)
+
+    def test_evicts_least_recently_used_above_max_workspaces(self):
+        for spec_ref in ('a', 'b', 'c', 'a'):
+            with self.pool.open('/src', spec_ref):
+                pass
+        self.assertTrue(os.path.isdir(self.pool.path('/src', 'a')))
+        self.assertFalse(os.path.isdir(self.pool.path('/src', 'b')))
+        self.assertTrue(os.path.isdir(self.pool.path('/src', 'c')))
+        self.assertEqual(self.pool.stats()['workspaces'], 2)
+
+    def test_workspace_in_use_not_evicted(self):
+        with self.pool.open('/src', 'a') as path:
+            for spec_ref in ('b', 'c'):
+                with self.pool.open('/src', spec_ref):
+                    pass
+            self.assertTrue(os.path.isdir(path))
+        self.assertFalse(os.path.isdir(self.pool.path('/src', 'b')))
+
+    def test_retired_workspace_deleted_in_background(self):
+        path = os.path.join(self.tmpdir.name, 'old')
+        os.makedirs(os.path.join(path, 'build'))
+        self.pool.retire(path).join()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(
+            os.listdir(os.path.join(self.tmpdir.name, self.pool.TRASH)), [])
+
+    def test_sweep_deletes_retired_workspaces(self):
+        trash = os.path.join(self.tmpdir.name, self.pool.TRASH)
+        os.makedirs(os.path.join(trash, 'x', 'build'))
+        with unittest.mock.patch.object(cache, 'delete_in_background') as m:
+            self.assertEqual(self.pool.sweep(), 1)
+        m.assert_called_once_with(os.path.join(trash, 'x'))
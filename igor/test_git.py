@@ -14,8 +14,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import subprocess
 import tempfile
 import unittest
+import unittest.mock
+
+import pygit2
 
 from . import git
 from . import test
@@ -96,6 +100,31 @@ class RepositoryTestCase(test.EmptyRepoTestCase):
                 newoid
             )
 
+    def test_fetch_ref_overwrites_only_that_ref(self):
+        oid = self.repo.null_report()
+        self.repo.create_reference('refs/ci/report/foo', oid)
+        self.repo.create_reference('refs/ci/report/bar', oid)
+        with tempfile.TemporaryDirectory() as name:
+            newrepo = git.Repository.clone(self.repo.path, name)
+            tree = self.repo[oid].tree.oid
+            foo = self.repo.create_commit(
+                'refs/ci/report/foo', 'later foo', tree, [oid])
+            bar = self.repo.create_commit(
+                'refs/ci/report/bar', 'later bar', tree, [oid])
+            self.assertTrue(newrepo.fetch_ref('refs/ci/report/foo'))
+            self.assertEqual(
+                newrepo.lookup_reference('refs/ci/report/foo').target, foo)
+            self.assertNotIn(bar, newrepo)
+
+    def test_fetch_ref_missing_on_remote_leaves_local_ref(self):
+        with tempfile.TemporaryDirectory() as name:
+            newrepo = git.Repository.clone(self.repo.path, name)
+            oid = newrepo.null_report()
+            newrepo.create_reference('refs/ci/report/foo', oid)
+            self.assertTrue(newrepo.fetch_ref('refs/ci/report/foo'))
+            self.assertEqual(
+                newrepo.lookup_reference('refs/ci/report/foo').target, oid)
+
     def test_fetch_fetches_ci_spec_and_ci_report_refs(self):
         oid = self.repo.null_report()
         self.repo.create_reference('refs/ci/spec/foo', oid)
@@ -112,6 +141,34 @@ class RepositoryTestCase(test.EmptyRepoTestCase):
                 oid
             )
 
+    @unittest.mock.patch.object(git.RemoteSession, 'fetch')
+    def test_fetch_coalesced_within_window(self, fetch):
+        self.assertTrue(self.repo.fetch())
+        self.assertFalse(self.repo.fetch())
+        self.assertTrue(self.repo.fetch(window=-1))
+        self.assertEqual(fetch.call_count, 2)
+
+    @unittest.mock.patch.object(git.RemoteSession, 'fetch')
+    def test_fetch_coalesced_between_repository_objects(self, fetch):
+        other = git.Repository(self.repo.path)
+        self.assertTrue(self.repo.fetch())
+        self.assertFalse(other.fetch())
+        self.assertEqual(fetch.call_count, 1)
+
+    @unittest.mock.patch.object(git.RemoteSession, 'fetch')
+    def test_fetch_not_coalesced_with_earlier_fetch_if_window_zero(
+        self, fetch
+    ):
+        self.assertTrue(self.repo.fetch())
+        self.assertTrue(self.repo.fetch(window=0))
+
+    @unittest.mock.patch.object(
+        git.RemoteSession, 'fetch', side_effect=[False, True])
+    def test_failed_fetch_not_coalesced(self, fetch):
+        self.assertFalse(self.repo.fetch())
+        self.assertTrue(self.repo.fetch())
+        self.assertEqual(fetch.call_count, 2)
+
     def test_clone_or_open_clones_missing_repo(self):
         oid = self.repo.null_report()
         self.repo.create_reference('refs/ci/report/foo', oid)
@@ -195,6 +252,64 @@ class RepositoryTestCase(test.EmptyRepoTestCase):
             )
 
 
+class RemoteSessionTestCase(test.EmptyRepoTestCase):
+    """Sessions of a repository whose origin is the (local) test repo."""
+    def setUp(self):
+        super().setUp()
+        self._local = tempfile.TemporaryDirectory()
+        pygit2.init_repository(self._local.name, True)
+        subprocess.check_call([
+            'git', '--git-dir', self._local.name,
+            'remote', 'add', 'origin', self.repo.path])
+        self.local = git.Repository(self._local.name)
+        self.oid = self.local.null_report()
+
+    def tearDown(self):
+        self._local.cleanup()
+        super().tearDown()
+
+    def later(self, repo, parent, message='later'):
+        return repo.create_commit(
+            None, message, repo.null_tree(), [parent])
+
+    def test_session_kept_per_remote(self):
+        self.assertIs(self.local.session(), self.local.session())
+        self.assertEqual(self.local.session().remote.name, 'origin')
+
+    def test_push_then_fetch_back_to_back(self):
+        session = self.local.session()
+        ref = 'refs/ci/report/foo'
+        self.assertTrue(session.push('{}:{}'.format(self.oid.hex, ref)))
+        self.assertEqual(self.repo.lookup_reference(ref).target, self.oid)
+        newoid = self.later(self.repo, self.oid)
+        self.repo.create_reference(ref, newoid, force=True)
+        self.assertTrue(self.local.fetch_ref(ref))
+        self.assertEqual(self.local.lookup_reference(ref).target, newoid)
+        stats = session.stats()
+        self.assertEqual(stats['push']['count'], 1)
+        self.assertEqual(stats['fetch']['count'], 1)
+        self.assertGreaterEqual(stats['push']['max'], 0)
+
+    def test_push_not_fast_forward_returns_false(self):
+        ref = 'refs/ci/report/foo'
+        self.assertTrue(self.local.push('{}:{}'.format(self.oid.hex, ref)))
+        theirs = self.later(self.repo, self.oid, 'theirs')
+        self.repo.create_reference(ref, theirs, force=True)
+        ours = self.later(self.local, self.oid, 'ours')
+        self.assertFalse(self.local.push('{}:{}'.format(ours.hex, ref)))
+        self.assertEqual(self.repo.lookup_reference(ref).target, theirs)
+
+    def test_push_falls_back_to_git_if_native_push_fails(self):
+        session = self.local.session()
+        remote = unittest.mock.Mock()
+        remote.push.side_effect = pygit2.GitError('unsupported')
+        session._remote = remote
+        ref = 'refs/ci/report/foo'
+        with self.assertLogs(git.logger):
+            self.assertTrue(session.push('{}:{}'.format(self.oid.hex, ref)))
+        self.assertEqual(self.repo.lookup_reference(ref).target, self.oid)
+
+
 class RefUtilTestCase(unittest.TestCase):
     def test_split_ref(self):
         self.assertEqual(
@@ -179,3 +179,79 @@ class OrderTestCase(unittest.TestCase):
             self.assertEqual(o.completed, t_string)
 
     # TODO tests to write/read repo
+
+
+class PublishTestCase(unittest.TestCase):
+    def setUp(self):
+        self.order = order.Order(
+            spec_uri='/fake/local/dir',
+            spec_ref='build0',
+            desc='test',
+            source_uri='git://example.org/foo/bar',
+        )
+        self.repo = unittest.mock.Mock()
+        self.report = unittest.mock.Mock()
+        self.ref = 'refs/ci/report/build0'
+        patcher = unittest.mock.patch.object(
+            order.Order, '_prev_oid', return_value=unittest.mock.MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = unittest.mock.patch('time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_backoff_is_jittered_and_capped(self):
+        for attempt in range(1, 20):
+            delay = order.backoff(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(
+                order.PUSH_BACKOFF_MAX,
+                order.PUSH_BACKOFF * 2 ** (attempt - 1)))
+
+    def test_first_push_neither_fetches_nor_sleeps(self):
+        self.repo.push.return_value = True
+        publish = self.order._publish(self.repo, self.ref, self.report)
+        self.assertEqual(publish['attempts'], 1)
+        self.repo.fetch_ref.assert_not_called()
+        self.sleep.assert_not_called()
+
+    def test_rejected_push_fetches_ref_and_rewrites_commit_only(self):
+        self.repo.push.side_effect = [False, False, True]
+        publish = self.order._publish(self.repo, self.ref, self.report)
+        self.assertEqual(publish['attempts'], 3)
+        self.assertEqual(self.repo.fetch_ref.call_args_list, [
+            unittest.mock.call(self.ref)] * 2)
+        self.repo.fetch.assert_not_called()
+        self.report.write_tree.assert_called_once_with(self.repo)
+        tree = self.report.write_tree.return_value
+        self.assertEqual(self.report.write.call_count, 3)
+        for args, kwargs in self.report.write.call_args_list:
+            self.assertIs(kwargs['tree'], tree)
+        self.assertEqual(self.sleep.call_count, 2)
+        # the local ref is only moved to the commit that was pushed
+        commit = self.report.write.return_value
+        self.repo.create_reference.assert_called_once_with(
+            self.ref, commit, force=True)
+        self.assertEqual(
+            self.repo.push.call_args,
+            unittest.mock.call('{}:{}'.format(commit.hex, self.ref)))
+
+    def test_gives_up_after_push_attempts(self):
+        self.repo.push.return_value = False
+        with self.assertRaises(order.OrderError):
+            self.order._publish(self.repo, self.ref, self.report)
+        self.assertEqual(self.repo.push.call_count, order.PUSH_ATTEMPTS)
+
+    def test_incoming_pushes_report_commit_to_ref_of_order(self):
+        o = self.order.assign('w1')
+        self.repo.push.side_effect = [False, True]
+        publish = o._publish_incoming(self.repo, self.report)
+        self.assertEqual(publish['attempts'], 2)
+        self.report.write.assert_called_once_with(
+            self.repo, self.repo.null_report.return_value)
+        commit = self.report.write.return_value
+        ref = 'refs/ci/incoming/w1/build0/{}'.format(o.id)
+        self.assertEqual(o.incoming_ref(), ref)
+        self.assertEqual(self.repo.push.call_args, unittest.mock.call(
+            '{}:{}'.format(commit.hex, ref)))
+        self.repo.fetch_ref.assert_not_called()
@@ -0,0 +1,130 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import unittest.mock
+
+import pygit2
+
+from . import build_report
+from . import order
+from . import result_cache
+from . import test
+
+order = order.Order(
+    spec_uri='/fake/local/dir',
+    spec_ref='build0',
+    desc='test',
+    source_uri='git://example.org/foo/bar',
+)
+
+pass_bsr = build_report.BuildStepReport(
+    exit=0, t_start=1000.1, t_finish=2000.2, stdout=b'', stderr=b'')
+fail_bsr = build_report.BuildStepReport(
+    exit=1, t_start=1000.1, t_finish=2000.2, stdout=b'', stderr=b'')
+
+
+class ResultCacheTestCase(test.EmptyRepoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = result_cache.ResultCache(env_keys=['CC'])
+        self.spec_oid = self.repo.create_commit(
+            None, 'bogo spec', self.repo.null_tree(), [])
+        self.source_oid = self.repo.create_commit(
+            None, 'bogo source', self.repo.null_tree(), [])
+        self.prev_oid = self.repo.null_report()
+
+    def report(self, *, step_reports=None, env=None, cached=None):
+        """Write a report of the bogo spec and source and update the ref."""
+        report = build_report.BuildReport(
+            spec_oid=self.spec_oid,
+            source_oid=self.source_oid,
+            name='build0',
+            order=order.assign('bob').complete(),
+            env=env or {'CC': 'gcc', 'HOME': '/home/bob'},
+            step_reports=step_reports or {'10': pass_bsr},
+            cached=cached
+        )
+        self.prev_oid = report.write(self.repo, self.prev_oid)
+        self.repo.create_reference(
+            'refs/ci/report/build0', self.prev_oid, force=True)
+        return self.prev_oid
+
+    def key(self, env=None):
+        return self.cache.key(
+            spec_tree=self.repo[self.spec_oid].tree.oid,
+            source_oid=self.source_oid,
+            env=env or {'CC': 'gcc'}
+        )
+
+    def test_key_ignores_other_environment_variables(self):
+        self.assertEqual(self.key({'CC': 'gcc', 'HOME': '/'}), self.key())
+        self.assertNotEqual(self.key({'CC': 'clang'}), self.key())
+
+    def test_lookup_finds_passing_report(self):
+        oid = self.report()
+        self.assertEqual(self.cache.lookup(self.repo, self.key()), oid)
+
+    def test_lookup_ignores_failing_report(self):
+        self.report(step_reports={'10': pass_bsr, '20': fail_bsr})
+        self.assertIsNone(self.cache.lookup(self.repo, self.key()))
+
+    def test_lookup_misses_other_environment(self):
+        self.report(env={'CC': 'clang'})
+        self.assertIsNone(self.cache.lookup(self.repo, self.key()))
+
+    def test_lookup_finds_newest_report(self):
+        self.report()
+        self.assertEqual(self.cache.update(self.repo), 1)
+        oid = self.report(step_reports={'10': pass_bsr, '20': pass_bsr})
+        self.assertEqual(self.cache.lookup(self.repo, self.key()), oid)
+
+    def test_update_indexes_only_new_reports(self):
+        self.report()
+        self.assertEqual(self.cache.update(self.repo), 1)
+        self.assertEqual(self.cache.update(self.repo), 0)
+        self.report()
+        self.assertEqual(self.cache.update(self.repo), 1)
+
+    def test_lookup_writes_index_only_when_changed(self):
+        oid = self.report()
+        with unittest.mock.patch.object(
+            result_cache.os, 'rename', wraps=os.rename
+        ) as rename:
+            self.assertEqual(self.cache.lookup(self.repo, self.key()), oid)
+            self.assertEqual(self.cache.lookup(self.repo, self.key()), oid)
+        self.assertEqual(rename.call_count, 1)
+
+    def test_lookup_resolves_reused_report_to_original(self):
+        oid = self.report()
+        self.report(cached=oid)
+        self.assertEqual(self.cache.lookup(self.repo, self.key()), oid)
+
+    def test_index_rebuilt_for_other_environment_variables(self):
+        self.report(env={'CC': 'gcc', 'CFLAGS': '-O2'})
+        self.cache.update(self.repo)
+        cache = result_cache.ResultCache(env_keys=['CC', 'CFLAGS'])
+        key = cache.key(
+            spec_tree=self.repo[self.spec_oid].tree.oid,
+            source_oid=self.source_oid,
+            env={'CC': 'gcc', 'CFLAGS': '-O2'}
+        )
+        self.assertEqual(cache.lookup(self.repo, key), self.prev_oid)
+
+    def test_lookup_reads_source_outside_repo(self):
+        self.source_oid = pygit2.Oid(hex='ab' * 20)
+        oid = self.report()
+        self.assertEqual(self.cache.lookup(self.repo, self.key()), oid)
@@ -0,0 +1,126 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import subprocess
+import unittest
+import unittest.mock
+
+from . import spool
+
+
+class SpoolTestCase(unittest.TestCase):
+    def test_small_output_kept_in_memory(self):
+        s = spool.Spool(max_memory=10)
+        s.write(b'foo')
+        s.write(b'bar')
+        s.finish()
+        self.assertEqual(s.getvalue(), b'foobar')
+        self.assertFalse(s._on_disk)
+
+    def test_output_spilled_to_disk_above_max_memory(self):
+        s = spool.Spool(max_memory=4)
+        s.write(b'foo')
+        s.write(b'bar')
+        s.finish()
+        self.assertTrue(s._on_disk)
+        self.assertEqual(s.getvalue(), b'foobar')
+        s.close()
+
+    def test_output_within_max_size_not_truncated(self):
+        s = spool.Spool(max_size=6)
+        s.write(b'foobar')
+        s.finish()
+        self.assertEqual(s.getvalue(), b'foobar')
+
+    def test_output_above_max_size_keeps_head_and_tail(self):
+        s = spool.Spool(max_size=6)
+        for c in b'abcdefghijklmnop':
+            s.write(bytes([c]))
+        s.finish()
+        self.assertEqual(s.size, 16)
+        self.assertEqual(
+            s.getvalue(),
+            b'abc' + spool.OMITTED.format(10).encode('UTF-8') + b'nop')
+
+    def test_tail_wraps_around_ring_buffer(self):
+        s = spool.Spool(max_size=8)
+        s.write(b'abcdefg')
+        s.write(b'hijklmnopqrstu')
+        s.write(b'vw')
+        s.finish()
+        self.assertEqual(
+            s.getvalue(),
+            b'abcd' + spool.OMITTED.format(15).encode('UTF-8') + b'tuvw')
+
+    def test_tee_given_all_output(self):
+        chunks = []
+        s = spool.Spool(max_size=2, tee=chunks.append)
+        s.write(b'foo')
+        s.write(b'bar')
+        self.assertEqual(chunks, [b'foo', b'bar'])
+
+    def test_create_blob_from_disk_when_spilled(self):
+        repo = unittest.mock.Mock()
+        s = spool.Spool(max_memory=2)
+        s.write(b'foobar')
+        s.finish()
+        blob = s.create_blob(repo)
+        repo.create_blob_fromdisk.assert_called_once_with(s._file.name)
+        self.assertIs(blob, repo.create_blob_fromdisk.return_value)
+        self.assertFalse(repo.create_blob.called)
+
+    def test_create_blob_from_memory(self):
+        repo = unittest.mock.Mock()
+        s = spool.Spool()
+        s.write(b'foobar')
+        s.finish()
+        s.create_blob(repo)
+        repo.create_blob.assert_called_once_with(b'foobar')
+
+
+class CommunicateTestCase(unittest.TestCase):
+    def _run(self, script, **kwargs):
+        proc = subprocess.Popen(
+            ['/bin/sh'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        out, err = spool.Spool(**kwargs), spool.Spool(**kwargs)
+        status = spool.communicate(
+            proc, script, {proc.stdout: out, proc.stderr: err})
+        return status, out, err
+
+    def test_spools_stdout_and_stderr(self):
+        status, out, err = self._run(b'echo out; echo err >&2; exit 3')
+        self.assertEqual(status, 3)
+        self.assertEqual(out.getvalue(), b'out\n')
+        self.assertEqual(err.getvalue(), b'err\n')
+
+    def test_large_output_on_both_pipes(self):
+        status, out, err = self._run(
+            b'head -c 1000000 /dev/zero; head -c 1000000 /dev/zero >&2',
+            max_memory=2 ** 16
+        )
+        self.assertEqual(status, 0)
+        self.assertEqual((out.size, err.size), (1000000, 1000000))
+        self.assertEqual(out.getvalue(), bytes(1000000))
+
+    def test_output_capped(self):
+        status, out, err = self._run(b'seq 100000', max_size=100)
+        self.assertTrue(out.getvalue().startswith(b'1\n2\n'))
+        self.assertTrue(out.getvalue().endswith(b'99999\n100000\n'))
+        self.assertLess(len(out.getvalue()), 200)
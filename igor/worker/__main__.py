@@ -15,12 +15,109 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-import asyncore
+import asyncio
 import logging
 import multiprocessing
 import sys
+import tempfile
 
-from . import net
+from .. import build_source
+from .. import cache
+from .. import order
+from .. import result_cache
+from .. import spool
+from . import adaptive
+from . import protocol
+
+
+def configure_options(args, probe_cache):
+    """Return options for ``protocol.configure``."""
+    return {
+        'mirror_root': args.source_mirrors,
+        'probe_cache': probe_cache,
+        'spool_memory': args.spool_memory * 2 ** 10,
+        'max_output': args.max_output and args.max_output * 2 ** 20,
+        'step_parallelism': args.step_parallelism,
+        'result_cache': args.result_cache and result_cache.ResultCache(
+            env_keys=args.result_cache_env),
+        'workspace_pool': workspace_pool(args),
+        'publish': args.publish,
+    }
+
+
+def workspace_pool(args):
+    """Return the workspace pool, if workspaces are kept."""
+    if args.workspaces is None:
+        return None
+    return cache.WorkspacePool(
+        args.workspaces,
+        max_workspaces=args.max_workspaces,
+        clean=args.workspace_clean,
+    )
+
+
+def controller(args):
+    """Return the concurrency controller, if adaptive concurrency is on."""
+    if not args.adaptive:
+        return None
+    return adaptive.Controller(
+        minimum=args.min_concurrency,
+        maximum=args.concurrency,
+        target_load=args.target_load,
+        min_free_memory=args.min_free_memory * 2 ** 20,
+        min_free_disk=args.min_free_disk * 2 ** 20,
+        paths=disk_paths(args),
+    )
+
+
+def disk_paths(args):
+    """Return the directories that orders fill, to watch for free disk."""
+    paths = [tempfile.gettempdir(), args.repo_cache]
+    paths.extend(
+        path for path in (args.source_mirrors, args.workspaces) if path)
+    return paths
+
+
+def worker_options(args):
+    """Return keyword arguments common to the workers of each engine."""
+    return {
+        'controller': controller(args),
+        'prefetch': args.prefetch,
+        'host': args.host,
+        'port': args.port,
+        'concurrency': args.concurrency,
+        'heartbeat_interval': args.heartbeat_interval,
+        'log_interval': args.log_interval,
+        'repo_cache': cache.RepoCache(
+            args.repo_cache, max_size=args.repo_cache_size * 2 ** 20),
+    }
+
+
+def run_pool(args, probe_cache):
+    import asyncore
+    from . import net
+    # orders are prefetched in threads of this process
+    protocol.configure(**configure_options(args, probe_cache))
+    log_queue = None
+    if args.log_interval > 0:
+        log_queue = multiprocessing.Queue(net.LOG_QUEUE_SIZE)
+    with multiprocessing.Pool(
+        args.concurrency,
+        initializer=net.init_process,
+        initargs=(log_queue, configure_options(args, probe_cache))
+    ) as pool:
+        worker = net.Worker(
+            pool=pool, log_queue=log_queue, **worker_options(args))
+        while asyncore.socket_map:
+            asyncore.loop(timeout=worker.poll_interval, count=1)
+            worker.poll()
+
+
+async def run_asyncio(args, probe_cache):
+    from . import aionet
+    protocol.configure(**configure_options(args, probe_cache))
+    worker = aionet.Worker(**worker_options(args))
+    await worker.run()
 
 
 def main():
@@ -31,6 +128,118 @@ def main():
     parser.add_argument(
         '--port', type=int, default=1602,
         help='port of igor-ci server')
+    parser.add_argument(
+        '--engine', choices=('pool', 'asyncio'), default='pool',
+        help='execute orders in a pool of processes, or in threads of '
+             'the worker process driven by asyncio (default: pool)')
+    parser.add_argument(
+        '--concurrency', type=int, default=multiprocessing.cpu_count(),
+        metavar='N',
+        help='execute up to N orders at once (default: number of CPUs)')
+    parser.add_argument(
+        '--prefetch', action='store_true',
+        help='accept an extra order per slot and bring its repositories '
+             'up to date while waiting for the slot')
+    parser.add_argument(
+        '--adaptive', action='store_true',
+        help='vary the number of orders executed at once, between '
+             '--min-concurrency and --concurrency, with the load average, '
+             'available memory and free disk space')
+    parser.add_argument(
+        '--min-concurrency', type=int, default=1, metavar='N',
+        help='with --adaptive, execute at least N orders at once '
+             '(default: 1)')
+    parser.add_argument(
+        '--target-load', type=float, metavar='LOAD',
+        help='with --adaptive, take fewer orders while the load average '
+             'exceeds LOAD (default: number of CPUs)')
+    parser.add_argument(
+        '--min-free-memory', type=int, metavar='MIB',
+        default=adaptive.MIN_FREE_MEMORY // 2 ** 20,
+        help='with --adaptive, take fewer orders while less than MIB MiB '
+             'of memory is available (default: {})'.format(
+                 adaptive.MIN_FREE_MEMORY // 2 ** 20))
+    parser.add_argument(
+        '--min-free-disk', type=int, metavar='MIB',
+        default=adaptive.MIN_FREE_DISK // 2 ** 20,
+        help='with --adaptive, take fewer orders while less than MIB MiB '
+             'of disk is free (default: {})'.format(
+                 adaptive.MIN_FREE_DISK // 2 ** 20))
+    parser.add_argument(
+        '--heartbeat-interval', type=float,
+        default=protocol.HEARTBEAT_INTERVAL, metavar='SECONDS',
+        help='seconds between heartbeats while executing orders '
+             '(default: {})'.format(protocol.HEARTBEAT_INTERVAL))
+    parser.add_argument(
+        '--repo-cache', default=cache.DEFAULT_ROOT, metavar='DIR',
+        help='directory in which to cache spec repos '
+             '(default: {})'.format(cache.DEFAULT_ROOT))
+    parser.add_argument(
+        '--repo-cache-size', type=int, metavar='MIB',
+        default=cache.DEFAULT_MAX_SIZE // 2 ** 20,
+        help='evict least recently used spec repos above MIB MiB '
+             '(default: {})'.format(cache.DEFAULT_MAX_SIZE // 2 ** 20))
+    parser.add_argument(
+        '--source-mirrors', metavar='DIR',
+        help='keep mirrors of source repos in DIR and check out from '
+             'them, rather than cloning the source for every order')
+    parser.add_argument(
+        '--workspaces', metavar='DIR',
+        help='keep a workspace for each source and spec in DIR and reuse '
+             'it for the next order, rather than building every order in '
+             'a fresh directory')
+    parser.add_argument(
+        '--max-workspaces', type=int, metavar='N',
+        default=cache.DEFAULT_MAX_WORKSPACES,
+        help='keep at most N workspaces, retiring the least recently '
+             'used (default: {})'.format(cache.DEFAULT_MAX_WORKSPACES))
+    parser.add_argument(
+        '--workspace-clean', choices=build_source.CLEAN_POLICIES,
+        default=build_source.CLEAN_UNTRACKED,
+        help='remove nothing, files not in the source unless ignored, '
+             'or all files not in the source from a reused workspace '
+             '(default: {})'.format(build_source.CLEAN_UNTRACKED))
+    parser.add_argument(
+        '--probe-ttl', type=float, default=cache.DEFAULT_PROBE_TTL,
+        metavar='SECONDS',
+        help='remember the kind of each source URI for SECONDS; 0 to '
+             'probe for every order (default: {})'.format(
+                 cache.DEFAULT_PROBE_TTL))
+    parser.add_argument(
+        '--spool-memory', type=int, metavar='KIB',
+        default=spool.DEFAULT_MAX_MEMORY // 2 ** 10,
+        help='hold up to KIB KiB of each step\'s output in memory before '
+             'spooling it to disk (default: {})'.format(
+                 spool.DEFAULT_MAX_MEMORY // 2 ** 10))
+    parser.add_argument(
+        '--max-output', type=int, metavar='MIB',
+        help='keep only the head and tail of step output beyond MIB MiB '
+             '(default: unlimited)')
+    parser.add_argument(
+        '--step-parallelism', type=int, default=1, metavar='N',
+        help='run up to N independent build steps of an order at once '
+             '(default: 1)')
+    parser.add_argument(
+        '--publish', choices=order.PUBLISH_MODES,
+        default=order.PUBLISH_REPORT,
+        help='append each report to the report ref of its spec, or push '
+             'it to a ref of its own for igor.aggregate to append '
+             '(default: {})'.format(order.PUBLISH_REPORT))
+    parser.add_argument(
+        '--result-cache', action='store_true',
+        help='reuse the result of an earlier passing build of the same '
+             'spec tree, source commit and environment instead of '
+             'executing the build steps')
+    parser.add_argument(
+        '--result-cache-env', action='append', default=[], metavar='NAME',
+        help='with --result-cache, count environment variable NAME as an '
+             'input of the build (may be repeated)')
+    parser.add_argument(
+        '--log-interval', type=float, default=protocol.LOG_INTERVAL,
+        metavar='SECONDS',
+        help='forward output of running build steps to the server every '
+             'SECONDS; 0 to disable (default: {})'.format(
+                 protocol.LOG_INTERVAL))
     parser.add_argument('--logging', metavar='LEVEL')
     args = parser.parse_args()
 
@@ -41,8 +250,14 @@ def main():
             level = logging.INFO
         logging.basicConfig(level=level)
 
-    with multiprocessing.Pool() as pool:
-        worker = net.Worker(pool=pool, host=args.host, port=args.port)
-        asyncore.loop()
+    probe_cache = None
+    if args.probe_ttl > 0:
+        probe_cache = cache.ProbeCache(ttl=args.probe_ttl)
+    if args.workspaces is not None:
+        workspace_pool(args).sweep()  # finish deletions cut short
+    if args.engine == 'asyncio':
+        asyncio.run(run_asyncio(args, probe_cache))
+    else:
+        run_pool(args, probe_cache)
 
 main()
@@ -0,0 +1,171 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Adapt the number of orders a worker executes to the machine's load.
+
+A ``Controller`` is consulted periodically by the worker.  It samples
+the load average, available memory and free disk space and moves the
+worker's concurrency limit one order at a time between the configured
+bounds: down when the machine is overloaded or short of memory or
+disk, up when there is room for another order.
+
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+INTERVAL = 30.0  # seconds between decisions
+MIN_FREE_MEMORY = 2 ** 29  # bytes
+MIN_FREE_DISK = 2 ** 30  # bytes
+
+
+def load_average():
+    """Return the one minute load average."""
+    return os.getloadavg()[0]
+
+
+def available_memory(path='/proc/meminfo'):
+    """Return bytes of memory available, or ``None`` if unknown."""
+    try:
+        with open(path) as f:
+            for entry in f:
+                if entry.startswith('MemAvailable:'):
+                    return int(entry.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def free_disk(path):
+    """Return bytes free on the filesystem containing ``path``.
+
+    If ``path`` does not exist yet, its nearest existing ancestor is
+    measured.
+
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+class Controller:
+    """Decide how many orders a worker should execute at once.
+
+    ``minimum``, ``maximum``
+      Bounds of the concurrency limit.
+    ``target_load``
+      One minute load average that the worker aims to stay below;
+      by default the number of CPUs.  The limit grows only while
+      the load is at least one below the target.
+    ``min_free_memory``
+      Bytes of available memory below which the limit shrinks.
+    ``min_free_disk``
+      Bytes free on the filesystem of any of ``paths`` (by default
+      the temporary directory, where sources are checked out) below
+      which the limit shrinks.
+    ``interval``
+      Seconds between decisions.
+
+    """
+    def __init__(
+        self, *, minimum=1, maximum, target_load=None,
+        min_free_memory=MIN_FREE_MEMORY, min_free_disk=MIN_FREE_DISK,
+        paths=None, interval=INTERVAL
+    ):
+        if not 1 <= minimum <= maximum:
+            raise ValueError('bounds must satisfy 1 <= minimum <= maximum')
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_load = target_load or multiprocessing.cpu_count()
+        self.min_free_memory = min_free_memory
+        self.min_free_disk = min_free_disk
+        self.paths = paths or [tempfile.gettempdir()]
+        self.interval = interval
+        self.t_decision = time.monotonic()
+        self.sample = {}
+        self.reason = None
+        self.grown = 0
+        self.shrunk = 0
+
+    def initial(self):
+        """Return the limit to start with."""
+        return max(
+            self.minimum,
+            min(self.maximum, multiprocessing.cpu_count())
+        )
+
+    def measure(self):
+        """Return the current load, available memory and free disk."""
+        return {
+            'load': load_average(),
+            'memory': available_memory(),
+            'disk': min(free_disk(path) for path in self.paths),
+        }
+
+    def decide(self, limit, sample):
+        """Return the new limit and the reason for it."""
+        if sample['load'] > self.target_load:
+            reason, step = 'load', -1
+        elif sample['memory'] is not None \
+                and sample['memory'] < self.min_free_memory:
+            reason, step = 'memory', -1
+        elif sample['disk'] < self.min_free_disk:
+            reason, step = 'disk', -1
+        elif sample['load'] + 1 <= self.target_load:
+            reason, step = 'idle', 1
+        else:
+            reason, step = 'steady', 0
+        return max(self.minimum, min(self.maximum, limit + step)), reason
+
+    def update(self, limit, now=None):
+        """Return the limit to use, given the current one.
+
+        A new decision is made once every ``interval`` seconds;
+        between decisions ``limit`` is returned unchanged.
+
+        """
+        now = time.monotonic() if now is None else now
+        if now - self.t_decision < self.interval:
+            return limit
+        self.t_decision = now
+        self.sample = self.measure()
+        new_limit, self.reason = self.decide(limit, self.sample)
+        if new_limit > limit:
+            self.grown += 1
+        elif new_limit < limit:
+            self.shrunk += 1
+        if new_limit != limit:
+            logger.info(
+                'concurrency {} -> {} ({}): {}'.format(
+                    limit, new_limit, self.reason, self.sample))
+        return new_limit
+
+    def stats(self):
+        return dict(
+            self.sample,
+            minimum=self.minimum,
+            maximum=self.maximum,
+            reason=self.reason,
+            grown=self.grown,
+            shrunk=self.shrunk,
+        )
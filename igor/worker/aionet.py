@@ -0,0 +1,97 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import traceback
+
+from . import protocol
+
+logger = logging.getLogger(__name__)
+
+
+class Worker(protocol.Worker):
+    """asyncio counterpart of ``net.Worker``.
+
+    Orders are executed in the worker process itself rather than in
+    a pool of forked processes: up to ``concurrency`` orders run at
+    once on a pool of threads, each waiting on the git and build step
+    subprocesses of its order, while the event loop talks to the
+    server.  Step output is handed straight to the event loop.
+
+    """
+    def __init__(self, *, host, port, loop=None, **kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            self.concurrency, thread_name_prefix='igor-order')
+        self.writer = None
+        self.tasks = set()
+
+    def push(self, data):
+        if self.writer is not None:
+            self.writer.write(data)
+
+    def start_order(self, o):
+        task = self.loop.create_task(self.execute(o))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def execute(self, o):
+        log = None
+        if self.log_interval > 0:
+            log = functools.partial(
+                self.loop.call_soon_threadsafe, self.add_log, o.id)
+        try:
+            publish = await self.loop.run_in_executor(
+                self.executor,
+                functools.partial(
+                    o.execute, repo_cache=self.repo_cache, log=log)
+            )
+        except Exception:
+            self.order_failed(o, traceback.format_exc())
+        else:
+            self.order_done(o, 'C', publish)
+
+    async def poll_forever(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self.poll()
+
+    async def run(self):
+        """Serve orders from the server until it closes the connection."""
+        reader, self.writer = await asyncio.open_connection(
+            self.host, self.port)
+        self.connection_made()
+        poller = self.loop.create_task(self.poll_forever())
+        try:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    break
+                try:
+                    self.process_data(data.rstrip(b'\n'))
+                except Exception:
+                    logger.exception('unhandled exception')
+        finally:
+            poller.cancel()
+            self.writer.close()
+            self.writer = None
+            self.executor.shutdown(wait=False)
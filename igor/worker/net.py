@@ -16,36 +16,54 @@
 
 import asyncore
 import asynchat
+import functools
 import logging
-import json
-import multiprocessing
+import os
+import queue
+import time
 import traceback
-import uuid
 
-from .. import order
-from ..server import error
+from . import protocol
 
 logger = logging.getLogger(__name__)
 
+LOG_QUEUE_SIZE = 1024  # chunks of step output queued by pool processes
 
-class Worker(asynchat.async_chat):
-    def __init__(self, *, pool, host, port):
-        super().__init__()
+_log_queue = None  # queue of step output, in pool processes
+
+
+class Worker(asynchat.async_chat, protocol.Worker):
+    """Worker that executes orders in a ``multiprocessing.Pool``.
+
+    Each order is executed in a pool process, so ``concurrency``
+    should be the size of the pool.  Step output is put by
+    the pool processes to ``log_queue``, which ``poll`` drains.
+
+    The pool reports completed orders on a thread of its own; they
+    are handed to the loop thread through ``completions``, so that
+    the worker's state is only touched by the loop thread.
+
+    """
+    def __init__(self, *, pool, host, port, log_queue=None, **kwargs):
+        asynchat.async_chat.__init__(self)
+        protocol.Worker.__init__(self, **kwargs)
         self.pool = pool
-        self.uuid = uuid.uuid4()
+        self.log_queue = log_queue  # step output from pool processes
+        self.completions = queue.Queue()  # (method, args) from the pool
+        self.waker = Waker(self.poll_completions)
         self.create_socket()
         self.connect((host, port))
         self.ibuf = []
         self.set_terminator(b'\n')
-
-        logger.info('worker id: {}'.format(self.uuid))
-
-        for i in range(multiprocessing.cpu_count()):
-            self._register_assign()
+        self.connection_made()
 
     def handle_close(self):
         self.close()
 
+    def close(self):
+        self.waker.close()
+        super().close()
+
     def collect_incoming_data(self, data):
         self.ibuf.append(data)
 
@@ -53,72 +71,127 @@ class Worker(asynchat.async_chat):
         data = b''.join(self.ibuf)
         self.ibuf = []
 
-        obj = None
         try:
             self.process_data(data)
         except Exception as e:
             logger.exception('unhandled exception')
 
-    def _register_assign(self):
-        self.push_obj({'command': 'orderassign'})
-
-    def push_obj(self, obj):
-        """Serialise the object as UTF-8 encoded JSON and send."""
-        self.push(json.dumps(obj).encode('UTF-8') + b'\n')
+    def poll(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.poll_completions()
+        self.poll_logs(now)
+        super().poll(now)
+
+    def poll_completions(self):
+        """Handle the orders that the pool has completed."""
+        while True:
+            try:
+                method, args = self.completions.get_nowait()
+            except queue.Empty:
+                break
+            method(*args)
+
+    def _complete(self, method, *args):
+        """Pass a completion from the pool's thread to the loop thread."""
+        self.completions.put((method, args))
+        self.waker.wake()
+
+    def poll_logs(self, now):
+        """Collect step output queued by the pool processes."""
+        if self.log_queue is None:
+            return
+        for i in range(LOG_QUEUE_SIZE):
+            try:
+                item = self.log_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.add_log(*item, now=now)
+
+    def start_order(self, o):
+        self.pool.apply_async(
+            work, (o, self.repo_cache), {},
+            callback=functools.partial(
+                self._complete, self.order_done, o, 'C'),
+            error_callback=lambda e:
+                self._complete(self.order_failed, o, e.args[0])
+        )
+
+
+class Waker(asyncore.file_dispatcher):
+    """Wake the loop from another thread to call ``callback``."""
+    def __init__(self, callback, map=None):
+        r, self._w = os.pipe()
+        os.set_blocking(self._w, False)
+        super().__init__(r, map)
+        os.close(r)  # file_dispatcher keeps a duplicate
+        self.callback = callback
+
+    def writable(self):
+        return False
+
+    def wake(self):
+        w = self._w
+        if w is None:
+            return
+        try:
+            os.write(w, b'\0')
+        except OSError:
+            pass  # already woken, or closed meanwhile
 
-    def process_data(self, data):
+    def handle_read(self):
         try:
-            obj = json.loads(data.decode('UTF-8'))
-        except Exception as e:
-            raise error.ClientError(str(e)) from e
-        self.process_obj(obj)
-
-    def process_obj(self, obj):
-        if 'order' not in obj:
-            logger.warn(
-                'received obj that is not an order; ignoring: {}'.format(obj))
-        else:
-            logger.info('received order: {}'.format(obj))
-            o = order.Order.from_obj(obj['order'])
-            # TODO check order is assigned and not complete
-
-            def success_cb(result):
-                self.push_obj(result)
-                self._register_assign()
-
-            def error_cb(e):
-                logger.error("Error in worker process:\n{}".format(e.args[0]))
-                self.push_obj(build_ordercomplete_obj(o.id, 'E'))
-                self._register_assign()
-
-            self.pool.apply_async(
-                work, (o,), {},
-                callback=success_cb,
-                error_callback=error_cb
-            )
-
-
-def build_ordercomplete_obj(order_id, result):
-    return {
-        'command': 'ordercomplete',
-        'params': {'order_id': order_id, 'result': result},
-    }
-
-
-# TODO: can open a socket in each worker to send progress to server,
-# when we get around to implementing that.  It should be possible to
-# share any secrets that authenticate transmissions with the child
-# processes.
-#
-def work(order):
-    """Execute a build order.
+            self.recv(4096)
+        except BlockingIOError:
+            pass
+        self.callback()
+
+    def handle_error(self):
+        logger.exception('unhandled exception')  # keep waking
+
+    def close(self):
+        if self._w is not None:
+            os.close(self._w)
+            self._w = None
+        super().close()
+
+
+def init_process(log_queue, options):
+    """Configure a pool process.
+
+    If ``log_queue`` is given, output of running build steps is put
+    to it for the worker to forward to the server.  ``options`` are
+    given to ``protocol.configure``.
+
+    """
+    global _log_queue
+    _log_queue = log_queue
+    protocol.configure(**options)
+
+
+def forward_log(order_id, step, stream, data):
+    """Put a chunk of step output to the worker's log queue.
+
+    Live output is best effort: if the queue is full the chunk is
+    dropped rather than holding up the build.
+
+    """
+    try:
+        _log_queue.put_nowait((order_id, step, stream, data))
+    except queue.Full:
+        pass
+
+
+def work(order, repo_cache):
+    """Execute a build order and return its publish stats.
 
     This routine cannot be a method on ``Worker`` as it must be
     picklable to work with ``multiprocessing``.
 
     """
+    log = None
+    if _log_queue is not None:
+        log = functools.partial(forward_log, order.id)
     try:
-        order.execute()
+        return order.execute(repo_cache=repo_cache, log=log)
     except Exception as e:
         raise RuntimeError(traceback.format_exc())
-    return build_ordercomplete_obj(order.id, 'C')
@@ -0,0 +1,394 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import codecs
+import collections
+import concurrent.futures
+import json
+import logging
+import time
+import uuid
+
+from .. import build
+from .. import build_source
+from .. import cache
+from .. import order
+from .. import spool
+from ..server import error
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 10.0  # seconds
+LOG_INTERVAL = 0.5  # seconds between batches of live step output
+LOG_BATCH_SIZE = 2 ** 16  # bytes of step output that force a batch
+
+
+def configure(
+    *, mirror_root=None, probe_cache=None,
+    spool_memory=spool.DEFAULT_MAX_MEMORY, max_output=None,
+    step_parallelism=1, result_cache=None, workspace_pool=None,
+    publish=order.PUBLISH_REPORT
+):
+    """Configure order execution in this process.
+
+    See ``build_source.GitBuildSource``, ``build_source.BuildSource``,
+    ``build.BuildStep``, ``build.BuildSpec`` and ``order.Order``.
+
+    """
+    build_source.GitBuildSource.set_mirror_root(mirror_root)
+    build_source.BuildSource.set_probe_cache(probe_cache)
+    build.BuildStep.set_output_limits(
+        spool_memory=spool_memory, max_output=max_output)
+    build.BuildSpec.set_parallelism(step_parallelism)
+    order.Order.set_result_cache(result_cache)
+    order.Order.set_workspace_pool(workspace_pool)
+    order.Order.set_publish(publish)
+
+
+class Worker:
+    """Transport- and engine-independent half of a worker.
+
+    Subclasses must implement ``push``, which sends the given
+    ``bytes`` to the server, and ``start_order``, which begins
+    executing an order and eventually calls ``order_done`` or
+    ``order_failed``.  Complete lines received from the server should
+    be given to ``process_data``, and ``poll`` called periodically.
+
+    ``concurrency``
+      Maximum number of orders executed at once.
+    ``controller``
+      Optional ``adaptive.Controller`` that varies the number of
+      orders executed at once (``limit``) with the machine's load,
+      within ``concurrency``.
+    ``prefetch``
+      If true, accept one further order per slot.  Such orders are
+      held until a slot frees, meanwhile bringing the repositories
+      they need up to date in the background (see
+      ``order.Order.prefetch``).  The server is told when each order
+      is started, and may revoke orders held for too long.
+
+    The worker holds ``credits`` registrations with the server, so
+    that ``credits`` plus the orders being executed or held make
+    ``capacity``.
+
+    """
+    def __init__(
+        self, *, concurrency, heartbeat_interval=HEARTBEAT_INTERVAL,
+        repo_cache=None, log_interval=LOG_INTERVAL, controller=None,
+        prefetch=False
+    ):
+        self.concurrency = concurrency
+        self.controller = controller
+        self.limit = concurrency if controller is None \
+            else min(concurrency, controller.initial())
+        self.credits = 0  # outstanding registrations with the server
+        self.prefetch = prefetch
+        self.held = collections.OrderedDict()  # order id -> held order
+        self.prefetcher = None
+        if prefetch:
+            self.prefetcher = concurrent.futures.ThreadPoolExecutor(
+                concurrency, thread_name_prefix='igor-prefetch')
+        self.repo_cache = repo_cache or cache.RepoCache()
+        self.heartbeat_interval = heartbeat_interval
+        self.t_heartbeat = time.monotonic()
+        self.log_interval = log_interval
+        self.t_log = time.monotonic()
+        self.logs = {}  # order id -> [[step, stream, [text]]]
+        self.logs_size = 0  # bytes of output in logs
+        self._decoders = {}  # (order id, step, stream) -> decoder
+        self.orders = set()  # ids of orders being executed or held
+        self.uuid = uuid.uuid4()
+        self.published = {  # totals of the reports published
+            'reports': 0, 'retries': 0, 'latency': 0.0, 'max_latency': 0.0,
+        }
+
+        logger.info('worker id: {}'.format(self.uuid))
+
+    def push(self, data):
+        raise NotImplementedError
+
+    def start_order(self, order):
+        raise NotImplementedError
+
+    def _register_assign(self, count=1):
+        params = {}
+        if count != 1:
+            params['count'] = count
+        caches = self.repo_cache.uris()  # as on disk, after evictions
+        if caches:
+            params['caches'] = caches
+        if self.prefetch:
+            params['prefetch'] = True
+        obj = {'command': 'orderassign'}
+        if params:
+            obj['params'] = params
+        self.credits += count
+        self.push_obj(obj)
+
+    def _release_assign(self, count=None):
+        """Return unused assignment credits to the server.
+
+        If ``count`` is ``None``, return all credits.
+
+        """
+        obj = {'command': 'orderrelease'}
+        if count is not None:
+            obj['params'] = {'count': count}
+        self.credits = 0 if count is None else max(0, self.credits - count)
+        self.push_obj(obj)
+
+    @property
+    def capacity(self):
+        """Number of orders to be executing or held at once."""
+        return self.limit * 2 if self.prefetch else self.limit
+
+    @property
+    def running(self):
+        """Number of orders being executed."""
+        return len(self.orders) - len(self.held)
+
+    def set_limit(self, limit):
+        """Register or release credits to execute ``limit`` orders."""
+        self.limit = limit
+        self._start_held()
+        wanted = max(0, self.capacity - len(self.orders))
+        if wanted > self.credits:
+            self._register_assign(wanted - self.credits)
+        elif wanted < self.credits:
+            self._release_assign(self.credits - wanted)
+
+    @property
+    def poll_interval(self):
+        """Seconds between calls to ``poll``."""
+        interval = self.heartbeat_interval
+        if self.log_interval > 0:
+            interval = min(interval, self.log_interval)
+        if self.controller is not None:
+            interval = min(interval, self.controller.interval)
+        return interval
+
+    def connection_made(self):
+        """Register for as many orders as may be executed at once."""
+        self._register_assign(self.capacity)
+
+    def poll(self, now=None):
+        """Send a heartbeat and step output if due; call periodically.
+
+        Heartbeats renew the lease on the orders being executed, so
+        are only sent while there are any.
+
+        """
+        now = time.monotonic() if now is None else now
+        if now - self.t_log >= self.log_interval:
+            self.flush_logs(now)
+        if now - self.t_heartbeat >= self.heartbeat_interval:
+            if self.orders:
+                self.push_obj({'command': 'heartbeat'})
+            self.t_heartbeat = now
+        if self.controller is not None:
+            limit = self.controller.update(self.limit, now)
+            if limit != self.limit:
+                self.set_limit(limit)
+                self.log_concurrency_stats()
+
+    def add_log(self, order_id, step, stream, data, now=None):
+        """Collect a chunk of step output for forwarding.
+
+        Output is sent to the server in batches, when ``log_interval``
+        has passed (see ``poll``) or ``LOG_BATCH_SIZE`` bytes have
+        accumulated.  Output of orders that have completed is
+        dropped; it is in their reports.
+
+        """
+        if order_id not in self.orders:
+            return
+        key = order_id, step, stream
+        if key not in self._decoders:
+            self._decoders[key] = \
+                codecs.getincrementaldecoder('UTF-8')(errors='replace')
+        text = self._decoders[key].decode(data)
+        chunks = self.logs.setdefault(order_id, [])
+        if chunks and chunks[-1][:2] == [step, stream]:
+            chunks[-1][2].append(text)
+        else:
+            chunks.append([step, stream, [text]])
+        self.logs_size += len(data)
+        if self.logs_size >= LOG_BATCH_SIZE:
+            self.flush_logs(time.monotonic() if now is None else now)
+
+    def flush_logs(self, now):
+        """Send collected step output to the server."""
+        for order_id, chunks in self.logs.items():
+            self.push_obj(build_orderlog_obj(order_id, [
+                {'step': step, 'stream': stream, 'data': ''.join(texts)}
+                for step, stream, texts in chunks
+            ]))
+        self.logs = {}
+        self.logs_size = 0
+        self.t_log = now
+        if any(key[0] not in self.orders for key in self._decoders):
+            self._decoders = {
+                key: decoder for key, decoder in self._decoders.items()
+                if key[0] in self.orders
+            }
+
+    def log_cache_stats(self):
+        stats = self.repo_cache.stats()
+        logger.info(
+            'repo cache: {hits} hits, {misses} misses ({hit_rate:.0%}), '
+            '{repos} repos, {size} bytes'.format(**stats)
+        )
+
+    def record_publish(self, publish):
+        """Add the publish stats of an order (see ``order.Order.execute``)."""
+        self.published['reports'] += 1
+        self.published['retries'] += publish['attempts'] - 1
+        self.published['latency'] += publish['latency']
+        self.published['max_latency'] = max(
+            self.published['max_latency'], publish['latency'])
+
+    def log_publish_stats(self):
+        published = self.published
+        logger.info(
+            'publish: {} reports, {} retries, {:.3f}s mean latency, '
+            '{:.3f}s max latency'.format(
+                published['reports'], published['retries'],
+                published['latency'] / (published['reports'] or 1),
+                published['max_latency'])
+        )
+
+    def log_concurrency_stats(self):
+        logger.info(
+            'concurrency: limit {}, {} executing, {} credits; {}'.format(
+                self.limit, len(self.orders), self.credits,
+                self.controller.stats())
+        )
+
+    def push_obj(self, obj):
+        """Serialise the object as UTF-8 encoded JSON and send."""
+        self.push(json.dumps(obj).encode('UTF-8') + b'\n')
+
+    def process_data(self, data):
+        try:
+            obj = json.loads(data.decode('UTF-8'))
+        except Exception as e:
+            raise error.ClientError(str(e)) from e
+        self.process_obj(obj)
+
+    def process_obj(self, obj):
+        if 'revoke' in obj:
+            self.revoke(obj['revoke'])
+        elif 'expired' in obj:
+            self.expire(obj['expired'])
+        elif 'order' not in obj:
+            logger.warn(
+                'received obj that is not an order; ignoring: {}'.format(obj))
+        else:
+            logger.info('received order: {}'.format(obj))
+            o = order.Order.from_obj(obj['order'])
+            # TODO check order is assigned and not complete
+            self.credits = max(0, self.credits - 1)
+            start = self.running < self.limit
+            self.orders.add(o.id)
+            if start:
+                self._start(o)
+            else:
+                self.held[o.id] = o
+                if self.prefetcher is not None:
+                    self.prefetcher.submit(self._prefetch, o)
+
+    def _prefetch(self, o):
+        try:
+            o.prefetch(repo_cache=self.repo_cache)
+        except Exception:
+            logger.exception('prefetch of order {} failed'.format(o.id))
+
+    def _start(self, o):
+        if self.prefetch:
+            self.push_obj({'command': 'orderstart',
+                           'params': {'order_id': o.id}})
+        self.start_order(o)
+
+    def _start_held(self):
+        while self.held and self.running < self.limit:
+            order_id, o = self.held.popitem(last=False)
+            self._start(o)
+
+    def revoke(self, order_id):
+        """Give up a held order that the server has reassigned."""
+        if order_id in self.held:
+            logger.info('order {} revoked'.format(order_id))
+            del self.held[order_id]
+            self.orders.discard(order_id)
+            if self.credits + len(self.orders) < self.capacity:
+                self._register_assign()
+        else:
+            logger.warning(
+                'order {} revoked but not held; ignoring'.format(order_id))
+
+    def expire(self, order_ids):
+        """Register again after the server let our lease expire.
+
+        The server has revoked all our credits and requeued the orders
+        ``order_ids``.  Those still held are given up; those executing
+        run to completion.
+
+        """
+        logger.warning('lease expired; {} orders requeued'.format(
+            len(order_ids)))
+        for order_id in order_ids:
+            if self.held.pop(order_id, None) is not None:
+                self.orders.discard(order_id)
+        self.credits = 0
+        wanted = self.capacity - len(self.orders)
+        if wanted > 0:
+            self._register_assign(wanted)
+
+    def order_done(self, order, result, publish=None):
+        """Report the outcome of an order and ask for another.
+
+        ``publish`` is the return value of ``order.Order.execute``,
+        if the order was executed.  No other order is asked for if
+        the limit has been lowered.
+
+        """
+        if publish is not None:
+            self.record_publish(publish)
+            self.log_publish_stats()
+        self.orders.discard(order.id)
+        self.push_obj(build_ordercomplete_obj(order.id, result))
+        self._start_held()
+        if self.credits + len(self.orders) < self.capacity:
+            self._register_assign()
+        self.log_cache_stats()
+
+    def order_failed(self, order, tb):
+        logger.error("Error in worker process:\n{}".format(tb))
+        self.order_done(order, 'E')
+
+
+def build_ordercomplete_obj(order_id, result):
+    return {
+        'command': 'ordercomplete',
+        'params': {'order_id': order_id, 'result': result},
+    }
+
+
+def build_orderlog_obj(order_id, chunks):
+    return {
+        'command': 'orderlog',
+        'params': {'order_id': order_id, 'chunks': chunks},
+    }
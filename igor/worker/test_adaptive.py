@@ -0,0 +1,104 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from . import adaptive
+
+GiB = 2 ** 30
+
+
+class ControllerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.c = adaptive.Controller(
+            minimum=2, maximum=8, target_load=4,
+            min_free_memory=GiB, min_free_disk=GiB, interval=10
+        )
+
+    def sample(self, load=0.0, memory=8 * GiB, disk=8 * GiB):
+        return {'load': load, 'memory': memory, 'disk': disk}
+
+    def test_bounds_validated(self):
+        for minimum, maximum in ((0, 1), (3, 2)):
+            with self.assertRaises(ValueError):
+                adaptive.Controller(minimum=minimum, maximum=maximum)
+
+    def test_decide_grows_when_idle(self):
+        self.assertEqual(self.c.decide(4, self.sample(load=3)), (5, 'idle'))
+
+    def test_decide_holds_near_target(self):
+        self.assertEqual(
+            self.c.decide(4, self.sample(load=3.5)), (4, 'steady'))
+
+    def test_decide_shrinks_when_overloaded(self):
+        self.assertEqual(self.c.decide(4, self.sample(load=5)), (3, 'load'))
+
+    def test_decide_shrinks_when_short_of_memory(self):
+        self.assertEqual(
+            self.c.decide(4, self.sample(memory=GiB // 2)), (3, 'memory'))
+
+    def test_decide_ignores_unknown_memory(self):
+        self.assertEqual(
+            self.c.decide(4, self.sample(memory=None)), (5, 'idle'))
+
+    def test_decide_shrinks_when_short_of_disk(self):
+        self.assertEqual(
+            self.c.decide(4, self.sample(disk=GiB // 2)), (3, 'disk'))
+
+    def test_decide_stays_within_bounds(self):
+        self.assertEqual(self.c.decide(8, self.sample())[0], 8)
+        self.assertEqual(self.c.decide(2, self.sample(load=9))[0], 2)
+
+    def test_update_decides_once_per_interval_and_counts(self):
+        now = self.c.t_decision
+        with unittest.mock.patch.object(
+            self.c, 'measure', return_value=self.sample()
+        ):
+            self.assertEqual(self.c.update(4, now + 5), 4)
+            self.assertEqual(self.c.update(4, now + 10), 5)
+            self.assertEqual(self.c.update(5, now + 15), 5)
+        with unittest.mock.patch.object(
+            self.c, 'measure', return_value=self.sample(load=9)
+        ):
+            self.assertEqual(self.c.update(5, now + 20), 4)
+        stats = self.c.stats()
+        self.assertEqual((stats['grown'], stats['shrunk']), (1, 1))
+        self.assertEqual(stats['reason'], 'load')
+        self.assertEqual(stats['load'], 9)
+
+    def test_available_memory_parses_meminfo(self):
+        m = unittest.mock.mock_open(
+            read_data='MemTotal: 100 kB\nMemAvailable: 42 kB\n')
+        with unittest.mock.patch('builtins.open', m):
+            self.assertEqual(adaptive.available_memory(), 42 * 1024)
+
+    def test_measure_takes_least_free_disk_of_paths(self):
+        c = adaptive.Controller(maximum=4, paths=['/a', '/b'])
+        free = {'/a': 8 * GiB, '/b': GiB}
+        with unittest.mock.patch.object(
+            adaptive, 'free_disk', side_effect=free.get
+        ):
+            self.assertEqual(c.measure()['disk'], GiB)
+
+    def test_free_disk_of_missing_path_measures_ancestor(self):
+        with tempfile.TemporaryDirectory() as name, \
+                unittest.mock.patch.object(shutil, 'disk_usage') as usage:
+            adaptive.free_disk(os.path.join(name, 'not', 'yet'))
+        usage.assert_called_once_with(name)
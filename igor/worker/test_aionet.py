@@ -0,0 +1,66 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import unittest
+import unittest.mock
+
+from .. import order
+from . import aionet
+
+
+class WorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.w = aionet.Worker(
+            host='localhost', port=1602, concurrency=2, loop=self.loop,
+            repo_cache=unittest.mock.Mock()
+        )
+        self.addCleanup(self.w.executor.shutdown)
+        self.w.writer = unittest.mock.Mock()
+        self.o = order.Order(
+            spec_uri='/spec', spec_ref='refs/ci/spec/test', desc='test',
+            source_uri='/source'
+        )
+        self.w.orders.add(self.o.id)
+
+    def test_execute_runs_order_in_executor_and_reports(self):
+        def execute(self, *, repo_cache, log):
+            log('a', 'stdout', b'foo')
+            return {'attempts': 1, 'latency': 0.1}
+
+        with unittest.mock.patch.object(order.Order, 'execute', execute), \
+                unittest.mock.patch.object(self.w, 'order_done') as done, \
+                unittest.mock.patch.object(self.w, 'add_log') as add_log:
+            self.loop.run_until_complete(self.w.execute(self.o))
+            self.loop.run_until_complete(asyncio.sleep(0))
+        done.assert_called_once_with(
+            self.o, 'C', {'attempts': 1, 'latency': 0.1})
+        add_log.assert_called_once_with(self.o.id, 'a', 'stdout', b'foo')
+
+    def test_execute_reports_error(self):
+        with unittest.mock.patch.object(
+            order.Order, 'execute', side_effect=RuntimeError
+        ), unittest.mock.patch.object(self.w, 'order_failed') as failed:
+            self.loop.run_until_complete(self.w.execute(self.o))
+        self.assertIs(failed.call_args[0][0], self.o)
+        self.assertIn('RuntimeError', failed.call_args[0][1])
+
+    def test_push_writes_to_stream(self):
+        self.w.push_obj({'command': 'heartbeat'})
+        self.w.writer.write.assert_called_once_with(
+            b'{"command": "heartbeat"}\n')
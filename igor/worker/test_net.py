@@ -0,0 +1,117 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncore
+import select
+import socket
+import threading
+import unittest
+import unittest.mock
+
+from .. import order
+from . import net
+
+
+class WorkerTestCase(unittest.TestCase):
+    worker_options = {}
+
+    def setUp(self):
+        server = socket.socket()
+        server.bind(('localhost', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        repo_cache = unittest.mock.Mock()
+        repo_cache.uris.return_value = []
+        repo_cache.stats.return_value = {
+            'hits': 0, 'misses': 0, 'hit_rate': 0, 'repos': 0, 'size': 0}
+        self.pool = unittest.mock.Mock()
+        self.w = net.Worker(
+            pool=self.pool, host='localhost', port=server.getsockname()[1],
+            concurrency=2, repo_cache=repo_cache, **self.worker_options
+        )
+        self.addCleanup(self.w.close)
+        self.o = order.Order(
+            spec_uri='/spec', spec_ref='refs/ci/spec/test', desc='test',
+            source_uri='/source'
+        )
+
+    def complete_in_pool_thread(self, result, call=-1):
+        """Complete an order as the pool would, on another thread."""
+        kwargs = self.pool.apply_async.call_args_list[call][1]
+        if isinstance(result, Exception):
+            target, args = kwargs['error_callback'], (result,)
+        else:
+            target, args = kwargs['callback'], (result,)
+        thread = threading.Thread(target=target, args=args)
+        thread.start()
+        thread.join()
+
+    def test_completion_handled_on_loop_thread(self):
+        self.w.orders.add(self.o.id)
+        with unittest.mock.patch.object(self.w, 'order_done') as done:
+            self.w.start_order(self.o)
+            self.complete_in_pool_thread({'attempts': 1, 'latency': 0.1})
+            self.assertFalse(done.called)
+            # as the loop would on waking
+            waker = self.w.waker
+            self.assertEqual(
+                select.select([waker.socket], [], [], 1)[0], [waker.socket])
+            waker.handle_read_event()
+        done.assert_called_once_with(
+            self.o, 'C', {'attempts': 1, 'latency': 0.1})
+
+    def test_failure_handled_by_poll(self):
+        self.w.orders.add(self.o.id)
+        with unittest.mock.patch.object(self.w, 'order_failed') as failed:
+            self.w.start_order(self.o)
+            self.complete_in_pool_thread(RuntimeError('tb'))
+            self.assertFalse(failed.called)
+            self.w.poll()
+        failed.assert_called_once_with(self.o, 'tb')
+
+    def test_close_closes_waker(self):
+        self.w.close()
+        self.assertNotIn(self.w.waker, asyncore.socket_map.values())
+        self.w.waker.wake()
+
+
+class PrefetchWorkerTestCase(WorkerTestCase):
+    worker_options = {'prefetch': True}
+
+    def setUp(self):
+        patcher = unittest.mock.patch.object(order.Order, 'prefetch')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+        self.addCleanup(self.w.prefetcher.shutdown)
+
+    def receive(self):
+        o = order.Order(
+            spec_uri='/spec', spec_ref='refs/ci/spec/test', desc='test',
+            source_uri='/source'
+        )
+        self.w.process_obj({'order': o.to_obj()})
+        return o
+
+    def test_revoked_order_not_started_by_pending_completion(self):
+        orders = [self.receive() for i in range(3)]
+        self.assertEqual(list(self.w.held), [orders[2].id])
+        self.complete_in_pool_thread({'attempts': 1, 'latency': 0.1}, 0)
+        self.w.process_obj({'revoke': orders[2].id})
+        self.w.poll()
+        self.assertEqual(self.pool.apply_async.call_count, 2)
+        self.assertEqual(self.w.orders, {orders[1].id})
+        self.assertEqual(self.w.credits + len(self.w.orders), 4)
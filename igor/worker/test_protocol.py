@@ -0,0 +1,264 @@
+# This file is part of igor-ci - the ghastly CI system
+# Copyright (C) 2013  Fraser Tweedale
+#
+# igor-ci is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import unittest
+import unittest.mock
+
+from .. import order
+from . import protocol
+
+
+class Worker(protocol.Worker):
+    def __init__(self, **kwargs):
+        repo_cache = unittest.mock.Mock()
+        repo_cache.stats.return_value = {
+            'hits': 0, 'misses': 0, 'hit_rate': 0, 'repos': 0, 'size': 0}
+        repo_cache.uris.return_value = []
+        super().__init__(concurrency=4, repo_cache=repo_cache, **kwargs)
+        self.sent = []
+        self.started = []
+
+    def push(self, data):
+        self.sent.append(json.loads(data.decode('UTF-8')))
+
+    def start_order(self, o):
+        self.started.append(o)
+
+
+class WorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.w = Worker(log_interval=1, heartbeat_interval=10)
+        self.o = order.Order(
+            spec_uri='/spec', spec_ref='refs/ci/spec/test', desc='test',
+            source_uri='/source'
+        )
+
+    def test_connection_made_registers_for_concurrency_orders(self):
+        self.w.connection_made()
+        self.assertEqual(self.w.sent, [
+            {'command': 'orderassign', 'params': {'count': 4}}])
+
+    def test_process_data_starts_order(self):
+        self.w.process_data(json.dumps({'order': self.o.to_obj()}).encode())
+        self.assertEqual(self.w.started, [self.o])
+        self.assertEqual(self.w.orders, {self.o.id})
+
+    def test_order_done_reports_result_and_registers_again(self):
+        self.w.orders.add(self.o.id)
+        self.w.repo_cache.uris.return_value = ['/spec']
+        self.w.order_done(self.o, 'C')
+        self.assertEqual(self.w.sent, [
+            protocol.build_ordercomplete_obj(self.o.id, 'C'),
+            {'command': 'orderassign', 'params': {'caches': ['/spec']}},
+        ])
+        self.assertEqual(self.w.orders, set())
+
+    def test_order_done_records_publish_stats(self):
+        for publish in (
+            {'attempts': 1, 'latency': 0.25},
+            {'attempts': 3, 'latency': 0.75},
+        ):
+            self.w.orders.add(self.o.id)
+            with self.assertLogs(protocol.logger):
+                self.w.order_done(self.o, 'C', publish)
+        self.assertEqual(self.w.published, {
+            'reports': 2, 'retries': 2, 'latency': 1.0, 'max_latency': 0.75})
+
+    def test_order_failed_reports_error(self):
+        self.w.orders.add(self.o.id)
+        with self.assertLogs(protocol.logger):
+            self.w.order_failed(self.o, 'Traceback')
+        self.assertEqual(
+            self.w.sent[0], protocol.build_ordercomplete_obj(self.o.id, 'E'))
+
+    def test_poll_sends_heartbeat_only_while_executing(self):
+        now = self.w.t_heartbeat
+        self.w.poll(now + 10)
+        self.assertEqual(self.w.sent, [])
+        self.w.orders.add(self.o.id)
+        self.w.poll(now + 15)
+        self.assertEqual(self.w.sent, [])
+        self.w.poll(now + 20)
+        self.assertEqual(self.w.sent, [{'command': 'heartbeat'}])
+
+    def test_poll_interval(self):
+        self.assertEqual(self.w.poll_interval, 1)
+        self.w.log_interval = 0
+        self.assertEqual(self.w.poll_interval, 10)
+
+    def test_logs_batched_until_log_interval(self):
+        self.w.orders.add(self.o.id)
+        now = self.w.t_log
+        self.w.add_log(self.o.id, 'a', 'stdout', b'foo ', now=now)
+        self.w.add_log(self.o.id, 'a', 'stdout', b'bar', now=now)
+        self.w.add_log(self.o.id, 'a', 'stderr', b'baz', now=now)
+        self.w.poll(now + 0.5)
+        self.assertEqual(self.w.sent, [])
+        self.w.poll(now + 1)
+        self.assertEqual(self.w.sent, [protocol.build_orderlog_obj(self.o.id, [
+            {'step': 'a', 'stream': 'stdout', 'data': 'foo bar'},
+            {'step': 'a', 'stream': 'stderr', 'data': 'baz'},
+        ])])
+
+    def test_logs_sent_once_batch_size_reached(self):
+        self.w.orders.add(self.o.id)
+        data = bytes(protocol.LOG_BATCH_SIZE)
+        self.w.add_log(self.o.id, 'a', 'stdout', data, now=self.w.t_log)
+        self.assertEqual(len(self.w.sent), 1)
+        self.assertEqual(self.w.logs, {})
+
+    def test_logs_decoded_across_chunks(self):
+        self.w.orders.add(self.o.id)
+        data = 'é'.encode('UTF-8')
+        self.w.add_log(self.o.id, 'a', 'stdout', data[:1])
+        self.w.add_log(self.o.id, 'a', 'stdout', data[1:])
+        self.w.flush_logs(0)
+        self.assertEqual(
+            self.w.sent[0]['params']['chunks'][0]['data'], 'é')
+
+    def test_logs_of_completed_orders_dropped(self):
+        self.w.add_log(self.o.id, 'a', 'stdout', b'foo')
+        self.assertEqual(self.w.logs, {})
+        self.w.orders.add(self.o.id)
+        self.w.add_log(self.o.id, 'a', 'stdout', b'foo')
+        self.w.orders.discard(self.o.id)
+        self.w.flush_logs(0)
+        self.assertEqual(self.w._decoders, {})
+
+
+class AdaptiveWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.controller = unittest.mock.Mock(interval=30)
+        self.controller.initial.return_value = 2
+        self.controller.update.side_effect = lambda limit, now: limit
+        self.w = Worker(controller=self.controller)
+        self.w.connection_made()
+        self.w.sent = []
+
+    def receive(self):
+        o = order.Order(
+            spec_uri='/spec', spec_ref='refs/ci/spec/test', desc='test',
+            source_uri='/source'
+        )
+        self.w.process_obj({'order': o.to_obj()})
+        return o
+
+    def test_starts_at_initial_limit(self):
+        self.assertEqual((self.w.limit, self.w.credits), (2, 2))
+
+    def test_poll_applies_controller_limit(self):
+        self.controller.update.side_effect = lambda limit, now: 3
+        self.w.poll()
+        self.assertEqual(self.w.sent, [{'command': 'orderassign'}])
+        self.assertEqual(self.w.credits, 3)
+
+    def test_lower_limit_releases_credits(self):
+        self.receive()
+        self.w.set_limit(1)
+        self.assertEqual(self.w.sent, [
+            {'command': 'orderrelease', 'params': {'count': 1}}])
+        self.assertEqual(self.w.credits, 0)
+
+    def test_no_new_credit_after_order_while_over_limit(self):
+        o1, o2 = self.receive(), self.receive()
+        self.w.set_limit(1)
+        self.assertEqual(self.w.sent, [])
+        self.w.order_done(o1, 'C')
+        self.assertEqual(self.w.sent, [
+            protocol.build_ordercomplete_obj(o1.id, 'C')])
+        self.w.order_done(o2, 'C')
+        self.assertEqual(self.w.sent[-1]['command'], 'orderassign')
+        self.assertEqual(self.w.credits, 1)
+
+
+class PrefetchWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = unittest.mock.patch.object(order.Order, 'prefetch')
+        self.prefetch = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.w = Worker(prefetch=True)
+        self.addCleanup(self.w.prefetcher.shutdown)
+        self.w.connection_made()
+
+    def receive(self):
+        o = order.Order(
+            spec_uri='/spec', spec_ref='refs/ci/spec/test', desc='test',
+            source_uri='/source'
+        )
+        self.w.process_obj({'order': o.to_obj()})
+        return o
+
+    def started(self, o):
+        return {'command': 'orderstart', 'params': {'order_id': o.id}}
+
+    def test_registers_for_extra_order_per_slot(self):
+        self.assertEqual(self.w.sent, [{
+            'command': 'orderassign',
+            'params': {'count': 8, 'prefetch': True},
+        }])
+
+    def test_orders_beyond_limit_held_and_prefetched(self):
+        orders = [self.receive() for i in range(5)]
+        self.assertEqual(self.w.started, orders[:4])
+        self.assertEqual(list(self.w.held), [orders[4].id])
+        self.w.prefetcher.shutdown()
+        self.prefetch.assert_called_once_with(repo_cache=self.w.repo_cache)
+        self.assertEqual(
+            self.w.sent[1:], [self.started(o) for o in orders[:4]])
+
+    def test_held_order_started_when_slot_frees(self):
+        orders = [self.receive() for i in range(5)]
+        self.w.sent = []
+        self.w.order_done(orders[0], 'C')
+        self.assertEqual(self.w.started[-1], orders[4])
+        self.assertEqual(self.w.held, {})
+        self.assertEqual(self.w.sent[:2], [
+            protocol.build_ordercomplete_obj(orders[0].id, 'C'),
+            self.started(orders[4]),
+        ])
+        self.assertEqual(self.w.sent[2]['command'], 'orderassign')
+
+    def test_revoke_drops_held_order_and_registers_again(self):
+        orders = [self.receive() for i in range(5)]
+        self.w.sent = []
+        self.w.process_obj({'revoke': orders[4].id})
+        self.assertEqual(self.w.held, {})
+        self.assertNotIn(orders[4].id, self.w.orders)
+        self.assertEqual(self.w.sent[0]['command'], 'orderassign')
+        self.assertEqual(self.w.credits, 4)
+
+    def test_expired_lease_drops_held_orders_and_registers_again(self):
+        orders = [self.receive() for i in range(5)]
+        self.assertEqual(self.w.credits, 3)
+        self.w.sent = []
+        with self.assertLogs(protocol.logger, 'WARNING'):
+            self.w.process_obj({'expired': [orders[0].id, orders[4].id]})
+        self.assertEqual(self.w.held, {})
+        self.assertEqual(self.w.orders, {o.id for o in orders[:4]})
+        self.assertEqual(self.w.sent, [{
+            'command': 'orderassign',
+            'params': {'count': 4, 'prefetch': True},
+        }])
+        self.assertEqual(self.w.credits, 4)
+
+    def test_revoke_of_running_order_ignored(self):
+        o = self.receive()
+        self.w.sent = []
+        with self.assertLogs(protocol.logger, 'WARNING'):
+            self.w.process_obj({'revoke': o.id})
+        self.assertIn(o.id, self.w.orders)
+        self.assertEqual(self.w.sent, [])